@@ -11,4 +11,7 @@ python manage.py collectstatic --noinput
 echo "Running migrations..."
 python manage.py migrate --noinput
 
+echo "Creating cache table..."
+python manage.py createcachetable
+
 echo "Build completed successfully!"
\ No newline at end of file
@@ -11,6 +11,9 @@ import os
 
 from django.core.asgi import get_asgi_application
 
+from financeapp.asgi import DisconnectWatcher
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'finance.settings')
 
-application = get_asgi_application()
+# DisconnectWatcher lets streaming views stop when the client goes away
+application = DisconnectWatcher(get_asgi_application())
@@ -1,9 +1,13 @@
 # your_project/celery.py
 import os
 from celery import Celery
+from kombu.transport import TRANSPORT_ALIASES
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'finance.settings')
 
+# CELERY_BROKER_URL=djangodb:// keeps the queue in the project database
+TRANSPORT_ALIASES.setdefault('djangodb', 'financeapp.broker:Transport')
+
 app = Celery('finance')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
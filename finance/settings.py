@@ -6,12 +6,14 @@ Generated by 'django-admin startproject' using Django 5.2.4.
 import os
 import sys
 import logging
+import tempfile
 import dj_database_url
 from pathlib import Path
 from django.utils.translation import gettext_lazy as _
 from django.contrib.messages import constants as messages
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+from kombu import Queue
 import pymysql
 
 pymysql.install_as_MySQLdb()
@@ -89,14 +91,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "financeapp.middleware.MetricsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
-    "django_otp.middleware.OTPMiddleware",
+    # Cached drop-ins for AuthenticationMiddleware and django_otp's OTPMiddleware
+    "financeapp.auth_cache.CachedAuthenticationMiddleware",
+    "financeapp.auth_cache.CachedOTPMiddleware",
+    "financeapp.usage.CostAccountingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "django.middleware.locale.LocaleMiddleware",
@@ -220,11 +225,20 @@ MEDIA_ROOT = BASE_DIR / "media"
 # ==========================
 # Gmail SMTP Email Settings
 # ==========================
-EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
-EMAIL_HOST = "smtp.gmail.com"
-EMAIL_PORT = 587
-EMAIL_USE_TLS = True
+# Mail is queued in the outbox and delivered by Celery (see financeapp.mail);
+# render.yaml runs the worker pools and beat next to the web service
+EMAIL_BACKEND = "financeapp.mail.OutboxBackend"
+OUTBOX_DELIVERY_BACKEND = os.getenv("OUTBOX_DELIVERY_BACKEND", "django.core.mail.backends.smtp.EmailBackend")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 6))
+OUTBOX_RETRY_BACKOFF = int(os.getenv("OUTBOX_RETRY_BACKOFF", 30))
+OUTBOX_RETRY_BACKOFF_MAX = int(os.getenv("OUTBOX_RETRY_BACKOFF_MAX", 60 * 60))
+OUTBOX_CLAIM_TIMEOUT = int(os.getenv("OUTBOX_CLAIM_TIMEOUT", 5 * 60))
+EMAIL_HOST = os.getenv("EMAIL_HOST", "smtp.gmail.com")
+EMAIL_PORT = int(os.getenv("EMAIL_PORT", 587))
+EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", "True").lower() == "true"
 EMAIL_USE_SSL = False  # Gmail works best with TLS
+EMAIL_TIMEOUT = int(os.getenv("EMAIL_TIMEOUT", 10))
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")  # your Gmail address
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")  # your App Password
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
@@ -234,6 +248,17 @@ GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 GOOGLE_REDIRECT_URI = os.getenv("GOOGLE_REDIRECT_URI")
 GOOGLE_OAUTH2_SCOPE = os.getenv("GOOGLE_OAUTH2_SCOPE")
+GOOGLE_DISCOVERY_URL = os.getenv(
+    "GOOGLE_DISCOVERY_URL", "https://accounts.google.com/.well-known/openid-configuration"
+)
+# Outbound calls to Google (see financeapp.oauth)
+OAUTH_CONNECT_TIMEOUT = float(os.getenv("OAUTH_CONNECT_TIMEOUT", 3))
+OAUTH_READ_TIMEOUT = float(os.getenv("OAUTH_READ_TIMEOUT", 5))
+OAUTH_RETRIES = int(os.getenv("OAUTH_RETRIES", 2))
+OAUTH_BACKOFF = float(os.getenv("OAUTH_BACKOFF", 0.3))
+OAUTH_POOL_SIZE = int(os.getenv("OAUTH_POOL_SIZE", 10))
+# Fallback lifetime of cached discovery/certificate data without max-age
+OAUTH_CACHE_TIMEOUT = int(os.getenv("OAUTH_CACHE_TIMEOUT", 24 * 60 * 60))
 # ==========================
 # Fix SSL Cert Errors (Windows/Python)
 # ==========================
@@ -272,11 +297,42 @@ TWO_FACTOR_WEBAUTHN_ORIGIN = os.environ.get("TWO_FACTOR_WEBAUTHN_ORIGIN", None)
 # ==========================
 # Cache / Redis / Celery
 # ==========================
-CACHES = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+# "default" is a two-tier cache: a bounded in-process LRU (L1) in front of
+# the "shared" alias (L2, Redis when REDIS_URL is set). Without Redis the
+# L1 works on its own, with writes broadcast to the other local workers.
+CACHES = {
+    "default": {
+        "BACKEND": "financeapp.cache_backends.TwoTierCache",
+        "OPTIONS": {
+            "SHARED_ALIAS": "shared",
+            "L1_MAX_ENTRIES": int(os.environ.get("CACHE_L1_MAX_ENTRIES", 5000)),
+            "L1_TIMEOUT": int(os.environ.get("CACHE_L1_TIMEOUT", 30)),
+        },
+    },
+    "sessions": {
+        "BACKEND": "financeapp.cache_backends.TwoTierCache",
+        "LOCATION": "sessions",
+        "OPTIONS": {"SHARED_ALIAS": "shared", "L1_MAX_ENTRIES": 10000, "L1_TIMEOUT": 10},
+    },
+    # LLM replies to repeated non-personal prompts (see financeapp.chat_cache)
+    "chat": {
+        "BACKEND": "financeapp.cache_backends.TwoTierCache",
+        "LOCATION": "chat",
+        "TIMEOUT": int(os.environ.get("CHAT_CACHE_TIMEOUT", 6 * 60 * 60)),
+        "OPTIONS": {"SHARED_ALIAS": "shared", "L1_MAX_ENTRIES": 2000, "L1_TIMEOUT": 300},
+    },
+    # L2 for the aliases above; must be shared by all processes. Without Redis it is a
+    # database table (created by "manage.py createcachetable")
+    "shared": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "financeapp_cache",
+        "KEY_PREFIX": "financeapp",
+    },
+}
 REDIS_URL = os.environ.get("REDIS_URL")
 if REDIS_URL:
     use_ssl = "redns.redis-cloud.com" in REDIS_URL
-    CACHES["default"] = {
+    CACHES["shared"] = {
         "BACKEND": "django_redis.cache.RedisCache",
         "LOCATION": REDIS_URL,
         "OPTIONS": {
@@ -291,18 +347,111 @@ if REDIS_URL:
         },
         "KEY_PREFIX": "financeapp",
     }
-    CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "memory://")
+    # A memory:// broker can't be consumed by a worker process, so mail and
+    # other tasks would never run
+    CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", REDIS_URL)
     CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "cache+memory://")
 else:
-    CELERY_BROKER_URL = "memory://"
+    # Without Redis, queue tasks in the database (see financeapp.broker)
+    CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "djangodb://")
+    CELERY_BROKER_TRANSPORT_OPTIONS = {
+        "visibility_timeout": int(os.environ.get("CELERY_VISIBILITY_TIMEOUT", 60 * 60)),
+        "polling_interval": float(os.environ.get("CELERY_POLLING_INTERVAL", 1)),
+    }
     CELERY_RESULT_BACKEND = "cache+memory://"
 
-SESSION_ENGINE = "django.contrib.sessions.backends.cache"
-SESSION_CACHE_ALIAS = "default"
+# Queues, routing and worker pools (see financeapp.queues)
+CELERY_TASK_DEFAULT_QUEUE = "celery"
+CELERY_TASK_QUEUES = [
+    Queue(name)
+    for name in ("celery", "mail", "maintenance", "analytics.business", "analytics.premium", "analytics.standard")
+]
+CELERY_TASK_ROUTES = ("financeapp.queues.route_task",)
+CELERY_TASK_ANNOTATIONS = ("financeapp.queues.PoolRateLimits",)
+TASK_TIER_CACHE_TIMEOUT = 5 * 60
+# Pool name -> queues consumed (in turn), processes, and per-process task rate limit.
+# Business work is served by three analytics pools, premium by two, standard by one.
+WORKER_POOLS = {
+    "default": {"queues": ["celery", "maintenance"], "concurrency": int(os.environ.get("DEFAULT_WORKERS", 2))},
+    "mail": {"queues": ["mail"], "concurrency": 1, "rate_limit": os.environ.get("MAIL_RATE_LIMIT", "120/m")},
+    "analytics": {
+        "queues": ["analytics.business", "analytics.premium", "analytics.standard"],
+        "concurrency": int(os.environ.get("ANALYTICS_WORKERS", 2)),
+        "rate_limit": os.environ.get("ANALYTICS_RATE_LIMIT", "30/m"),
+    },
+    "analytics-premium": {
+        "queues": ["analytics.business", "analytics.premium"],
+        "concurrency": int(os.environ.get("ANALYTICS_PREMIUM_WORKERS", 1)),
+    },
+    "analytics-business": {
+        "queues": ["analytics.business"],
+        "concurrency": int(os.environ.get("ANALYTICS_BUSINESS_WORKERS", 1)),
+    },
+}
+
+# Chunked per-user jobs (see financeapp.jobs)
+FANOUT_CHUNK_SIZE = int(os.environ.get("FANOUT_CHUNK_SIZE", 500))
+FANOUT_CHUNK_TIMEOUT = int(os.environ.get("FANOUT_CHUNK_TIMEOUT", 30 * 60))
+# Postpone a chunk while a "SELECT 1" takes longer than this, or MySQL has more running threads
+FANOUT_MAX_PROBE_MS = float(os.environ.get("FANOUT_MAX_PROBE_MS", 50))
+FANOUT_MAX_THREADS_RUNNING = int(os.environ.get("FANOUT_MAX_THREADS_RUNNING", 20))
+FANOUT_THROTTLE_DELAY = int(os.environ.get("FANOUT_THROTTLE_DELAY", 10))
+# Postponements before a chunk runs regardless of load
+FANOUT_MAX_THROTTLE_RETRIES = int(os.environ.get("FANOUT_MAX_THROTTLE_RETRIES", 30))
+
+# Accounts per query when writing month-end balance checkpoints (see financeapp.ledger)
+BALANCE_CHECKPOINT_BATCH_SIZE = int(os.environ.get("BALANCE_CHECKPOINT_BATCH_SIZE", 2000))
+# Rows per batch when balance_after is recomputed without window functions
+RUNNING_BALANCE_BATCH_SIZE = int(os.environ.get("RUNNING_BALANCE_BATCH_SIZE", 1000))
+# Slots given to a hot account by the admin action, and how often they are folded into its balance
+BALANCE_SHARDS = int(os.environ.get("BALANCE_SHARDS", 16))
+BALANCE_COMPACT_INTERVAL = int(os.environ.get("BALANCE_COMPACT_INTERVAL", 60))
+
+# Write endpoints honour an Idempotency-Key header (see financeapp.idempotency): the first
+# response is replayed for this long, duplicates of a running first request are told to retry
+# after this many seconds, and a claim older than the lock timeout is considered abandoned
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 24 * 60 * 60))
+IDEMPOTENCY_RETRY_AFTER = int(os.environ.get("IDEMPOTENCY_RETRY_AFTER", 1))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.environ.get("IDEMPOTENCY_LOCK_TIMEOUT", 60))
+
+CELERY_BEAT_SCHEDULE = {
+    "slow-query-report": {
+        "task": "financeapp.task.slow_query_report",
+        "schedule": 60 * 60,
+    },
+    "clear-expired-sessions": {
+        "task": "financeapp.task.clear_expired_sessions",
+        "schedule": 6 * 60 * 60,
+    },
+    "deliver-outbox": {
+        "task": "financeapp.task.deliver_outbox",
+        "schedule": 60,
+    },
+    "write-balance-checkpoints": {
+        "task": "financeapp.task.write_balance_checkpoints",
+        "schedule": 24 * 60 * 60,
+    },
+    "compact-balance-shards": {
+        "task": "financeapp.task.compact_balance_shards",
+        "schedule": BALANCE_COMPACT_INTERVAL,
+    },
+    "clear-expired-idempotency-records": {
+        "task": "financeapp.task.clear_expired_idempotency_records",
+        "schedule": 6 * 60 * 60,
+    },
+}
+
+# Sessions are stored in the database and read through the "sessions" cache
+SESSION_ENGINE = "financeapp.sessions"
+SESSION_CACHE_ALIAS = "sessions"
+# Rewrite an unchanged session only when its expiry is at least this stale
+SESSION_EXPIRY_REFRESH_SECONDS = int(os.environ.get("SESSION_EXPIRY_REFRESH_SECONDS", 60 * 60))
+SESSION_CLEAR_BATCH_SIZE = 1000
+# How long resolved users / OTP devices stay in the session cache
+AUTH_CACHE_TIMEOUT = int(os.environ.get("AUTH_CACHE_TIMEOUT", 5 * 60))
 
 if "migrate" in sys.argv or "makemigrations" in sys.argv:
     CACHES["default"] = {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}
-    SESSION_ENGINE = "django.contrib.sessions.backends.db"
 
 if "test" in sys.argv:
     DATABASES["default"] = {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
@@ -311,7 +460,6 @@ if "test" in sys.argv:
         "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
         "LOCATION": "test-cache",
     }
-    SESSION_ENGINE = "django.contrib.sessions.backends.db"
     CELERY_BROKER_URL = "memory://"
     CELERY_RESULT_BACKEND = "cache+memory://"
 
@@ -346,6 +494,11 @@ LOGGING = {
             "format": "{levelname} {asctime} {module} {process:d} {thread:d} {message}",
             "style": "{",
         },
+        "json": {
+            "()": "pythonjsonlogger.json.JsonFormatter",
+            "fmt": "{asctime} {levelname} {message}",
+            "style": "{",
+        },
     },
     "handlers": {
         "console": {
@@ -353,10 +506,87 @@ LOGGING = {
             "class": "logging.StreamHandler",
             "formatter": "simple" if DEBUG else "verbose",
         },
+        "slow_queries": {
+            "level": "WARNING",
+            "class": "logging.handlers.RotatingFileHandler",
+            "filename": LOG_DIR / "slow_queries.log",
+            "maxBytes": 10 * 1024 * 1024,
+            "backupCount": 3,
+            "delay": True,
+            "formatter": "json",
+        },
+    },
+    "loggers": {
+        "financeapp.slow_queries": {
+            "handlers": ["slow_queries"],
+            "level": "WARNING",
+            "propagate": False,
+        },
     },
     "root": {"handlers": ["console"], "level": "INFO" if DEBUG else "WARNING"},
 }
 
+# Queries slower than the threshold are logged as JSON lines to
+# LOG_DIR/slow_queries.log; the plan is captured once per fingerprint.
+SLOW_QUERY_LOG_ENABLED = os.environ.get("SLOW_QUERY_LOG", "True").lower() == "true"
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS", "200"))
+SLOW_QUERY_EXPLAIN = os.environ.get("SLOW_QUERY_EXPLAIN", "True").lower() == "true"
+
+# ==========================
+# Metrics (/metrics)
+# ==========================
+# Each process flushes its metrics here; the endpoint merges all files so
+# one scrape covers every gunicorn/celery worker on the host.
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR", os.path.join(tempfile.gettempdir(), "wealthywise-metrics")
+)
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "2"))
+# Bearer token for scrapers. Without it /metrics is staff-only (open in DEBUG).
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# ==========================
+# Per-user cost accounting (admin: User Profiles > usage)
+# ==========================
+COST_BUCKET_SECONDS = 3600
+COST_WINDOW_BUCKETS = 24  # rolling 24h totals
+COST_FLUSH_INTERVAL = 5.0
+
+# ==========================
+# Memory profiling (manage.py memprofile)
+# ==========================
+MEMPROFILE_SIZES = [1000, 5000, 20000]
+# A run may use up to this factor more than linear growth from the smallest size
+MEMPROFILE_TOLERANCE = float(os.environ.get("MEMPROFILE_TOLERANCE", "1.5"))
+# Baselines below this are treated as this, so tiny fixed costs don't dominate
+MEMPROFILE_MIN_BASELINE_BYTES = 256 * 1024
+
+# ==========================
+# LLM chat proxy
+# ==========================
+LLM_CHAT_URL = os.environ.get("LLM_CHAT_URL", "http://localhost:11434/api/chat")
+LLM_MODEL = os.environ.get("LLM_MODEL", "llama3")
+# Overall deadline for one chat exchange, in seconds
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 10))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 2))
+# Upper bound for a whole streamed (SSE) reply
+LLM_STREAM_TIMEOUT = float(os.environ.get("LLM_STREAM_TIMEOUT", 120))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 100))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 20))
+CHAT_CACHE_ALIAS = "chat"
+CHAT_CACHE_TIMEOUT = CACHES["chat"]["TIMEOUT"]
+# Admission control shared by all workers on the host (see financeapp.admission)
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 2))
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", 16))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", 30))
+LLM_ADMISSION_DIR = os.environ.get(
+    "LLM_ADMISSION_DIR", os.path.join(tempfile.gettempdir(), "wealthywise-llm-slots")
+)
+# Per-user financial context for personal prompts (see financeapp.chat_context)
+CHAT_CONTEXT_MONTHS = int(os.environ.get("CHAT_CONTEXT_MONTHS", 3))
+CHAT_CONTEXT_TIMEOUT = int(os.environ.get("CHAT_CONTEXT_TIMEOUT", 24 * 60 * 60))
+CHAT_INDEX_MAX_ROWS = int(os.environ.get("CHAT_INDEX_MAX_ROWS", 5000))
+CHAT_CONTEXT_MAX_ROWS = int(os.environ.get("CHAT_CONTEXT_MAX_ROWS", 8))
+
 # ==========================
 # Messages
 # ==========================
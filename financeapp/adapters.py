@@ -1,6 +1,6 @@
 # users/adapters.py
 from allauth.account.adapter import DefaultAccountAdapter
-from django_otp import user_has_device
+from .auth_cache import user_has_device
 from django.shortcuts import redirect
 
 class CustomAccountAdapter(DefaultAccountAdapter):
@@ -4,12 +4,15 @@ from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from unfold.admin import ModelAdmin as UnfoldModelAdmin
 from django.utils.html import format_html
 from django.urls import path
+from django.template.response import TemplateResponse
 from django.http import JsonResponse
-from django.db.models import Sum, Count, Q
+from django.db.models import Count, Q
 from django.db.models.functions import TruncDay
 from .models import Account, Transaction, UserProfile, UserSetting, AppSettings, ContactMessage,Budget
 from datetime import timedelta
 from django.utils import timezone
+from django.conf import settings
+from . import ledger, queues, usage
 
 
 # Remove the problematic UserProfile inline that's causing the REQUIRED_FIELDS error
@@ -36,6 +39,46 @@ class UserProfileAdmin(UnfoldModelAdmin):
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('user')
 
+    def get_urls(self):
+        urls = [
+            path('usage/', self.admin_site.admin_view(self.usage_view), name='financeapp_userprofile_usage'),
+            path('queues/', self.admin_site.admin_view(self.queues_view), name='financeapp_userprofile_queues'),
+        ]
+        return urls + super().get_urls()
+
+    def usage_view(self, request):
+        """Top consumers of DB and CPU time over the rolling window"""
+        order_by = request.GET.get('o', 'db_seconds')
+        if order_by not in ('requests', 'queries', 'db_seconds', 'cpu_seconds'):
+            order_by = 'db_seconds'
+        rows = usage.top_consumers(limit=50, order_by=order_by)
+
+        if request.GET.get('resolve') and request.user.is_superuser:
+            users = usage.resolve_hashes(row['user_hash'] for row in rows)
+            for row in rows:
+                row['user'] = users.get(row['user_hash'])
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Per-user resource usage',
+            'opts': self.model._meta,
+            'rows': rows,
+            'order_by': order_by,
+            'window_hours': settings.COST_BUCKET_SECONDS * settings.COST_WINDOW_BUCKETS / 3600,
+        }
+        return TemplateResponse(request, 'admin/financeapp/usage.html', context)
+
+    def queues_view(self, request):
+        """Celery queue depth and wait times, with the pools serving each queue"""
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Background task queues',
+            'opts': self.model._meta,
+            'rows': queues.overview(),
+            'pools': settings.WORKER_POOLS,
+        }
+        return TemplateResponse(request, 'admin/financeapp/queues.html', context)
+
     @admin.action(description='Verify selected emails')
     def verify_emails(self, request, queryset):
         updated = queryset.update(email_verified=True)
@@ -129,7 +172,9 @@ class AccountAdmin(UnfoldModelAdmin):
     search_fields = ('name', 'account_number', 'user__username', 'user__email')
     readonly_fields = ('account_number', 'last_updated', 'created_at', 'last_transaction_date')
     list_editable = ('is_active',)
-    actions = ['deactivate_accounts', 'activate_accounts', 'recalculate_balances']
+    actions = [
+        'deactivate_accounts', 'activate_accounts', 'recalculate_balances', 'shard_balances', 'unshard_balances'
+    ]
     date_hierarchy = 'last_updated'
 
     def get_formatted_balance(self, obj):
@@ -163,31 +208,24 @@ class AccountAdmin(UnfoldModelAdmin):
         updated = queryset.update(is_active=True)
         self.message_user(request, f'{updated} accounts activated.')
 
-    @admin.action(description='Recalculate balances from transactions')
-    def recalculate_balances(self, request, queryset):
-        for account in queryset:
-            # Calculate balance from all transactions
-            income = account.transactions.filter(
-                transaction_type='income'
-            ).aggregate(total=Sum('amount'))['total'] or 0
-
-            expenses = account.transactions.filter(
-                transaction_type='expense'
-            ).aggregate(total=Sum('amount'))['total'] or 0
-
-            # For transfers, we need special handling
-            outgoing_transfers = account.transactions.filter(
-                transaction_type='transfer'
-            ).aggregate(total=Sum('amount'))['total'] or 0
-
-            incoming_transfers = Transaction.objects.filter(
-                transaction_type='transfer', to_account=account
-            ).aggregate(total=Sum('amount'))['total'] or 0
+    @admin.action(description='Take credits through balance shards (hot accounts)')
+    def shard_balances(self, request, queryset):
+        ledger.set_balance_shards(queryset, settings.BALANCE_SHARDS)
+        self.message_user(
+            request, f'{queryset.count()} accounts now take credits through {settings.BALANCE_SHARDS} shards.'
+        )
 
-            account.balance = income - expenses - outgoing_transfers + incoming_transfers
-            account.save()
+    @admin.action(description='Stop using balance shards')
+    def unshard_balances(self, request, queryset):
+        ledger.set_balance_shards(queryset, 0)
+        self.message_user(request, f'{queryset.count()} accounts now update their balance directly.')
 
-        self.message_user(request, f'Recalculated balances for {queryset.count()} accounts.')
+    @admin.action(description='Recalculate balances from transactions')
+    def recalculate_balances(self, request, queryset):
+        drifted = ledger.recalculate(queryset)
+        self.message_user(
+            request, f'Recalculated balances for {queryset.count()} accounts; {len(drifted)} corrected.'
+        )
 
 
 class AmountRangeFilter(UnfoldModelAdmin):
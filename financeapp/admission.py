@@ -0,0 +1,277 @@
+# financeapp/admission.py
+"""
+Admission control for the local LLM.
+
+The model server can only run a few generations at once, so every worker
+process on the host shares a fixed set of slot files and a bounded set of
+queue ticket files under ``LLM_ADMISSION_DIR``. Holding an exclusive lock
+on a slot file means "generating"; holding a ticket means "waiting". Locks
+disappear with the process that held them, so a crashed worker can never
+leak capacity.
+
+The locks are open file description locks (``F_OFD_SETLK``): like
+``flock`` they belong to the open file rather than the process, so two
+requests in one worker still exclude each other, but they can also be
+tested with ``F_OFD_GETLK``. Counting holders for queue positions, the
+``Retry-After`` estimate and the gauges therefore never takes a lock that
+a request could be refused over. Platforms without them fall back to
+``flock``.
+
+A request first tries for a free slot, then for a ticket. With neither
+available it is rejected straight away with a ``Retry-After`` estimate.
+Queued requests poll for a slot, roughly in arrival order, until
+``LLM_QUEUE_TIMEOUT`` runs out. The async entry points (``abegin``,
+``positions``, ``arelease``) do their file locking in a worker thread so a
+slow filesystem never stalls the event loop.
+"""
+import asyncio
+import fcntl
+import math
+import os
+import random
+import struct
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+
+class Overloaded(Exception):
+    """No slot and no queue ticket available"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"LLM is at capacity; retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Overloaded):
+    """Waited ``LLM_QUEUE_TIMEOUT`` seconds in the queue without getting a slot"""
+
+
+# struct flock: l_type, l_whence, l_start, l_len (0 = whole file), l_pid
+_FLOCK = "hhqqi"
+_OFD_LOCKS = hasattr(fcntl, "F_OFD_SETLK")
+
+
+def _lock_request(fd, command, lock_type):
+    return fcntl.fcntl(fd, command, struct.pack(_FLOCK, lock_type, os.SEEK_SET, 0, 0, 0))
+
+
+def _try_lock(path, payload=b""):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if _OFD_LOCKS:
+            _lock_request(fd, fcntl.F_OFD_SETLK, fcntl.F_WRLCK)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (BlockingIOError, PermissionError):
+        os.close(fd)
+        return None
+    if payload:
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, payload, 0)
+    return fd
+
+
+def _unlock(fd, clear=False):
+    if clear:
+        os.ftruncate(fd, 0)
+    if _OFD_LOCKS:
+        _lock_request(fd, fcntl.F_OFD_SETLK, fcntl.F_UNLCK)
+    else:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def _is_locked(path):
+    """Whether someone holds ``path``, without taking its lock"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        if _OFD_LOCKS:
+            result = _lock_request(fd, fcntl.F_OFD_GETLK, fcntl.F_WRLCK)
+            return struct.unpack(_FLOCK, result[: struct.calcsize(_FLOCK)])[0] != fcntl.F_UNLCK
+        # flock has no test; a brief shared lock is the closest (development only)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return False
+    finally:
+        os.close(fd)
+
+
+class Admission:
+    """One request's hold on the limiter: a slot, or a queue ticket waiting for one"""
+
+    def __init__(self, limiter, slot=None, ticket=None):
+        self.limiter = limiter
+        self.slot = slot
+        self.ticket = ticket
+        self.enqueued_at = time.time()
+        self.admitted_at = time.monotonic() if slot is not None else None
+
+    @property
+    def admitted(self):
+        return self.slot is not None
+
+    def _try_admit(self):
+        """Swap the queue ticket for a free slot, if there is one"""
+        self.slot = self.limiter.try_slot()
+        if self.admitted:
+            self.admitted_at = time.monotonic()
+            _unlock(self.ticket, clear=True)
+            self.ticket = None
+            metrics.observe("financeapp_llm_queue_wait_seconds", time.time() - self.enqueued_at)
+
+    async def positions(self, stop=None):
+        """
+        Wait for a slot, yielding the queue position whenever it changes.
+        Returns early if ``stop`` is set; raises ``QueueTimeout`` on expiry.
+        """
+        deadline = time.monotonic() + self.limiter.queue_timeout
+        delay = 0.05
+        last_position = None
+        while not self.admitted:
+            if stop is not None and stop.is_set():
+                return
+            position = await asyncio.to_thread(self.limiter.position, self)
+            if position != last_position:
+                last_position = position
+                yield position
+            if position <= self.limiter.max_concurrency:
+                await asyncio.to_thread(self._try_admit)
+                if self.admitted:
+                    return
+            if time.monotonic() >= deadline:
+                metrics.inc("financeapp_llm_admissions_total", result="timeout")
+                raise QueueTimeout(self.limiter.retry_after())
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, 0.25)
+
+    async def wait(self, stop=None):
+        async for _ in self.positions(stop):
+            pass
+
+    def release(self):
+        if self.slot is not None:
+            self.limiter.record_service_time(time.monotonic() - self.admitted_at)
+            _unlock(self.slot)
+            self.slot = None
+        if self.ticket is not None:
+            _unlock(self.ticket, clear=True)
+            self.ticket = None
+
+    async def arelease(self):
+        await asyncio.to_thread(self.release)
+
+
+class Limiter:
+    def __init__(self, directory, max_concurrency, max_queue, queue_timeout):
+        self.directory = directory
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # Moving average of generation time, for Retry-After estimates
+        self.mean_service_time = settings.LLM_TIMEOUT / 2
+        os.makedirs(directory, exist_ok=True)
+
+    def _slot_paths(self):
+        return [os.path.join(self.directory, f"slot-{i}") for i in range(self.max_concurrency)]
+
+    def _ticket_paths(self):
+        return [os.path.join(self.directory, f"queue-{i}") for i in range(self.max_queue)]
+
+    def _first_free(self, paths, payload=b""):
+        # Start at a random offset so workers don't all fight over the first file
+        offset = random.randrange(len(paths)) if paths else 0
+        for path in paths[offset:] + paths[:offset]:
+            fd = _try_lock(path, payload)
+            if fd is not None:
+                return fd
+        return None
+
+    def try_slot(self):
+        return self._first_free(self._slot_paths())
+
+    def begin(self):
+        """Take a slot or a queue ticket, or raise ``Overloaded``"""
+        slot = self.try_slot()
+        if slot is not None:
+            metrics.inc("financeapp_llm_admissions_total", result="admitted")
+            return Admission(self, slot=slot)
+        admission = Admission(self)
+        admission.ticket = self._first_free(self._ticket_paths(), repr(admission.enqueued_at).encode())
+        if admission.ticket is None:
+            metrics.inc("financeapp_llm_admissions_total", result="rejected")
+            raise Overloaded(self.retry_after())
+        metrics.inc("financeapp_llm_admissions_total", result="queued")
+        return admission
+
+    async def abegin(self):
+        return await asyncio.to_thread(self.begin)
+
+    def _held(self, paths):
+        """Contents of the files in ``paths`` that someone holds locked"""
+        held = []
+        for path in paths:
+            # A free file may still hold a dead process's ticket; it's ignored here
+            # and overwritten by the next holder
+            if not _is_locked(path):
+                continue
+            try:
+                with open(path, "rb") as f:
+                    held.append(f.read())
+            except OSError:
+                held.append(b"")
+        return held
+
+    def position(self, admission):
+        """1-based position among waiting requests, by enqueue time"""
+        earlier = 0
+        for content in self._held(self._ticket_paths()):
+            try:
+                enqueued_at = float(content)
+            except ValueError:
+                continue
+            if enqueued_at < admission.enqueued_at:
+                earlier += 1
+        return earlier + 1
+
+    def record_service_time(self, seconds):
+        self.mean_service_time += 0.2 * (seconds - self.mean_service_time)
+
+    def retry_after(self):
+        queued = len(self._held(self._ticket_paths()))
+        rounds = queued / self.max_concurrency + 1
+        return max(1, math.ceil(self.mean_service_time * rounds))
+
+    def gauges(self):
+        """Host-wide utilization, for ``metrics.render(extra_gauges=...)``"""
+        in_flight = len(self._held(self._slot_paths()))
+        queued = len(self._held(self._ticket_paths()))
+        return {
+            ("financeapp_llm_in_flight", ()): in_flight,
+            ("financeapp_llm_queued", ()): queued,
+            ("financeapp_llm_capacity", ()): self.max_concurrency,
+            ("financeapp_llm_utilization", ()): in_flight / self.max_concurrency,
+        }
+
+
+_limiter = None
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = Limiter(
+            settings.LLM_ADMISSION_DIR,
+            settings.LLM_MAX_CONCURRENCY,
+            settings.LLM_MAX_QUEUE,
+            settings.LLM_QUEUE_TIMEOUT,
+        )
+    return _limiter
@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
 
 
 class FinanceappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'financeapp'
+
+    def ready(self):
+        from . import auth_cache, chat_context, ledger, metrics, middleware, queues, slow_queries  # noqa: F401
+        # Celery autodiscovery only looks for "tasks" modules
+        from . import task  # noqa: F401
+
+        metrics.connect_celery_signals()
+        queues.connect_celery_signals()
+        connection_created.connect(middleware.install_query_counter, dispatch_uid="financeapp.query_counter")
+        if settings.SLOW_QUERY_LOG_ENABLED:
+            connection_created.connect(slow_queries.install, dispatch_uid="financeapp.slow_queries")
@@ -0,0 +1,54 @@
+# financeapp/asgi.py
+"""
+ASGI helpers.
+
+Django 4.2 doesn't notice when a client goes away during a streaming
+response. ``DisconnectWatcher`` keeps listening on ``receive`` once the
+request body has been read and sets an ``asyncio.Event`` stored in the
+scope when ``http.disconnect`` arrives. Streaming views poll it with
+``client_disconnected(request)`` and stop producing output. The response then
+finishes normally, so Django still closes it and fires request_finished.
+"""
+import asyncio
+
+SCOPE_KEY = "financeapp.disconnected"
+
+
+class DisconnectWatcher:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        disconnected = scope[SCOPE_KEY] = asyncio.Event()
+        body_read = asyncio.Event()
+
+        async def tracked_receive():
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                body_read.set()
+            elif not message.get("more_body", False):
+                body_read.set()
+            return message
+
+        async def watch():
+            await body_read.wait()
+            if not disconnected.is_set():
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await self.app(scope, tracked_receive, send)
+        finally:
+            watcher.cancel()
+
+
+def client_disconnected(request):
+    """The disconnect event for an ASGI request, or None (e.g. under WSGI)"""
+    scope = getattr(request, "scope", None)
+    return scope.get(SCOPE_KEY) if scope else None
@@ -0,0 +1,183 @@
+# financeapp/auth_cache.py
+"""
+Cached user and OTP-device resolution.
+
+``AuthenticationMiddleware`` loads the user row and ``OTPMiddleware`` loads
+the verified device on every request; the 2FA redirect in the account
+adapter then asks the database whether the user has any device. The drop-in
+middlewares below resolve all three from the session cache instead.
+
+Entries are keyed by a per-user version token, and a cached user is only
+accepted when its session auth hash matches the one stored in the session,
+so a password change logs other sessions out exactly as before. Saving or
+deleting the user or any of their OTP devices replaces the version token,
+which orphans every entry written under the old one. ``QuerySet.update()``
+and ``bulk_update()`` send no signals, so code changing users that way must
+call ``invalidate_user`` itself; otherwise the old user is served for up to
+``AUTH_CACHE_TIMEOUT`` seconds.
+"""
+import functools
+import uuid
+
+import django_otp
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import get_user_model
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+from django_otp import DEVICE_ID_SESSION_KEY
+from django_otp.middleware import OTPMiddleware, is_verified
+from django_otp.models import Device
+
+_NO_DEVICE = "none"
+
+
+def _cache():
+    return caches[settings.SESSION_CACHE_ALIAS]
+
+
+def _version(user_id):
+    """Current version token for a user's entries, creating one if needed"""
+    cache = _cache()
+    key = f"auth:version:{user_id}"
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_user(user_id):
+    _cache().set(f"auth:version:{user_id}", uuid.uuid4().hex, timeout=None)
+
+
+# ----------------- User -----------------
+def resolve_user(request):
+    """``django.contrib.auth.get_user`` backed by the session cache"""
+    session = request.session
+    try:
+        user_id = auth._get_user_session_key(request)
+        backend_path = session[auth.BACKEND_SESSION_KEY]
+        session_hash = session[auth.HASH_SESSION_KEY]
+    except KeyError:
+        return auth.get_user(request)
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return auth.get_user(request)
+
+    cache = _cache()
+    key = f"auth:user:{user_id}:{_version(user_id)}"
+    entry = cache.get(key)
+    if entry is not None and constant_time_compare(entry[0], session_hash):
+        user = entry[1]
+        user.backend = backend_path
+        return user
+
+    user = auth.get_user(request)
+    if user.is_authenticated and user.pk == user_id:
+        cache.set(key, (user.get_session_auth_hash(), user), settings.AUTH_CACHE_TIMEOUT)
+    return user
+
+
+def get_user(request):
+    if not hasattr(request, "_cached_user"):
+        request._cached_user = resolve_user(request)
+    return request._cached_user
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """AuthenticationMiddleware that resolves the user via the cache"""
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_user(request))
+
+    async def __acall__(self, request):
+        # process_request only installs a lazy user, so unlike MiddlewareMixin
+        # there's no need to run it in a thread
+        self.process_request(request)
+        return await self.get_response(request)
+
+
+# ----------------- OTP devices -----------------
+def device_for_user(user, persistent_id, loader):
+    """Cached ``Device.from_persistent_id`` for ``user``; ``loader`` runs on a miss"""
+    cache = _cache()
+    key = f"auth:device:{user.pk}:{_version(user.pk)}:{persistent_id}"
+    device = cache.get(key)
+    if device is None:
+        device = loader()
+        if device is not None and device.user_id != user.pk:
+            device = None
+        cache.set(key, device if device is not None else _NO_DEVICE, settings.AUTH_CACHE_TIMEOUT)
+    return None if device == _NO_DEVICE else device
+
+
+def user_has_device(user, confirmed=True):
+    """Cached ``django_otp.user_has_device`` for confirmed devices"""
+    if user.is_anonymous or confirmed is not True:
+        return django_otp.user_has_device(user, confirmed=confirmed)
+
+    cache = _cache()
+    key = f"auth:has_device:{user.pk}:{_version(user.pk)}"
+    has_device = cache.get(key)
+    if has_device is None:
+        has_device = django_otp.user_has_device(user)
+        cache.set(key, has_device, settings.AUTH_CACHE_TIMEOUT)
+    return has_device
+
+
+class CachedOTPMiddleware(OTPMiddleware):
+    """Drop-in for django_otp's OTPMiddleware that resolves the device via the cache"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        # OTPMiddleware only wraps request.user in a lazy object; nothing blocks
+        return await super().__call__(request)
+
+    def _verify_user(self, request, user):
+        user.otp_device = None
+        user.is_verified = functools.partial(is_verified, user)
+
+        if user.is_authenticated:
+            persistent_id = request.session.get(DEVICE_ID_SESSION_KEY)
+            device = (
+                device_for_user(user, persistent_id, lambda: self._device_from_persistent_id(persistent_id))
+                if persistent_id
+                else None
+            )
+            if (device is None) and (DEVICE_ID_SESSION_KEY in request.session):
+                del request.session[DEVICE_ID_SESSION_KEY]
+            user.otp_device = device
+
+        return user
+
+
+# ----------------- Invalidation -----------------
+@receiver(post_save, sender=get_user_model(), dispatch_uid="financeapp.auth_cache.user_saved")
+@receiver(post_delete, sender=get_user_model(), dispatch_uid="financeapp.auth_cache.user_deleted")
+def _user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+@receiver(post_save, dispatch_uid="financeapp.auth_cache.device_saved")
+@receiver(post_delete, dispatch_uid="financeapp.auth_cache.device_deleted")
+def _device_changed(sender, instance, **kwargs):
+    if isinstance(instance, Device) and instance.user_id:
+        invalidate_user(instance.user_id)
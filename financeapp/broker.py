@@ -0,0 +1,174 @@
+# financeapp/broker.py
+"""
+Kombu transport that keeps Celery messages in the project database.
+
+For deployments without Redis: ``CELERY_BROKER_URL=djangodb://`` (the alias
+is registered in ``finance/celery.py``) stores each message as a
+``BrokerMessage`` row, so queued work survives restarts and can be consumed
+by worker processes other than the one that queued it.
+
+Fetching a message leases it instead of removing it: the row stays in the
+table but is hidden until ``visible_at``, ``visibility_timeout`` seconds
+later (``CELERY_BROKER_TRANSPORT_OPTIONS``). Acknowledging deletes the row;
+rejecting with requeue, or a clean worker shutdown, makes it visible again
+straight away. If a worker dies holding a message, the lease expires and
+another worker gets it, marked as redelivered. Claims are compare-and-set
+on the row's delivery counter, so concurrent workers never receive the
+same lease, on any database backend.
+
+With Celery's default early acknowledgement a task is acked when it starts;
+tasks that must survive a worker crash mid-run need ``acks_late=True``.
+Fanout exchanges are not supported, so worker remote control is disabled.
+"""
+import functools
+from datetime import timedelta
+from json import dumps, loads
+from queue import Empty
+
+import django
+from django.db import InterfaceError, OperationalError, connection
+from django.db.models import F
+from django.utils import timezone
+from kombu.transport import virtual
+
+from .models import BrokerMessage
+
+
+def _reconnecting(method):
+    """
+    Retry once on a fresh connection if the database dropped the old one.
+    Not inside a transaction: closing the connection would silently discard
+    the caller's earlier writes, so the error is left to the caller.
+    """
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except (InterfaceError, OperationalError):
+            if connection.in_atomic_block:
+                raise
+            connection.close()
+            return method(*args, **kwargs)
+
+    return wrapper
+
+
+class QoS(virtual.QoS):
+    def ack(self, delivery_tag):
+        self.channel._forget(delivery_tag)
+        super().ack(delivery_tag)
+
+    def reject(self, delivery_tag, requeue=False):
+        if requeue:
+            self.channel._make_visible(delivery_tag)
+        else:
+            self.channel._forget(delivery_tag)
+        self._quick_ack(delivery_tag)
+
+
+class Channel(virtual.Channel):
+    QoS = QoS
+    visibility_timeout = 60 * 60
+    # Attempts at claiming a message that another worker keeps winning
+    claim_attempts = 5
+    from_transport_options = virtual.Channel.from_transport_options + ("visibility_timeout", "claim_attempts")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._noack_queues = set()
+
+    def basic_consume(self, queue, no_ack, *args, **kwargs):
+        if no_ack:
+            self._noack_queues.add(queue)
+        return super().basic_consume(queue, no_ack, *args, **kwargs)
+
+    def basic_cancel(self, consumer_tag):
+        self._noack_queues.discard(self._tag_to_queue.get(consumer_tag))
+        return super().basic_cancel(consumer_tag)
+
+    def basic_get(self, queue, no_ack=False, **kwargs):
+        if not no_ack:
+            return super().basic_get(queue, no_ack=no_ack, **kwargs)
+        self._noack_queues.add(queue)
+        try:
+            return super().basic_get(queue, no_ack=no_ack, **kwargs)
+        finally:
+            self._noack_queues.discard(queue)
+
+    def _new_queue(self, queue, **kwargs):
+        # Queues are just a column value; nothing to create
+        pass
+
+    @_reconnecting
+    def _put(self, queue, message, **kwargs):
+        BrokerMessage.objects.create(
+            queue=queue,
+            payload=dumps(message),
+            delivery_tag=message["properties"]["delivery_tag"],
+        )
+
+    @_reconnecting
+    def _get(self, queue):
+        for _ in range(self.claim_attempts):
+            now = timezone.now()
+            row = (
+                BrokerMessage.objects.filter(queue=queue, visible_at__lte=now)
+                .order_by("id")
+                .only("id", "payload", "deliveries")
+                .first()
+            )
+            if row is None:
+                raise Empty()
+            claimed = BrokerMessage.objects.filter(pk=row.pk, deliveries=row.deliveries)
+            if queue in self._noack_queues:
+                won = claimed.delete()[0]
+            else:
+                won = claimed.update(
+                    visible_at=now + timedelta(seconds=self.visibility_timeout),
+                    deliveries=F("deliveries") + 1,
+                )
+            if won:
+                message = loads(row.payload)
+                if row.deliveries:
+                    message["redelivered"] = True
+                return message
+        raise Empty()
+
+    @_reconnecting
+    def _size(self, queue):
+        return BrokerMessage.objects.filter(queue=queue, visible_at__lte=timezone.now()).count()
+
+    @_reconnecting
+    def _purge(self, queue):
+        return BrokerMessage.objects.filter(queue=queue, visible_at__lte=timezone.now()).delete()[0]
+
+    @_reconnecting
+    def _delete(self, queue, *args, **kwargs):
+        BrokerMessage.objects.filter(queue=queue).delete()
+
+    @_reconnecting
+    def _forget(self, delivery_tag):
+        BrokerMessage.objects.filter(delivery_tag=delivery_tag).delete()
+
+    @_reconnecting
+    def _make_visible(self, delivery_tag):
+        BrokerMessage.objects.filter(delivery_tag=delivery_tag).update(visible_at=timezone.now())
+
+    def _restore(self, message):
+        # Unacked at shutdown: hand the lease back rather than publish a copy
+        self._make_visible(message.delivery_tag)
+
+
+class Transport(virtual.Transport):
+    Channel = Channel
+
+    polling_interval = 1
+    default_port = 0
+    driver_type = "sql"
+    driver_name = "django"
+    connection_errors = virtual.Transport.connection_errors + (InterfaceError, OperationalError)
+    implements = virtual.Transport.implements.extend(exchange_type=frozenset(["direct", "topic"]))
+
+    def driver_version(self):
+        return django.get_version()
@@ -0,0 +1,419 @@
+# financeapp/cache_backends.py
+"""
+Two-tier cache backend.
+
+``TwoTierCache`` keeps a bounded in-process LRU/TTL layer (L1, cachetools)
+in front of another configured cache alias (L2, usually Redis). Hits served
+from L1 cost no network round-trip or decompression. Writes go through to
+L2 and are broadcast to the other worker processes on this host over
+``InvalidationChannel`` so their L1 copies are dropped. ``get_or_set`` lets
+only one caller per key compute a missing value while the others wait.
+
+L2 must be shared by every process: it is what makes ``add``/``incr`` and
+``timeout=None`` entries hold across workers. With a ``DummyCache`` L2 the
+backend still works, but only as a per-process cache whose entries live at
+most ``L1_TIMEOUT`` seconds.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import socket
+import tempfile
+import threading
+import time
+
+from cachetools import TLRUCache
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.dummy import DummyCache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class InvalidationChannel:
+    """
+    Host-local broadcast over Unix datagram sockets. Every process binds
+    ``<directory>/<pid>.sock`` and a daemon thread delivers incoming
+    messages to the handler subscribed under the message's ``channel`` name.
+    Delivery is best effort: a dropped message only means a stale L1 entry
+    until its (short) TTL expires.
+    """
+
+    MAX_KEYS_PER_MESSAGE = 200
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.enabled = hasattr(socket, "AF_UNIX")
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._path = None
+        self._sender = None
+
+    def subscribe(self, name, handler):
+        self._handlers[name] = handler
+        self._ensure_bound()
+
+    def _ensure_bound(self):
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, f"{os.getpid()}.sock")
+                if os.path.exists(path):
+                    os.unlink(path)
+                receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                receiver.bind(path)
+                sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sender.setblocking(False)
+            except OSError as e:
+                logger.warning(f"Cache invalidation channel disabled: {e}")
+                self.enabled = False
+                return
+            self._path, self._sender, self._pid = path, sender, os.getpid()
+            threading.Thread(
+                target=self._listen, args=(receiver,), name="cache-invalidation", daemon=True
+            ).start()
+
+    def _listen(self, receiver):
+        while True:
+            try:
+                data = receiver.recv(65536)
+            except OSError:
+                return
+            try:
+                message = json.loads(data)
+                handler = self._handlers.get(message["channel"])
+                if handler:
+                    handler(message)
+            except Exception as e:
+                logger.warning(f"Bad cache invalidation message: {e}")
+
+    def publish(self, name, op, keys=()):
+        self._ensure_bound()
+        if not self.enabled:
+            return
+        keys = list(keys)
+        chunks = [keys[i : i + self.MAX_KEYS_PER_MESSAGE] for i in range(0, len(keys), self.MAX_KEYS_PER_MESSAGE)]
+        payloads = [json.dumps({"channel": name, "op": op, "keys": chunk}).encode() for chunk in chunks or [[]]]
+
+        try:
+            peers = [n for n in os.listdir(self.directory) if n.endswith(".sock")]
+        except FileNotFoundError:
+            return
+        for peer in peers:
+            path = os.path.join(self.directory, peer)
+            if path == self._path:
+                continue
+            for payload in payloads:
+                try:
+                    self._sender.sendto(payload, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Nobody is bound there any more: the process exited
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                    break
+                except OSError:
+                    # Receiver buffer full; its L1 TTL bounds the staleness
+                    break
+
+
+_channels = {}
+_channels_lock = threading.Lock()
+
+
+def get_channel(directory):
+    with _channels_lock:
+        if directory not in _channels:
+            _channels[directory] = InvalidationChannel(directory)
+        return _channels[directory]
+
+
+class LocalTier:
+    """
+    The in-process half of a ``TwoTierCache``. Django creates a cache
+    instance per thread, so the L1 store, its locks and the invalidation
+    subscription live here and are shared by every thread of the process.
+    """
+
+    def __init__(self, name, max_entries, channel):
+        self.name = name
+        self.max_entries = max_entries
+        self.channel = channel
+        self.lock = threading.RLock()
+        self.fill_locks = [threading.Lock() for _ in range(64)]
+        self._pid = None
+        self._store = None
+
+    @property
+    def store(self):
+        if self._pid != os.getpid():
+            # First use, or a forked child that must not trust the parent's copy
+            with self.lock:
+                if self._pid != os.getpid():
+                    # Entries are (pickled value, monotonic expiry time)
+                    self._store = TLRUCache(self.max_entries, ttu=lambda key, value, now: value[1])
+                    self._pid = os.getpid()
+                    self.channel.subscribe(self.name, self._on_invalidate)
+        return self._store
+
+    def _on_invalidate(self, message):
+        with self.lock:
+            if message["op"] == "clear":
+                self.store.clear()
+            else:
+                for key in message["keys"]:
+                    self.store.pop(key, None)
+
+
+_local_tiers = {}
+
+
+def get_local_tier(name, max_entries, channel):
+    with _channels_lock:
+        if name not in _local_tiers:
+            _local_tiers[name] = LocalTier(name, max_entries, channel)
+        return _local_tiers[name]
+
+
+class TwoTierCache(BaseCache):
+    """
+    OPTIONS:
+        SHARED_ALIAS       L2 cache alias (default "shared")
+        L1_MAX_ENTRIES     bounded size of the in-process layer (default 5000)
+        L1_TIMEOUT         max seconds an entry lives in L1 (default 30)
+        LOCK_TIMEOUT       how long get_or_set waits on another filler (default 10)
+        INVALIDATION_DIR   directory for the host-local invalidation sockets
+
+    LOCATION names the L1 store and its invalidation channel, so give each
+    TwoTierCache alias a distinct one.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.name = location or "default"
+        self.shared_alias = options.get("SHARED_ALIAS", "shared")
+        self.l1_timeout = float(options.get("L1_TIMEOUT", 30))
+        self.lock_timeout = float(options.get("LOCK_TIMEOUT", 10))
+        self.channel = get_channel(
+            options.get("INVALIDATION_DIR", os.path.join(tempfile.gettempdir(), "wealthywise-cache-bus"))
+        )
+        self.local = get_local_tier(self.name, int(options.get("L1_MAX_ENTRIES", 5000)), self.channel)
+        self._lock = self.local.lock
+        self._fill_locks = self.local.fill_locks
+        self._l2 = None
+
+    # ----------------- Plumbing -----------------
+    @property
+    def l2(self):
+        if self._l2 is None:
+            self._l2 = caches[self.shared_alias]
+        return self._l2
+
+    @property
+    def local_only(self):
+        """Without a real shared backend, L1 alone provides add/incr semantics"""
+        return isinstance(self.l2, DummyCache)
+
+    @property
+    def l1(self):
+        return self.local.store
+
+    def _l1_ttl(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        if timeout is None:
+            return self.l1_timeout
+        return max(0.0, min(self.l1_timeout, timeout - time.time()))
+
+    def _l1_get(self, key):
+        with self._lock:
+            entry = self.l1.get(key)
+        if entry is None:
+            return _MISSING
+        return pickle.loads(entry[0])
+
+    def _l1_set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        ttl = self._l1_ttl(timeout)
+        with self._lock:
+            if ttl <= 0:
+                self.l1.pop(key, None)
+            else:
+                self.l1[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.monotonic() + ttl)
+
+    def _invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self.l1.pop(key, None)
+        self.channel.publish(self.name, "delete", keys)
+
+    def _namespace(self, key):
+        # Metrics are labelled by a key's "name:" prefix; keys without one (session ids and the
+        # like) are counted under the alias, so the label set stays bounded
+        prefix, colon, _ = str(key).partition(":")
+        return prefix if colon and prefix.isidentifier() else self.name
+
+    # ----------------- Cache API -----------------
+    def get(self, key, default=None, version=None):
+        internal = self.make_and_validate_key(key, version=version)
+        value = self._l1_get(internal)
+        if value is not _MISSING:
+            metrics.record_cache_lookup(self._namespace(key), True, tier="l1")
+            return value
+        metrics.record_cache_lookup(self._namespace(key), False, tier="l1")
+
+        value = self.l2.get(key, _MISSING, version=version)
+        metrics.record_cache_lookup(self._namespace(key), value is not _MISSING, tier="l2")
+        if value is _MISSING:
+            return default
+        self._l1_set(internal, value)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        internal = self.make_and_validate_key(key, version=version)
+        self.l2.set(key, value, timeout=timeout, version=version)
+        self._invalidate(internal)
+        self._l1_set(internal, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        internal = self.make_and_validate_key(key, version=version)
+        with self._lock:
+            if self._l1_get(internal) is not _MISSING:
+                return False
+            if not self.l2.add(key, value, timeout=timeout, version=version):
+                return False
+            self._l1_set(internal, value, timeout)
+        self.channel.publish(self.name, "delete", [internal])
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        internal = self.make_and_validate_key(key, version=version)
+        if self.local_only:
+            value = self._l1_get(internal)
+            if value is _MISSING:
+                return False
+            self._l1_set(internal, value, timeout)
+            return True
+        return self.l2.touch(key, timeout=timeout, version=version)
+
+    def delete(self, key, version=None):
+        internal = self.make_and_validate_key(key, version=version)
+        with self._lock:
+            existed = internal in self.l1
+        deleted = self.l2.delete(key, version=version)
+        self._invalidate(internal)
+        return deleted or existed
+
+    def has_key(self, key, version=None):
+        internal = self.make_and_validate_key(key, version=version)
+        if self._l1_get(internal) is not _MISSING:
+            return True
+        return self.l2.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        internal = self.make_and_validate_key(key, version=version)
+        if self.local_only:
+            with self._lock:
+                value = self._l1_get(internal)
+                if value is _MISSING:
+                    raise ValueError("Key '%s' not found" % key)
+                new_value = value + delta
+                # Keep the existing expiry
+                self.l1[internal] = (pickle.dumps(new_value, pickle.HIGHEST_PROTOCOL), self.l1[internal][1])
+            self.channel.publish(self.name, "delete", [internal])
+            return new_value
+        new_value = self.l2.incr(key, delta, version=version)
+        self._invalidate(internal)
+        return new_value
+
+    def get_many(self, keys, version=None):
+        found, missing = {}, []
+        for key in keys:
+            value = self._l1_get(self.make_and_validate_key(key, version=version))
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            fetched = self.l2.get_many(missing, version=version)
+            for key, value in fetched.items():
+                self._l1_set(self.make_and_validate_key(key, version=version), value)
+            found.update(fetched)
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.l2.set_many(data, timeout=timeout, version=version)
+        internal_keys = [self.make_and_validate_key(key, version=version) for key in data]
+        self._invalidate(*internal_keys)
+        for key, value in data.items():
+            if key not in failed:
+                self._l1_set(self.make_and_validate_key(key, version=version), value, timeout)
+        return failed
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self.l2.delete_many(keys, version=version)
+        self._invalidate(*(self.make_and_validate_key(key, version=version) for key in keys))
+
+    def clear(self):
+        self.l2.clear()
+        with self._lock:
+            self.l1.clear()
+        self.channel.publish(self.name, "clear")
+
+    def close(self, **kwargs):
+        self.l2.close(**kwargs)
+
+    # ----------------- Stampede protection -----------------
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Like BaseCache.get_or_set, but concurrent misses for the same key are
+        coalesced: one caller computes ``default`` while the others (threads
+        in this process, or other processes via an L2 lock key) wait for it.
+        """
+        value = self.get(key, _MISSING, version=version)
+        if value is not _MISSING:
+            return value
+
+        digest = hashlib.md5(self.make_key(key, version=version).encode()).digest()
+        with self._fill_locks[digest[0] % len(self._fill_locks)]:
+            value = self.get(key, _MISSING, version=version)
+            if value is not _MISSING:
+                return value
+
+            lock_key = f"{key}:fill-lock"
+            if not self.local_only and not self.l2.add(lock_key, os.getpid(), timeout=self.lock_timeout, version=version):
+                value = self._wait_for_fill(key, version)
+                if value is not _MISSING:
+                    return value
+            try:
+                value = default() if callable(default) else default
+                if value is not None:
+                    self.set(key, value, timeout=timeout, version=version)
+            finally:
+                if not self.local_only:
+                    self.l2.delete(lock_key, version=version)
+            return value
+
+    def _wait_for_fill(self, key, version):
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.01
+        while time.monotonic() < deadline:
+            time.sleep(delay)
+            value = self.l2.get(key, _MISSING, version=version)
+            if value is not _MISSING:
+                self._l1_set(self.make_and_validate_key(key, version=version), value)
+                return value
+            delay = min(delay * 2, 0.2)
+        return _MISSING
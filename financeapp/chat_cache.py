@@ -0,0 +1,93 @@
+# financeapp/chat_cache.py
+"""
+Shared cache of LLM replies for repeated, non-personal prompts.
+
+Prompts are normalized (Unicode NFKC, case-folded, whitespace collapsed,
+trailing punctuation dropped) and keyed together with the model name, so
+"How do I add a budget?" and "how do i add a budget" share one entry.
+Entries live in the "chat" cache alias (TwoTierCache: LRU-bounded L1 plus
+the shared L2), which supplies TTL and eviction.
+
+Prompts that refer to the user's own finances ("my balance", "how much did I
+spend", amounts, account numbers) are never looked up or stored, so one
+user's context can't leak into another user's answer.
+"""
+import hashlib
+import re
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+PERSONAL_PATTERNS = [
+    # "my savings account", "our monthly budget"
+    r"\b(my|our)\s+(\w+\s+){0,2}(balances?|accounts?|transactions?|spending|expenses?|income|salary|"
+    r"budgets?|savings|debts?|loans?|cards?|bills?|net worth|finances?|money|portfolio|investments?)\b",
+    r"\bhow much (did|have|do|can|should|am|will) (i|we)\b",
+    r"\b(i|we) (spent|spend|earned|earn|owe|saved|paid|bought|make|made)\b",
+    r"\b(can|should) (i|we) afford\b",
+    # Account numbers, phone numbers and the like
+    r"\d{6,}",
+    # Amounts: "₦5000", "$20", "300 usd"
+    r"[₦$€£]\s?\d|\b\d[\d,]*(\.\d+)?\s?(ngn|usd|eur|naira|dollars?|euros?)\b",
+]
+_personal = re.compile("|".join(f"(?:{pattern})" for pattern in PERSONAL_PATTERNS), re.IGNORECASE)
+
+
+def normalize(prompt):
+    text = unicodedata.normalize("NFKC", prompt).casefold()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?!. ")
+
+
+def is_personal(prompt):
+    return bool(_personal.search(prompt))
+
+
+def cache_key(prompt, model=None):
+    digest = hashlib.sha256(f"{model or settings.LLM_MODEL}\0{normalize(prompt)}".encode()).hexdigest()
+    return f"chat:{digest}"
+
+
+def _cache():
+    return caches[settings.CHAT_CACHE_ALIAS]
+
+
+def _record(result):
+    metrics.inc("financeapp_chat_cache_requests_total", result=result)
+
+
+def cacheable(prompt):
+    """Whether this prompt may use the shared cache (records a bypass if not)"""
+    if not normalize(prompt) or is_personal(prompt):
+        _record("bypass")
+        return False
+    return True
+
+
+async def aget(prompt):
+    reply = await _cache().aget(cache_key(prompt))
+    _record("hit" if reply is not None else "miss")
+    return reply
+
+
+async def aset(prompt, reply):
+    if reply:
+        await _cache().aset(cache_key(prompt), reply, timeout=settings.CHAT_CACHE_TIMEOUT)
+
+
+def stats():
+    """Hit/miss/bypass totals and hit rate across all local worker processes"""
+    metrics.flush(force=True)
+    counters, _, _ = metrics.collect()
+    totals = {"hit": 0, "miss": 0, "bypass": 0}
+    for (name, labels), value in counters.items():
+        if name == "financeapp_chat_cache_requests_total":
+            result = dict(labels).get("result")
+            if result in totals:
+                totals[result] += value
+    lookups = totals["hit"] + totals["miss"]
+    totals["hit_rate"] = totals["hit"] / lookups if lookups else 0.0
+    return totals
@@ -0,0 +1,219 @@
+# financeapp/chat_context.py
+"""
+Per-user financial context for the chat assistant.
+
+Personal prompts ("how much did I spend on food last month?") get a compact
+snapshot of the user's finances as a system message: account balances,
+income and expenses for recent months, top expense categories and budget
+status. Matching transactions are pulled from a token index over the
+user's transaction descriptions, so no ledger scan happens per message.
+
+Both the snapshot and the index are built on first use and cached under the
+user's ledger version (the snapshot also under the day, since its monthly
+figures are relative to today). Any save or delete of a Transaction, Account or
+Budget replaces that version, so they are rebuilt only after the ledger
+actually changes. Querysets that bypass signals (``update()``,
+``bulk_create()``) must call ``bump_ledger_version`` themselves.
+"""
+import math
+import re
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, Sum
+from django.db.models.functions import TruncMonth
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import ledger
+from .models import Account, Budget, Transaction
+
+STOPWORDS = {
+    "the", "and", "for", "with", "from", "that", "this", "what", "how", "much", "did", "does", "have",
+    "has", "was", "were", "are", "you", "your", "my", "our", "on", "in", "of", "to", "at", "last",
+    "month", "week", "year", "spend", "spent", "show", "tell", "about", "any", "all", "can", "i",
+}
+_token = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return [t for t in _token.findall((text or "").lower()) if len(t) > 2 and t not in STOPWORDS]
+
+
+# ----------------- Ledger version -----------------
+def ledger_version(user_id):
+    key = f"ledger:version:{user_id}"
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_ledger_version(user_id):
+    cache.set(f"ledger:version:{user_id}", uuid.uuid4().hex, timeout=None)
+
+
+@receiver(post_save, sender=Transaction, dispatch_uid="financeapp.chat_context.transaction_saved")
+@receiver(post_delete, sender=Transaction, dispatch_uid="financeapp.chat_context.transaction_deleted")
+@receiver(post_save, sender=Account, dispatch_uid="financeapp.chat_context.account_saved")
+@receiver(post_delete, sender=Account, dispatch_uid="financeapp.chat_context.account_deleted")
+@receiver(post_save, sender=Budget, dispatch_uid="financeapp.chat_context.budget_saved")
+@receiver(post_delete, sender=Budget, dispatch_uid="financeapp.chat_context.budget_deleted")
+def _ledger_changed(sender, instance, **kwargs):
+    if instance.user_id:
+        bump_ledger_version(instance.user_id)
+
+
+# ----------------- Snapshot -----------------
+def build_snapshot(user):
+    """A handful of aggregate queries summarizing the user's finances"""
+    today = timezone.now().date()
+    month_start = today.replace(day=1)
+    window_start = (month_start - timedelta(days=1)).replace(day=1)
+    for _ in range(settings.CHAT_CONTEXT_MONTHS - 2):
+        window_start = (window_start - timedelta(days=1)).replace(day=1)
+
+    accounts = list(
+        ledger.with_live_balance(Account.objects.filter(user=user, is_active=True))
+        .order_by("name")
+        .values_list("name", "account_type", "currency", "live_balance")
+    )
+    months = (
+        Transaction.objects.filter(user=user, date__gte=window_start)
+        .annotate(month=TruncMonth("date"))
+        .values("month")
+        .annotate(
+            income=Sum("amount", filter=Q(transaction_type="income")),
+            expenses=Sum("amount", filter=Q(transaction_type="expense")),
+        )
+        .order_by("month")
+    )
+    categories = (
+        Transaction.objects.filter(user=user, transaction_type="expense", date__gte=month_start)
+        .values("category")
+        .annotate(total=Sum("amount"))
+        .order_by("-total")[:5]
+    )
+    spent_by_category = {row["category"]: row["total"] for row in categories}
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
+    budgets = list(Budget.objects.filter(user=user, month__gte=month_start, month__lt=next_month))
+    if budgets:
+        missing = [b.category for b in budgets if b.category not in spent_by_category]
+        if missing:
+            spent_by_category.update(
+                Transaction.objects.filter(
+                    user=user, transaction_type="expense", date__gte=month_start, category__in=missing
+                )
+                .values_list("category")
+                .annotate(total=Sum("amount"))
+            )
+
+    return {
+        "as_of": today.isoformat(),
+        "accounts": [
+            {"name": name, "type": account_type, "currency": currency, "balance": str(balance)}
+            for name, account_type, currency, balance in accounts
+        ],
+        "months": [
+            {
+                "month": row["month"].strftime("%Y-%m"),
+                "income": str(row["income"] or 0),
+                "expenses": str(row["expenses"] or 0),
+            }
+            for row in months
+        ],
+        "top_categories": [{"category": row["category"], "spent": str(row["total"])} for row in categories],
+        "budgets": [
+            {
+                "category": b.category,
+                "budget": str(b.amount),
+                "spent": str(spent_by_category.get(b.category) or 0),
+            }
+            for b in budgets
+        ],
+    }
+
+
+def get_snapshot(user):
+    # Also keyed by day: "this month" and the month window move with the date
+    today = timezone.now().date()
+    key = f"chat:snapshot:{user.pk}:{ledger_version(user.pk)}:{today.isoformat()}"
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = build_snapshot(user)
+        cache.set(key, snapshot, timeout=settings.CHAT_CONTEXT_TIMEOUT)
+    return snapshot
+
+
+# ----------------- Retrieval index -----------------
+def build_index(user):
+    """Inverted index token -> row ids over the user's most recent transactions"""
+    rows = {}
+    postings = {}
+    recent = (
+        Transaction.objects.filter(user=user)
+        .order_by("-date", "-id")
+        .values_list("id", "date", "transaction_type", "category", "amount", "description", "account__name")
+        [: settings.CHAT_INDEX_MAX_ROWS]
+    )
+    for pk, date, transaction_type, category, amount, description, account_name in recent:
+        rows[pk] = (date.isoformat(), transaction_type, category, str(amount), description, account_name or "")
+        for token in set(tokenize(f"{description} {category} {account_name or ''}")):
+            postings.setdefault(token, []).append(pk)
+    return {"rows": rows, "postings": postings}
+
+
+def get_index(user):
+    key = f"chat:index:{user.pk}:{ledger_version(user.pk)}"
+    index = cache.get(key)
+    if index is None:
+        index = build_index(user)
+        cache.set(key, index, timeout=settings.CHAT_CONTEXT_TIMEOUT)
+    return index
+
+
+def search(index, prompt, limit=None):
+    """Rows sharing the most (rarest) tokens with the prompt, newest first on ties"""
+    limit = limit or settings.CHAT_CONTEXT_MAX_ROWS
+    total = len(index["rows"]) or 1
+    scores = Counter()
+    for token in set(tokenize(prompt)):
+        matches = index["postings"].get(token, ())
+        if not matches:
+            continue
+        weight = math.log(1 + total / len(matches))
+        for pk in matches:
+            scores[pk] += weight
+    ranked = sorted(scores, key=lambda pk: (scores[pk], index["rows"][pk][0]), reverse=True)
+    return [index["rows"][pk] for pk in ranked[:limit]]
+
+
+# ----------------- Prompt -----------------
+def render(snapshot, rows):
+    lines = [
+        "You are WealthyWise's finance assistant. Answer using the user's data below; "
+        "say so if it doesn't contain the answer.",
+        f"Data as of {snapshot['as_of']}.",
+        "Accounts: "
+        + ("; ".join(f"{a['name']} ({a['type']}) {a['currency']} {a['balance']}" for a in snapshot["accounts"]) or "none"),
+        "Monthly totals: "
+        + ("; ".join(f"{m['month']} income {m['income']}, expenses {m['expenses']}" for m in snapshot["months"]) or "none"),
+        "Top expense categories this month: "
+        + (", ".join(f"{c['category']} {c['spent']}" for c in snapshot["top_categories"]) or "none"),
+        "Budgets this month: "
+        + ("; ".join(f"{b['category']} spent {b['spent']} of {b['budget']}" for b in snapshot["budgets"]) or "none"),
+    ]
+    if rows:
+        lines.append("Relevant transactions (date, type, category, amount, description, account):")
+        lines.extend(" | ".join(row) for row in rows)
+    return "\n".join(lines)
+
+
+def context_for(user, prompt):
+    """System prompt with the user's financial context for ``prompt``"""
+    return render(get_snapshot(user), search(get_index(user), prompt))
@@ -3,6 +3,7 @@ from .models import UserSetting
 from django.db.models import Sum
 from datetime import datetime, timedelta
 from .models import UserProfile, Account, Transaction, UserSetting
+from . import ledger
 from django.conf import settings
 
 def app_settings(request):
@@ -28,10 +29,10 @@ def dashboard_data(request):
     """Add dashboard data to template context"""
     if request.user.is_authenticated:
         # Get user accounts
-        accounts = Account.objects.filter(user=request.user, is_active=True)
+        accounts = ledger.with_live_balance(Account.objects.filter(user=request.user, is_active=True))
         
         # Calculate totals
-        total_balance = sum(account.balance for account in accounts)
+        total_balance = sum(account.live_balance for account in accounts)
         
         # Get current month transactions
         today = datetime.now().date()
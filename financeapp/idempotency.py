@@ -0,0 +1,221 @@
+# financeapp/idempotency.py
+"""
+Idempotency-Key support for write endpoints.
+
+Mobile clients retry a write after a timeout without knowing whether the
+first attempt went through. When such a request carries an
+``Idempotency-Key`` header, views wrapped in ``idempotent`` run at most once
+per (user, key): the first request claims the key by inserting an
+``IdempotencyRecord``, and its response is stored on that row and in the
+cache for ``IDEMPOTENCY_TTL`` seconds. A retry gets the stored response back
+(marked ``Idempotent-Replayed: true``) with the cookies the view set, and
+the flash messages it queued are queued again for the retry. Session
+changes are already saved server-side, so the session cookie the client
+holds stays valid; only a rotated session key is not replayed. A retry
+that arrives while the first is still running gets a 409 with
+``Retry-After: IDEMPOTENCY_RETRY_AFTER`` straight away rather than holding
+a worker thread while it waits.
+
+Reusing a key for a different request (another method, path or body) is a
+422. Failures are not stored: if the view raises or answers with a 5xx the
+claim is released, so the retry runs for real. A claim whose request died
+is taken over after ``IDEMPOTENCY_LOCK_TIMEOUT`` seconds.
+"""
+import functools
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+from django.http.request import RawPostDataException
+from django.utils import timezone
+
+from .models import IdempotencyRecord
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+# Response headers stored along with the body
+KEPT_HEADERS = ("Content-Type", "Location")
+# Stored headers key holding the response's cookies, as Set-Cookie values
+COOKIES = "Set-Cookie"
+
+
+def _fingerprint(request):
+    digest = hashlib.sha256(f"{request.method} {request.get_full_path()}\n".encode())
+    try:
+        digest.update(request.body)
+    except RawPostDataException:
+        # Multipart bodies are streamed into request.POST and can't be read again
+        digest.update(repr(sorted(request.POST.lists())).encode())
+        uploads = sorted((name, [(f.name, f.size) for f in files]) for name, files in request.FILES.lists())
+        digest.update(repr(uploads).encode())
+    return digest.hexdigest()
+
+
+def _cache_key(user_id, key):
+    return f"idempotency:{user_id}:{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def _error(message, status):
+    return JsonResponse({"success": False, "message": message}, status=status)
+
+
+def _in_progress():
+    response = _error(f"A request with this {HEADER} is still being processed", 409)
+    response["Retry-After"] = str(settings.IDEMPOTENCY_RETRY_AFTER)
+    return response
+
+
+def _stored(record):
+    return {
+        "fingerprint": record.fingerprint,
+        "status": record.response_status,
+        "headers": record.response_headers,
+        "body": bytes(record.response_body),
+        "messages": record.response_messages,
+    }
+
+
+def _replay(request, stored, fingerprint):
+    if stored["fingerprint"] != fingerprint:
+        return _error(f"This {HEADER} was already used for a different request", 422)
+    response = HttpResponse(stored["body"], status=stored["status"])
+    for name, value in stored["headers"].items():
+        if name == COOKIES:
+            for cookie in value:
+                response.cookies.load(cookie)
+        else:
+            response[name] = value
+    response[REPLAYED_HEADER] = "true"
+    # Queued again so the message middleware delivers them with this response
+    for level, message, extra_tags in stored.get("messages", []):
+        messages.add_message(request, level, message, extra_tags=extra_tags, fail_silently=True)
+    return response
+
+
+def _claim(user, key, fingerprint):
+    """Insert the running record for (user, key); None if there already is one"""
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            return IdempotencyRecord.objects.create(
+                user=user,
+                key=key,
+                fingerprint=fingerprint,
+                started_at=now,
+                expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_TTL),
+            )
+    except IntegrityError:
+        return None
+
+
+def _take_over(record, fingerprint):
+    """Reclaim an expired record, or one whose request died; True if this request now owns it"""
+    now = timezone.now()
+    abandoned = now - timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+    return bool(
+        IdempotencyRecord.objects.filter(pk=record.pk, started_at=record.started_at)
+        .filter(Q(expires_at__lte=now) | Q(status="running", started_at__lt=abandoned))
+        .update(
+            status="running",
+            fingerprint=fingerprint,
+            response_status=None,
+            response_headers={},
+            response_body=b"",
+            started_at=now,
+            expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_TTL),
+        )
+    )
+
+
+def _acquire(request, user, key, fingerprint):
+    """
+    Own the key, or find its outcome: returns (record, None) when this
+    request should run the view, (None, response) when it must not.
+    """
+    cache_key = _cache_key(user.pk, key)
+    stored = cache.get(cache_key)
+    if stored:
+        return None, _replay(request, stored, fingerprint)
+    # A second pass only if a failed run released the key in between
+    for _ in range(2):
+        record = _claim(user, key, fingerprint)
+        if record:
+            return record, None
+        record = IdempotencyRecord.objects.filter(user=user, key=key).first()
+        if record is not None:
+            break
+    else:
+        return None, _in_progress()
+    live = record.expires_at > timezone.now()
+    if live and record.status == "done":
+        stored = _stored(record)
+        cache.set(cache_key, stored, timeout=(record.expires_at - timezone.now()).total_seconds())
+        return None, _replay(request, stored, fingerprint)
+    if live and record.fingerprint != fingerprint:
+        return None, _error(f"This {HEADER} was already used for a different request", 422)
+    if _take_over(record, fingerprint):
+        record.refresh_from_db()
+        return record, None
+    return None, _in_progress()
+
+
+def idempotent(view):
+    """Run ``view`` at most once per (user, Idempotency-Key); see the module docstring"""
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        user = getattr(request, "user", None)
+        if not key or request.method not in WRITE_METHODS or not (user and user.is_authenticated):
+            return view(request, *args, **kwargs)
+        if len(key) > IdempotencyRecord._meta.get_field("key").max_length:
+            return _error(f"{HEADER} must be at most 255 characters", 400)
+
+        fingerprint = _fingerprint(request)
+        record, response = _acquire(request, user, key, fingerprint)
+        if response is not None:
+            return response
+
+        owned = IdempotencyRecord.objects.filter(pk=record.pk, started_at=record.started_at)
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            owned.delete()
+            raise
+        if response.streaming or response.status_code >= 500:
+            owned.delete()
+            return response
+
+        headers = {name: response[name] for name in KEPT_HEADERS if response.has_header(name)}
+        if response.cookies:
+            headers[COOKIES] = [morsel.OutputString() for morsel in response.cookies.values()]
+        queued = getattr(getattr(request, "_messages", None), "_queued_messages", [])
+        stored = {
+            "fingerprint": fingerprint,
+            "status": response.status_code,
+            "headers": headers,
+            "body": response.content,
+            "messages": [[message.level, str(message.message), message.extra_tags] for message in queued],
+        }
+        if owned.update(
+            status="done",
+            response_status=stored["status"],
+            response_headers=stored["headers"],
+            response_body=stored["body"],
+            response_messages=stored["messages"],
+        ):
+            cache.set(_cache_key(user.pk, key), stored, timeout=settings.IDEMPOTENCY_TTL)
+        return response
+
+    return wrapper
+
+
+def clear_expired():
+    """Delete records past their TTL; returns how many"""
+    return IdempotencyRecord.objects.filter(expires_at__lte=timezone.now()).delete()[0]
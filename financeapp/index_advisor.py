@@ -0,0 +1,229 @@
+# financeapp/index_advisor.py
+"""
+Catalog of the app's hot Transaction query shapes and an EXPLAIN-based
+checker that flags full scans, filesorts and uncovered lookups.
+
+Each entry mirrors a real query from views.py, context_processors.py,
+models.py or ledger.py, and names the composite index that would serve it
+from the index alone.
+"""
+import json
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+
+from .ledger import OUTGOING_DELTA
+from .models import Transaction
+
+
+@dataclass
+class QueryShape:
+    name: str
+    source: str
+    build: object  # callable(user_id, account_id) -> QuerySet
+    index_fields: tuple
+    # Aggregates should be answerable from the index alone; row fetches can't be
+    covering: bool = True
+
+
+def _month_start():
+    return timezone.now().date().replace(day=1)
+
+
+CATALOG = [
+    QueryShape(
+        "monthly_totals",
+        "views.landing / views.transaction / context_processors.dashboard_data",
+        lambda user_id, account_id: Transaction.objects.filter(
+            user_id=user_id, transaction_type="income", date__gte=_month_start()
+        ).order_by().values("user_id").annotate(total=Sum("amount")),
+        ("user", "transaction_type", "date", "amount"),
+    ),
+    QueryShape(
+        "chart_daily",
+        "views.get_chart_data(period='week')",
+        lambda user_id, account_id: Transaction.objects.filter(
+            user_id=user_id, transaction_type="expense", date=timezone.now().date()
+        ).order_by().values("user_id").annotate(total=Sum("amount")),
+        ("user", "transaction_type", "date", "amount"),
+    ),
+    QueryShape(
+        "chart_range",
+        "views.get_chart_data(period='month'|'year')",
+        lambda user_id, account_id: Transaction.objects.filter(
+            user_id=user_id,
+            transaction_type="expense",
+            date__range=[timezone.now().date() - timedelta(days=30), timezone.now().date()],
+        ).order_by().values("user_id").annotate(total=Sum("amount")),
+        ("user", "transaction_type", "date", "amount"),
+    ),
+    QueryShape(
+        "monthly_history",
+        "views.budget_insights_view",
+        lambda user_id, account_id: Transaction.objects.filter(
+            user_id=user_id,
+            transaction_type="expense",
+            date__year=_month_start().year,
+            date__month=_month_start().month,
+        ).order_by().values("user_id").annotate(total=Sum("amount")),
+        ("user", "transaction_type", "date", "amount"),
+    ),
+    QueryShape(
+        "top_categories",
+        "views.landing",
+        lambda user_id, account_id: Transaction.objects.filter(
+            user_id=user_id, transaction_type="expense"
+        ).values("category").annotate(total=Sum("amount")).order_by("-total")[:5],
+        ("user", "transaction_type", "category", "date", "amount"),
+    ),
+    QueryShape(
+        "budget_spent",
+        "models.Budget.spent_amount",
+        lambda user_id, account_id: Transaction.objects.filter(
+            user_id=user_id,
+            category="food",
+            transaction_type="expense",
+            date__gte=_month_start(),
+            date__lt=_month_start() + timedelta(days=32),
+        ).order_by().values("user_id").annotate(total=Sum("amount")),
+        ("user", "transaction_type", "category", "date", "amount"),
+    ),
+    QueryShape(
+        "recent_transactions",
+        "views.landing / views.profile_view / context_processors.dashboard_data",
+        lambda user_id, account_id: Transaction.objects.filter(user_id=user_id).order_by("-date")[:10],
+        ("user", "date"),
+        covering=False,
+    ),
+    QueryShape(
+        "export_csv",
+        "views.export_transactions_csv",
+        lambda user_id, account_id: Transaction.objects.filter(user_id=user_id)
+        .select_related("account")
+        .order_by("-date"),
+        ("user", "date"),
+        covering=False,
+    ),
+    QueryShape(
+        "account_totals",
+        "ledger.with_computed_balance (ledger.drift / ledger.recalculate)",
+        lambda user_id, account_id: Transaction.objects.filter(account_id=account_id)
+        .order_by()
+        .values("account_id")
+        .annotate(total=Sum(OUTGOING_DELTA)),
+        ("account", "transaction_type", "amount"),
+    ),
+    QueryShape(
+        "incoming_transfers",
+        "ledger.with_computed_balance (ledger.drift / ledger.recalculate)",
+        lambda user_id, account_id: Transaction.objects.filter(
+            to_account_id=account_id, transaction_type="transfer"
+        ).order_by().values("to_account_id").annotate(total=Sum("amount")),
+        ("to_account", "transaction_type", "amount"),
+    ),
+]
+
+
+# ----------------- Plan analysis -----------------
+def explain(queryset):
+    """Return (raw plan text, parsed JSON plan or None) for the current backend"""
+    if connection.vendor in ("mysql", "postgresql"):
+        raw = queryset.explain(format="json")
+        plan = json.loads(raw)
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return raw, plan
+    return queryset.explain(), None
+
+
+def _walk(node):
+    if isinstance(node, dict):
+        yield node
+        for value in node.values():
+            yield from _walk(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _walk(value)
+
+
+def analyze(raw, plan, table):
+    """Return a set of issues: 'full_scan', 'filesort', 'not_covered'"""
+    issues = set()
+    covered = False
+
+    if connection.vendor == "mysql":
+        for node in _walk(plan):
+            if node.get("table_name") == table:
+                if node.get("access_type") == "ALL":
+                    issues.add("full_scan")
+                covered = covered or bool(node.get("using_index"))
+            if node.get("using_filesort"):
+                issues.add("filesort")
+    elif connection.vendor == "postgresql":
+        for node in _walk(plan):
+            node_type = node.get("Node Type")
+            if node_type == "Seq Scan" and node.get("Relation Name") == table:
+                issues.add("full_scan")
+            elif node_type == "Sort":
+                issues.add("filesort")
+            elif node_type == "Index Only Scan":
+                covered = True
+    else:
+        # SQLite: "SCAN <table>" without an index, "USE TEMP B-TREE" for sorts
+        for line in raw.splitlines():
+            if f"SCAN {table}" in line and "INDEX" not in line:
+                issues.add("full_scan")
+            if "USE TEMP B-TREE" in line:
+                issues.add("filesort")
+            if "COVERING INDEX" in line:
+                covered = True
+
+    if not covered:
+        issues.add("not_covered")
+    return issues
+
+
+def existing_index_fields(model=Transaction):
+    fields = [tuple(index.fields) for index in model._meta.indexes]
+    for f in model._meta.concrete_fields:
+        if f.db_index or f.is_relation:
+            fields.append((f.name,))
+    return fields
+
+
+def is_served(index_fields, existing):
+    """True if an existing index starts with all the proposed columns"""
+    return any(tuple(fields[: len(index_fields)]) == tuple(index_fields) for fields in existing)
+
+
+def index_name(index_fields):
+    abbrev = {"transaction_type": "type", "to_account": "to_acc", "category": "cat", "amount": "amt"}
+    name = "txn_" + "_".join(abbrev.get(f, f) for f in index_fields) + "_idx"
+    return name[:30]
+
+
+def run(user_id, account_id):
+    """EXPLAIN every catalog entry and return findings plus index proposals"""
+    table = Transaction._meta.db_table
+    existing = existing_index_fields()
+    findings, proposals = [], {}
+
+    for shape in CATALOG:
+        queryset = shape.build(user_id, account_id)
+        try:
+            raw, plan = explain(queryset)
+        except Exception as e:
+            findings.append({"shape": shape, "issues": {"explain_failed"}, "plan": str(e)})
+            continue
+        issues = analyze(raw, plan, table)
+        if not shape.covering:
+            issues.discard("not_covered")
+        findings.append({"shape": shape, "issues": issues, "plan": raw})
+
+        if issues & {"full_scan", "filesort", "not_covered"} and not is_served(shape.index_fields, existing):
+            proposals.setdefault(shape.index_fields, []).append(shape.name)
+
+    return findings, proposals
@@ -0,0 +1,270 @@
+# financeapp/jobs.py
+"""
+Chunked per-user fan-out jobs.
+
+Work that has to touch every user (rebuilding caches, rolling budgets over,
+recalculating balances) is registered here as a handler that processes one
+batch of user ids. ``start`` splits the users into chunks of
+``chunk_size``, each holding users of a single account type, records them
+as ``FanOutChunk`` rows and dispatches them as a Celery group. Every chunk
+is sent with its ``tier``, so it lands on that tier's analytics queue (see
+financeapp.queues).
+
+The chunk rows are the checkpoint. A chunk is claimed by flipping it to
+"running", and it only counts once marked "done", so a redelivered chunk
+never runs twice. ``resume`` re-dispatches whatever is not done (failed, or
+running for longer than ``FANOUT_CHUNK_TIMEOUT``), which picks an
+interrupted run up where it stopped. Completion is counted on the job row
+rather than with a chord callback, since the result backend is not shared
+between workers.
+
+Before each chunk the worker probes the database. When a trivial query is
+slower than ``FANOUT_MAX_PROBE_MS``, or MySQL reports more than
+``FANOUT_MAX_THREADS_RUNNING`` running threads, the chunk is postponed by
+``FANOUT_THROTTLE_DELAY`` seconds instead of adding load. After
+``FANOUT_MAX_THROTTLE_RETRIES`` postponements it runs anyway, so a job
+can't be held off forever.
+"""
+import time
+from datetime import timedelta
+
+from celery import group
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import FanOutChunk, FanOutJob
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register ``func(user_ids, **params)`` as the handler for job ``kind``"""
+
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+
+    return decorator
+
+
+# ----------------- Launching -----------------
+def plan_chunks(chunk_size):
+    """(tier, user_ids) chunks of up to ``chunk_size`` existing users, each of a single tier"""
+    from .queues import TIERS
+
+    chunks = []
+    pending = {tier: [] for tier in TIERS}
+    users = get_user_model().objects.order_by("pk").values_list("pk", "profile__account_type")
+    for user_id, tier in users.iterator(chunk_size=2000):
+        tier = tier if tier in pending else "standard"
+        pending[tier].append(user_id)
+        if len(pending[tier]) == chunk_size:
+            chunks.append((tier, pending[tier]))
+            pending[tier] = []
+    chunks.extend((tier, user_ids) for tier, user_ids in pending.items() if user_ids)
+    return chunks
+
+
+def start(kind, chunk_size=None, params=None, dispatch_chunks=True):
+    """Create a job for ``kind`` over all users and dispatch its chunks"""
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind {kind!r}; known: {', '.join(sorted(HANDLERS))}")
+    chunk_size = chunk_size or settings.FANOUT_CHUNK_SIZE
+    chunks = plan_chunks(chunk_size)
+    with transaction.atomic():
+        job = FanOutJob.objects.create(
+            kind=kind,
+            params=params or {},
+            chunk_size=chunk_size,
+            total_chunks=len(chunks),
+            status="running" if chunks else "done",
+            finished_at=None if chunks else timezone.now(),
+        )
+        FanOutChunk.objects.bulk_create(
+            FanOutChunk(
+                job=job, index=i, tier=tier, user_ids=user_ids, first_user_id=user_ids[0], last_user_id=user_ids[-1]
+            )
+            for i, (tier, user_ids) in enumerate(chunks)
+        )
+    if dispatch_chunks:
+        transaction.on_commit(lambda: dispatch(job))
+    return job
+
+
+def _resumable(job):
+    stale = timezone.now() - timedelta(seconds=settings.FANOUT_CHUNK_TIMEOUT)
+    return job.chunks.filter(
+        Q(status__in=("pending", "failed")) | Q(status="running", updated_at__lt=stale)
+    )
+
+
+def dispatch(job, chunk_ids=None):
+    """Queue the job's unfinished chunks as one Celery group, each on its tier's queue"""
+    from .task import run_fanout_chunk
+
+    chunks = job.chunks.filter(status="pending") if chunk_ids is None else job.chunks.filter(pk__in=chunk_ids)
+    chunks = list(chunks.values_list("pk", "tier"))
+    if chunks:
+        group(run_fanout_chunk.s(chunk_id, tier=tier) for chunk_id, tier in chunks).apply_async()
+    return len(chunks)
+
+
+def resume(job, dispatch_chunks=True):
+    """Re-dispatch every chunk that isn't done (failed, pending, or stuck running)"""
+    with transaction.atomic():
+        chunks = list(_resumable(job).values_list("pk", "status"))
+        failed = sum(1 for _, status in chunks if status == "failed")
+        _resumable(job).update(status="pending")
+        FanOutJob.objects.filter(pk=job.pk).update(
+            status="running", finished_at=None, failed_chunks=F("failed_chunks") - failed
+        )
+    if not dispatch_chunks:
+        return len(chunks)
+    return dispatch(job, [pk for pk, _ in chunks])
+
+
+def cancel(job):
+    """Stop dispatching: chunks not yet claimed are skipped when they arrive"""
+    return FanOutJob.objects.filter(pk=job.pk, status="running").update(status="cancelled", finished_at=timezone.now())
+
+
+# ----------------- Running -----------------
+def db_busy():
+    """Whether the database looks too loaded for another chunk right now"""
+    # Time the query, not the connection setup
+    connection.ensure_connection()
+    started = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        if (time.perf_counter() - started) * 1000 > settings.FANOUT_MAX_PROBE_MS:
+            return True
+        if connection.vendor == "mysql":
+            cursor.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+            row = cursor.fetchone()
+            if row and int(row[1]) > settings.FANOUT_MAX_THREADS_RUNNING:
+                return True
+    return False
+
+
+def _claim(chunk_id):
+    """Flip a pending chunk to running; None if it's done, claimed or its job stopped"""
+    claimed = FanOutChunk.objects.filter(pk=chunk_id, status="pending", job__status="running").update(
+        status="running", attempts=F("attempts") + 1, updated_at=timezone.now()
+    )
+    if not claimed:
+        return None
+    return FanOutChunk.objects.select_related("job").get(pk=chunk_id)
+
+
+def _finish_job_if_complete(job_id):
+    job = FanOutJob.objects.get(pk=job_id)
+    if job.status == "running" and job.done_chunks + job.failed_chunks >= job.total_chunks:
+        status = "failed" if job.failed_chunks else "done"
+        FanOutJob.objects.filter(pk=job_id, status="running").update(status=status, finished_at=timezone.now())
+
+
+def run_chunk(chunk_id):
+    """
+    Process one chunk. Returns the number of users handled, or None when the
+    chunk was skipped (already done, claimed elsewhere, or job stopped).
+    Handler exceptions mark the chunk failed and are re-raised.
+    """
+    chunk = _claim(chunk_id)
+    if chunk is None:
+        return None
+    job = chunk.job
+    started = time.perf_counter()
+    users = get_user_model().objects.order_by("pk")
+    if chunk.user_ids:
+        users = users.filter(pk__in=chunk.user_ids)
+    else:
+        users = users.filter(pk__gte=chunk.first_user_id, pk__lte=chunk.last_user_id)
+    user_ids = list(users.values_list("pk", flat=True))
+    try:
+        processed = HANDLERS[job.kind](user_ids, **job.params)
+    except Exception as e:
+        FanOutChunk.objects.filter(pk=chunk.pk).update(
+            status="failed", error=f"{type(e).__name__}: {e}"[:2000], duration=time.perf_counter() - started
+        )
+        FanOutJob.objects.filter(pk=job.pk).update(failed_chunks=F("failed_chunks") + 1)
+        _finish_job_if_complete(job.pk)
+        raise
+    processed = len(user_ids) if processed is None else processed
+    with transaction.atomic():
+        FanOutChunk.objects.filter(pk=chunk.pk).update(
+            status="done", users_processed=processed, error="", duration=time.perf_counter() - started
+        )
+        FanOutJob.objects.filter(pk=job.pk).update(
+            done_chunks=F("done_chunks") + 1, users_processed=F("users_processed") + processed
+        )
+    _finish_job_if_complete(job.pk)
+    return processed
+
+
+def progress(job):
+    """Chunk counts by status plus throughput, for ``manage.py fanout watch``"""
+    job.refresh_from_db()
+    counts = dict.fromkeys(("pending", "running", "done", "failed"), 0)
+    for status in job.chunks.values_list("status", flat=True):
+        counts[status] += 1
+    elapsed = ((job.finished_at or timezone.now()) - job.created_at).total_seconds()
+    return {
+        "job": job,
+        "chunks": counts,
+        "users_processed": job.users_processed,
+        "users_per_second": job.users_processed / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+# ----------------- Handlers -----------------
+@handler("warm_chat_context")
+def warm_chat_context(user_ids):
+    """Build each user's chat snapshot and transaction index ahead of their first question"""
+    from . import chat_context
+
+    users = get_user_model().objects.filter(pk__in=user_ids)
+    for user in users:
+        chat_context.get_snapshot(user)
+        chat_context.get_index(user)
+    return len(user_ids)
+
+
+@handler("rollover_budgets")
+def rollover_budgets(user_ids, month=None):
+    """Copy last month's budgets into ``month`` (default: this month) where a category has none"""
+    from datetime import date
+
+    from . import chat_context
+    from .models import Budget
+
+    target = date.fromisoformat(month).replace(day=1) if month else timezone.now().date().replace(day=1)
+    previous = (target - timedelta(days=1)).replace(day=1)
+    existing = set(
+        Budget.objects.filter(user_id__in=user_ids, month=target).values_list("user_id", "category")
+    )
+    new = [
+        Budget(user_id=user_id, category=category, amount=amount, month=target)
+        for user_id, category, amount in Budget.objects.filter(user_id__in=user_ids, month=previous).values_list(
+            "user_id", "category", "amount"
+        )
+        if (user_id, category) not in existing
+    ]
+    Budget.objects.bulk_create(new, ignore_conflicts=True)
+    # bulk_create skips the signals that invalidate chat context
+    for user_id in {budget.user_id for budget in new}:
+        chat_context.bump_ledger_version(user_id)
+    return len(user_ids)
+
+
+@handler("recalculate_balances")
+def recalculate_balances(user_ids):
+    """Set every account balance of these users to their opening balance plus their transactions"""
+    from . import ledger
+    from .models import Account
+
+    ledger.recalculate(Account.objects.filter(user_id__in=user_ids))
+    return len(user_ids)
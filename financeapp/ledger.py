@@ -0,0 +1,456 @@
+# financeapp/ledger.py
+"""
+Account balances recomputed from the transaction ledger.
+
+The rules are the ones ``Transaction.save`` applies when a transaction is
+posted: income adds its amount to ``account``, an expense subtracts it, and
+a transfer subtracts it from ``account`` and adds it to ``to_account``. A
+transfer whose destination account has since been deleted still debits its
+source, as it did when it was posted. The ledger starts from the account's
+``opening_balance``, which holds the balance it was opened with and any
+later change to ``balance`` made by hand rather than by a transaction.
+
+Everything here is set-based: the expected balance of any number of
+accounts comes from one statement with two grouped subqueries over
+``Transaction`` (by ``account_id`` and by ``to_account_id``), and fixing
+them is one UPDATE per batch that shifts each balance by its drift.
+
+For balances on a past date, ``BalanceCheckpoint`` rows record each
+account's balance at month ends (the daily ``write_balance_checkpoints``
+task fills in any account missing the latest one). ``balances_as_of``
+starts from the nearest checkpoint and only sums the transactions after it.
+
+``Transaction.balance_after`` is the account's running ledger balance in
+(date, created_at, id) order, and ``to_balance_after`` the destination's
+for a transfer. A transaction posted after all others gets them from
+``Transaction.save``; one that is backdated, edited or deleted makes the
+accounts' later rows wrong, so the signal handlers here rewrite the
+running balances of just those rows (one windowed UPDATE where the
+database supports it, chunked ``bulk_update`` otherwise) and drop the
+checkpoints the change predates.
+
+A hot account (say a business collection account taking hundreds of
+concurrent credits) can have ``balance_shards`` set. Its credits then add
+to one of that many ``BalanceShard`` slots instead of updating and locking
+its row, its live balance is ``balance`` plus the slots, and
+``compact_balance_shards`` (a periodic task) folds the slots back in.
+Debits still lock the row, since they must see the whole balance to refuse
+an overdraft. Anything showing a balance reads ``live_balance`` (from
+``with_live_balance``) or ``Account.current_balance()``.
+"""
+import json
+import os
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, DecimalField, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Account, BalanceCheckpoint, BalanceShard, Transaction
+
+ZERO = Value(Decimal("0.00"), output_field=DecimalField(max_digits=15, decimal_places=2))
+HALF_CENT = Decimal("0.005")
+
+# Signed effect of a transaction on its own ``account``
+OUTGOING_DELTA = Case(
+    When(transaction_type="income", then=F("amount")),
+    When(Q(transaction_type="expense") | Q(transaction_type="transfer"), then=-F("amount")),
+    default=ZERO,
+    output_field=DecimalField(max_digits=15, decimal_places=2),
+)
+
+
+def _grouped_sum(column, value, **filters):
+    return Subquery(
+        Transaction.objects.filter(**{column: OuterRef("pk")}, **filters)
+        .order_by()
+        .values(column)
+        .annotate(total=Sum(value))
+        .values("total")[:1],
+        output_field=DecimalField(max_digits=15, decimal_places=2),
+    )
+
+
+def _delta(after=None, through=None):
+    """Net effect on the outer account of its transactions dated in (``after``, ``through``]"""
+    dates = {}
+    if after is not None:
+        dates["date__gt"] = after
+    if through is not None:
+        dates["date__lte"] = through
+    return Coalesce(_grouped_sum("account_id", OUTGOING_DELTA, **dates), ZERO) + Coalesce(
+        _grouped_sum("to_account_id", F("amount"), transaction_type="transfer", **dates), ZERO
+    )
+
+
+def with_live_balance(accounts):
+    """
+    ``accounts`` annotated with ``pending`` credits still in balance shards
+    and ``live_balance`` (stored balance plus pending), the balance to show
+    """
+    pending = Subquery(
+        BalanceShard.objects.filter(account=OuterRef("pk"))
+        .order_by()
+        .values("account")
+        .annotate(total=Sum("delta"))
+        .values("total")[:1],
+        output_field=DecimalField(max_digits=15, decimal_places=2),
+    )
+    return accounts.annotate(pending=Coalesce(pending, ZERO)).annotate(live_balance=F("balance") + F("pending"))
+
+
+def with_computed_balance(accounts=None):
+    """
+    ``accounts`` (default: all) annotated as by ``with_live_balance``, plus
+    ``computed_balance``: opening balance plus their transactions
+    """
+    accounts = Account.objects.all() if accounts is None else accounts
+    return with_live_balance(accounts.order_by()).annotate(computed_balance=F("opening_balance") + _delta())
+
+
+def _cents(value):
+    return Decimal(value).quantize(Decimal("0.01"))
+
+
+def drift(accounts=None):
+    """Accounts whose live balance differs from the ledger, as dicts"""
+    # Compared to the cent: SQLite keeps decimals as floats
+    rows = (
+        with_computed_balance(accounts)
+        .annotate(difference=F("live_balance") - F("computed_balance"))
+        .filter(Q(difference__gte=HALF_CENT) | Q(difference__lte=-HALF_CENT))
+        .values("pk", "user_id", "name", "currency", "live_balance", "pending", "computed_balance")
+    )
+    return [
+        {
+            "account_id": row["pk"],
+            "user_id": row["user_id"],
+            "name": row["name"],
+            "currency": row["currency"],
+            "stored": _cents(row["live_balance"]),
+            "pending": _cents(row["pending"]),
+            "computed": _cents(row["computed_balance"]),
+            "difference": _cents(row["live_balance"] - row["computed_balance"]),
+        }
+        for row in rows
+    ]
+
+
+def recalculate(accounts=None, batch_size=1000):
+    """
+    Bring each account's balance back to the ledger's. Only drifted rows are
+    written; returns their ``drift`` entries. Balances are shifted by their
+    difference rather than overwritten, so a posting that commits between
+    the drift check and the write is kept.
+    """
+    from . import chat_context
+
+    drifted = drift(accounts)
+    with transaction.atomic():
+        for start in range(0, len(drifted), batch_size):
+            batch = drifted[start : start + batch_size]
+            correction = Case(
+                *[When(pk=row["account_id"], then=Value(row["difference"])) for row in batch],
+                output_field=DecimalField(max_digits=15, decimal_places=2),
+            )
+            Account.objects.filter(pk__in=[row["account_id"] for row in batch]).update(
+                balance=F("balance") - correction
+            )
+    # update() skips the signals that invalidate chat context
+    for user_id in {row["user_id"] for row in drifted}:
+        chat_context.bump_ledger_version(user_id)
+    return drifted
+
+
+# ----------------- Point-in-time balances -----------------
+def with_balance_as_of(accounts, on):
+    """
+    ``accounts`` annotated with ``balance_as_of``, their ledger balance at the
+    end of ``on``: the latest checkpoint on or before that day (the opening
+    balance if there is none) plus the transactions dated after it. One
+    query for any number of accounts.
+    """
+    checkpoints = BalanceCheckpoint.objects.filter(account=OuterRef("pk"), date__lte=on).order_by("-date")
+    return (
+        accounts.order_by()
+        .annotate(
+            checkpoint_date=Coalesce(Subquery(checkpoints.values("date")[:1]), Value(date.min)),
+            checkpoint_balance=Coalesce(Subquery(checkpoints.values("balance")[:1]), F("opening_balance")),
+        )
+        .annotate(balance_as_of=F("checkpoint_balance") + _delta(after=OuterRef("checkpoint_date"), through=on))
+    )
+
+
+def balances_as_of(accounts, on):
+    """{account_id: balance at the end of ``on``} for ``accounts``"""
+    return dict(with_balance_as_of(accounts, on).values_list("pk", "balance_as_of"))
+
+
+def balance_as_of(account, on):
+    """``account``'s balance at the end of ``on``"""
+    return balances_as_of(Account.objects.filter(pk=account.pk), on).get(account.pk, Decimal("0.00"))
+
+
+def user_balances_as_of(user, on):
+    """{account_id: balance at the end of ``on``} for all of ``user``'s accounts, in one query"""
+    return balances_as_of(Account.objects.filter(user=user), on)
+
+
+def month_end(day):
+    """Last day of the month before the one ``day`` falls in"""
+    return day.replace(day=1) - timedelta(days=1)
+
+
+def write_checkpoints(on, accounts=None, batch_size=1000):
+    """Record the balance of ``accounts`` (default: all) at the end of ``on``; returns how many"""
+    accounts = Account.objects.all() if accounts is None else accounts
+    checkpoints = [
+        BalanceCheckpoint(account_id=account_id, date=on, balance=balance)
+        for account_id, balance in with_balance_as_of(accounts, on).values_list("pk", "balance_as_of")
+    ]
+    BalanceCheckpoint.objects.bulk_create(
+        checkpoints,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=["account", "date"],
+        update_fields=["balance"],
+    )
+    return len(checkpoints)
+
+
+# ----------------- Running balances -----------------
+# Changing any of these moves a transaction within its accounts' ledgers
+LEDGER_FIELDS = {"date", "amount", "transaction_type", "account", "to_account"}
+ORDERING = ("date", "created_at", "id")
+
+
+def _affected(instance):
+    """{account_id: earliest date} whose ledger a save or delete of ``instance`` changes"""
+    versions = [(instance.date, instance.account_id, instance.to_account_id)]
+    loaded = getattr(instance, "_loaded_values", None)
+    if loaded and not instance._state.adding:
+        versions.append((loaded.get("date"), loaded.get("account_id"), loaded.get("to_account_id")))
+    affected = {}
+    for day, *account_ids in versions:
+        if isinstance(day, datetime):
+            day = day.date()
+        for account_id in account_ids:
+            if account_id and day and (account_id not in affected or day < affected[account_id]):
+                affected[account_id] = day
+    return affected
+
+
+def _history(account_id):
+    return Account(pk=account_id).history()
+
+
+def _windowed_update_sql():
+    """One UPDATE recomputing the running balances with a window sum, or None if unsupported"""
+    if not connection.features.supports_over_clause:
+        return None
+    q = connection.ops.quote_name
+    table = q(Transaction._meta.db_table)
+    account, to_account, kind, amount, day = (
+        q(name) for name in ("account_id", "to_account_id", "transaction_type", "amount", "date")
+    )
+    running = f"""
+        SELECT {q("id")} AS id, %s + SUM(
+            CASE
+                WHEN {account} = %s AND {kind} = 'income' THEN {amount}
+                WHEN {account} = %s AND {kind} IN ('expense', 'transfer') THEN -{amount}
+                WHEN {account} = %s THEN 0
+                ELSE {amount}
+            END
+        ) OVER (
+            ORDER BY {day}, {q("created_at")}, {q("id")} ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+        ) AS running
+        FROM {table}
+        WHERE ({account} = %s OR ({to_account} = %s AND {kind} = 'transfer')) AND {day} >= %s
+    """
+    # Own rows get balance_after, incoming transfers to_balance_after
+    columns = [
+        (name, f"CASE WHEN {table}.{column} = %s THEN r.running ELSE {table}.{q(name)} END")
+        for name, column in (("balance_after", account), ("to_balance_after", to_account))
+    ]
+    if connection.vendor == "mysql":
+        assignments = ", ".join(f"{table}.{q(name)} = {value}" for name, value in columns)
+        return f"UPDATE {table} JOIN ({running}) AS r ON {table}.{q('id')} = r.id SET {assignments}"
+    if connection.vendor == "postgresql" or (connection.vendor == "sqlite" and sqlite3.sqlite_version_info >= (3, 33)):
+        assignments = ", ".join(f"{q(name)} = {value}" for name, value in columns)
+        return f"UPDATE {table} SET {assignments} FROM ({running}) AS r WHERE {table}.{q('id')} = r.id"
+    return None
+
+
+def recompute_running_balances(account_id, since):
+    """
+    Rewrite ``account_id``'s running balance on its transactions dated
+    ``since`` or later, starting from its ledger balance (opening balance
+    included) the day before:
+    ``balance_after`` on its own rows, ``to_balance_after`` on transfers
+    into it.
+    """
+    anchor = balance_as_of(Account(pk=account_id), since - timedelta(days=1))
+    sql = _windowed_update_sql()
+    if sql:
+        params = [anchor, account_id, account_id, account_id, account_id, account_id, since]
+        # MySQL's JOIN puts the derived table before SET; the others put it after
+        params = params + [account_id] * 2 if connection.vendor == "mysql" else [account_id] * 2 + params
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        return
+    # Chunked fallback: walk the rows in ledger order and write the changed ones
+    rows = (
+        _history(account_id)
+        .filter(date__gte=since)
+        .order_by(*ORDERING)
+        .values_list("pk", "account_id", "transaction_type", "amount", "balance_after", "to_balance_after")
+    )
+    running, own, incoming = anchor, [], []
+    for pk, owner, kind, amount, balance_after, to_balance_after in rows.iterator(
+        chunk_size=settings.RUNNING_BALANCE_BATCH_SIZE
+    ):
+        if owner != account_id:
+            running += amount
+            if to_balance_after != running:
+                incoming.append(Transaction(pk=pk, to_balance_after=running))
+        else:
+            running += amount if kind == "income" else -amount if kind in ("expense", "transfer") else 0
+            if balance_after != running:
+                own.append(Transaction(pk=pk, balance_after=running))
+        if len(own) + len(incoming) >= settings.RUNNING_BALANCE_BATCH_SIZE:
+            Transaction.objects.bulk_update(own, ["balance_after"])
+            Transaction.objects.bulk_update(incoming, ["to_balance_after"])
+            own, incoming = [], []
+    Transaction.objects.bulk_update(own, ["balance_after"])
+    Transaction.objects.bulk_update(incoming, ["to_balance_after"])
+
+
+@receiver(pre_save, sender=Transaction, dispatch_uid="financeapp.ledger.transaction_saving")
+def _transaction_saving(sender, instance, **kwargs):
+    if instance._state.adding or LEDGER_FIELDS & set(instance.get_dirty_fields()):
+        instance._ledger_affected = _affected(instance)
+        invalidate_checkpoints(instance._ledger_affected)
+
+
+@receiver(post_save, sender=Transaction, dispatch_uid="financeapp.ledger.transaction_saved")
+def _transaction_saved(sender, instance, created, **kwargs):
+    affected = instance.__dict__.pop("_ledger_affected", None)
+    if not affected:
+        return
+    for account_id, since in affected.items():
+        # A new transaction dated after all of the account's others already has the right running balances
+        if created and not _history(account_id).filter(date__gt=since).exists():
+            continue
+        recompute_running_balances(account_id, since)
+    instance.balance_after, instance.to_balance_after = (
+        Transaction.objects.filter(pk=instance.pk).values_list("balance_after", "to_balance_after").first()
+    )
+
+
+@receiver(post_delete, sender=Transaction, dispatch_uid="financeapp.ledger.transaction_deleted")
+def _transaction_deleted(sender, instance, **kwargs):
+    affected = _affected(instance)
+    invalidate_checkpoints(affected)
+    for account_id, since in affected.items():
+        recompute_running_balances(account_id, since)
+
+
+@receiver(post_save, sender=Account, dispatch_uid="financeapp.ledger.account_saved")
+def _account_saved(sender, instance, **kwargs):
+    # A hand-edited balance moved the opening balance, and with it every balance since
+    shift = instance.__dict__.pop("_opening_shift", None)
+    if shift:
+        BalanceCheckpoint.objects.filter(account=instance).update(balance=F("balance") + shift)
+        Transaction.objects.filter(account=instance).update(balance_after=F("balance_after") + shift)
+        Transaction.objects.filter(to_account=instance, transaction_type="transfer").update(
+            to_balance_after=F("to_balance_after") + shift
+        )
+
+
+def invalidate_checkpoints(affected):
+    """Drop checkpoints that a changed transaction predates (``affected`` from ``_affected``)"""
+    stale = Q()
+    for account_id, since in affected.items():
+        stale |= Q(account_id=account_id, date__gte=since)
+    if stale:
+        BalanceCheckpoint.objects.filter(stale).delete()
+
+
+# ----------------- Balance shards -----------------
+def compact_balance_shards(accounts=None):
+    """
+    Fold pending shard credits into ``Account.balance``; returns how many
+    accounts had any. Each account is locked while its slots are drained,
+    which briefly queues its debits but never its credits.
+    """
+    shards = BalanceShard.objects.exclude(delta=0)
+    if accounts is not None:
+        shards = shards.filter(account__in=accounts)
+    account_ids = sorted(set(shards.values_list("account_id", flat=True)))
+    for account_id in account_ids:
+        with transaction.atomic():
+            list(Account.objects.select_for_update().filter(pk=account_id))
+            drained = dict(
+                BalanceShard.objects.select_for_update()
+                .filter(account_id=account_id)
+                .exclude(delta=0)
+                .order_by("slot")
+                .values_list("pk", "delta")
+            )
+            if not drained:
+                continue
+            # Subtract what was read rather than zeroing, in case a credit lands meanwhile
+            BalanceShard.objects.filter(pk__in=drained).update(
+                delta=Case(
+                    *(When(pk=pk, then=F("delta") - amount) for pk, amount in drained.items()),
+                    output_field=DecimalField(max_digits=15, decimal_places=2),
+                )
+            )
+            Account.objects.filter(pk=account_id).update(balance=F("balance") + sum(drained.values()))
+    return len(account_ids)
+
+
+def set_balance_shards(accounts, shards):
+    """Turn sharded credits on (``shards`` slots) or off (0) for ``accounts``"""
+    accounts = list(accounts)
+    Account.objects.filter(pk__in=[account.pk for account in accounts]).update(balance_shards=shards)
+    for account in accounts:
+        account.balance_shards = shards
+    if shards:
+        BalanceShard.objects.bulk_create(
+            [BalanceShard(account=account, slot=slot) for account in accounts for slot in range(shards)],
+            ignore_conflicts=True,
+        )
+    # Slots past the new count only get drained from now on
+    compact_balance_shards(accounts)
+    BalanceShard.objects.filter(account__in=accounts, slot__gte=shards, delta=0).delete()
+
+
+# ----------------- Reconciliation -----------------
+def id_ranges(chunk_size):
+    """(first_id, last_id) ranges of ``chunk_size`` accounts each"""
+    ids = list(Account.objects.order_by("pk").values_list("pk", flat=True))
+    return [(chunk[0], chunk[-1]) for chunk in (ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size))]
+
+
+def write_drift_report(drifted, checked, fixed=False):
+    """Write the reconciliation result to LOG_DIR and return its path"""
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "accounts_checked": checked,
+        "accounts_drifted": len(drifted),
+        "fixed": fixed,
+        "drift": [
+            {key: str(value) if isinstance(value, Decimal) else value for key, value in row.items()} for row in drifted
+        ],
+    }
+    path = os.path.join(settings.LOG_DIR, "balance_drift_report.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return path
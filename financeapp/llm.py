@@ -0,0 +1,83 @@
+# financeapp/llm.py
+"""
+Async client for the LLM chat endpoint (Ollama-compatible ``/api/chat``).
+
+One pooled ``httpx.AsyncClient`` is kept per event loop, so every chat
+request served by a worker reuses the same keep-alive connections instead
+of opening a new one. Each call runs under an overall deadline
+(``LLM_TIMEOUT``) on top of httpx's connect/read timeouts.
+
+``stream_chat`` reads the model's NDJSON output incrementally. It only pulls
+the next line when its consumer asks for the next fragment, so a slow client
+slows the upstream read instead of buffering the whole generation here.
+"""
+import asyncio
+import json
+import weakref
+
+import httpx
+from django.conf import settings
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    """The shared AsyncClient for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.LLM_TIMEOUT, connect=settings.LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+        _clients[loop] = client
+    return client
+
+
+def chat_payload(user_message, stream=False, context=None):
+    messages = [{"role": "user", "content": user_message}]
+    if context:
+        messages.insert(0, {"role": "system", "content": context})
+    return {"model": settings.LLM_MODEL, "messages": messages, "stream": stream}
+
+
+async def chat(user_message, deadline=None, context=None):
+    """
+    Send one user message and return the upstream response. Raises
+    ``TimeoutError`` when the whole exchange exceeds ``deadline`` seconds
+    (``LLM_TIMEOUT`` by default) and ``httpx.HTTPError`` on transport errors.
+    """
+    async with asyncio.timeout(deadline or settings.LLM_TIMEOUT):
+        response = await get_client().post(settings.LLM_CHAT_URL, json=chat_payload(user_message, context=context))
+    return response
+
+
+async def stream_chat(user_message, stop=None, context=None):
+    """
+    Yield content fragments as the model produces them. httpx's read timeout
+    (``LLM_TIMEOUT``) bounds the wait for each fragment and
+    ``LLM_STREAM_TIMEOUT`` the whole stream. Iteration ends early, closing
+    the upstream request, once ``stop`` (an ``asyncio.Event``) is set. A
+    line that isn't valid JSON raises ``ValueError``.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.LLM_STREAM_TIMEOUT
+    payload = chat_payload(user_message, stream=True, context=context)
+    async with get_client().stream("POST", settings.LLM_CHAT_URL, json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if stop is not None and stop.is_set():
+                return
+            if loop.time() > deadline:
+                raise TimeoutError
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            content = (chunk.get("message") or {}).get("content")
+            if content:
+                yield content
+            if chunk.get("done"):
+                return
@@ -0,0 +1,167 @@
+# financeapp/mail.py
+"""
+Outbox for outgoing email.
+
+``OutboxBackend`` is the project's ``EMAIL_BACKEND``: ``send_mail``, the
+password reset form and allauth all hand it their messages, and it only
+stores them as ``OutboxMessage`` rows and asks a worker to deliver them once
+the surrounding transaction commits. Requests never wait on the mail server.
+Rows hold the message's parts as plain fields (``build_message`` puts them
+back together), never a pickle that delivery would have to load from the
+database.
+
+The ``deliver_outbox`` task claims due rows in batches and sends each batch
+over one connection of ``OUTBOX_DELIVERY_BACKEND`` (SMTP in production).
+A failed message is retried with exponential backoff plus jitter until
+``OUTBOX_MAX_ATTEMPTS``, then marked failed. Claimed rows are leased for
+``OUTBOX_CLAIM_TIMEOUT`` seconds, so messages held by a crashed worker are
+picked up again; the beat schedule also sweeps the outbox every minute.
+"""
+import base64
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+def _schedule_delivery():
+    from .task import deliver_outbox
+
+    try:
+        deliver_outbox.delay()
+    except Exception:
+        # The beat sweep will deliver it
+        logger.warning("Could not queue outbox delivery", exc_info=True)
+
+
+def to_row(message):
+    """An unsaved ``OutboxMessage`` holding ``message``"""
+    attachments = []
+    for attachment in message.attachments:
+        if not isinstance(attachment, tuple):
+            raise ValueError("The outbox only stores (filename, content, mimetype) attachments")
+        filename, content, mimetype = attachment
+        if isinstance(content, str):
+            content = content.encode()
+        attachments.append([filename, base64.b64encode(content).decode("ascii"), mimetype])
+    return OutboxMessage(
+        subject=str(message.subject),
+        body=str(message.body),
+        content_subtype=message.content_subtype,
+        from_email=str(message.from_email or ""),
+        to=[str(address) for address in message.to],
+        cc=[str(address) for address in message.cc],
+        bcc=[str(address) for address in message.bcc],
+        reply_to=[str(address) for address in message.reply_to],
+        headers={str(name): str(value) for name, value in message.extra_headers.items()},
+        alternatives=[[str(content), mimetype] for content, mimetype in getattr(message, "alternatives", [])],
+        attachments=attachments,
+        recipients=", ".join(message.recipients()),
+    )
+
+
+def build_message(row, connection=None):
+    """The email stored in ``row``, ready to send over ``connection``"""
+    message = EmailMultiAlternatives(
+        subject=row.subject,
+        body=row.body,
+        from_email=row.from_email or None,
+        to=row.to,
+        cc=row.cc,
+        bcc=row.bcc,
+        reply_to=row.reply_to,
+        headers=row.headers,
+        alternatives=[tuple(alternative) for alternative in row.alternatives],
+        connection=connection,
+    )
+    message.content_subtype = row.content_subtype
+    for filename, content, mimetype in row.attachments:
+        message.attach(filename, base64.b64decode(content), mimetype)
+    return message
+
+
+class OutboxBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        rows = [to_row(message) for message in email_messages if message.recipients()]
+        if rows:
+            OutboxMessage.objects.bulk_create(rows)
+            transaction.on_commit(_schedule_delivery)
+        return len(rows)
+
+
+def retry_delay(attempts):
+    """Seconds before attempt ``attempts + 1``: exponential, capped, with jitter"""
+    delay = min(settings.OUTBOX_RETRY_BACKOFF * 2 ** (attempts - 1), settings.OUTBOX_RETRY_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def claim_batch(batch_size=None):
+    """Lease up to ``batch_size`` due messages to this worker"""
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(status="pending", next_attempt_at__lte=now)
+            .order_by("next_attempt_at", "id")[: batch_size or settings.OUTBOX_BATCH_SIZE]
+        )
+        if batch:
+            lease = now + timedelta(seconds=settings.OUTBOX_CLAIM_TIMEOUT)
+            OutboxMessage.objects.filter(pk__in=[row.pk for row in batch]).update(next_attempt_at=lease)
+    return batch
+
+
+def deliver(batch):
+    """Send a claimed batch over one connection. Returns (sent, retrying, failed)"""
+    sent = retrying = failed = 0
+    open_error = None
+    connection = get_connection(settings.OUTBOX_DELIVERY_BACKEND, fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:
+        # Nothing can go out; every message in the batch is retried
+        logger.warning("Mail server unavailable: %s", e)
+        connection = None
+        open_error = e
+    try:
+        for row in batch:
+            row.attempts += 1
+            try:
+                if connection is None:
+                    raise open_error
+                build_message(row, connection).send()
+            except Exception as e:
+                row.last_error = f"{type(e).__name__}: {e}"[:2000]
+                if row.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                    row.status = "failed"
+                    failed += 1
+                    logger.error("Giving up on outbox message %s: %s", row.pk, row.last_error)
+                else:
+                    row.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(row.attempts))
+                    retrying += 1
+                if connection is not None:
+                    # The connection may be unusable after an error; start a fresh one
+                    connection.close()
+                    try:
+                        connection.open()
+                    except Exception:
+                        connection = None
+                        open_error = e
+            else:
+                row.status = "sent"
+                row.sent_at = timezone.now()
+                row.last_error = ""
+                sent += 1
+    finally:
+        if connection is not None:
+            connection.close()
+    OutboxMessage.objects.bulk_update(batch, ["status", "attempts", "next_attempt_at", "last_error", "sent_at"])
+    return sent, retrying, failed
@@ -0,0 +1,82 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection
+
+from financeapp import ledger
+from financeapp.models import Account, Transaction
+
+SQLITE_BUSY_RETRIES = 100
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure concurrent income postings to one account, with the balance row "
+        "locked per posting versus credits spread over balance shards, at rising "
+        "thread counts"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", default="1,2,4,8,16", help="Comma-separated concurrency levels")
+        parser.add_argument("--postings", type=int, default=100, help="Postings per thread")
+        parser.add_argument("--shards", type=int, default=settings.BALANCE_SHARDS)
+        parser.add_argument("--keep", action="store_true", help="Keep the benchmark user and its data afterwards")
+
+    def handle(self, *args, **options):
+        levels = [int(level) for level in options["threads"].split(",")]
+        if connection.vendor == "sqlite":
+            self.stdout.write(self.style.WARNING("SQLite serializes all writers; expect no scaling in either mode"))
+        user = get_user_model().objects.create_user(f"accumulator-bench-{int(time.time() * 1000)}")
+        try:
+            self.stdout.write(f"{'threads':>8} {'locked/s':>12} {'sharded/s':>12} {'speedup':>8}")
+            for level in levels:
+                locked = self.run(user, level, options["postings"], shards=0)
+                sharded = self.run(user, level, options["postings"], shards=options["shards"])
+                self.stdout.write(f"{level:>8} {locked:>12.1f} {sharded:>12.1f} {sharded / locked:>7.2f}x")
+        finally:
+            if not options["keep"]:
+                Transaction.objects.filter(user=user).delete()
+                user.delete()
+
+    def run(self, user, threads, postings, shards):
+        """Postings per second into a fresh account; checks nothing was lost"""
+        account = Account.objects.create(
+            user=user, name=f"Collection {time.time_ns()}", account_type="Bank", account_number=str(time.time_ns())[-16:]
+        )
+        ledger.set_balance_shards([account], shards)
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(postings):
+                    for _ in range(SQLITE_BUSY_RETRIES):
+                        try:
+                            Transaction.objects.create(
+                                user=user, account_id=account.pk, transaction_type="income", amount=Decimal("1.00")
+                            )
+                            break
+                        except DatabaseError as e:
+                            if "database is locked" not in str(e):
+                                errors.append(e)
+                                break
+                            time.sleep(0.005)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        ledger.compact_balance_shards([account])
+        account.refresh_from_db()
+        if errors or account.balance != threads * postings:
+            raise CommandError(f"Balance {account.balance}, expected {threads * postings}; errors: {errors[:3]}")
+        return threads * postings / elapsed
@@ -0,0 +1,51 @@
+import os
+import shlex
+import signal
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from financeapp.queues import POOL_ENV, worker_argv
+
+
+class Command(BaseCommand):
+    help = (
+        "Show or start the Celery worker pools defined in WORKER_POOLS, each "
+        "consuming its own queues with its own concurrency and rate limit"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("pools", nargs="*", help="Pools to include (default: all)")
+        parser.add_argument("--run", action="store_true", help="Start the pools and wait for them")
+        parser.add_argument("--loglevel", default="info")
+
+    def handle(self, *args, **options):
+        names = options["pools"] or list(settings.WORKER_POOLS)
+        unknown = [name for name in names if name not in settings.WORKER_POOLS]
+        if unknown:
+            raise CommandError(f"Unknown pool(s): {', '.join(unknown)}. Known: {', '.join(settings.WORKER_POOLS)}")
+
+        commands = {name: worker_argv(name) + ["-l", options["loglevel"]] for name in names}
+        if not options["run"]:
+            for name, argv in commands.items():
+                pool = settings.WORKER_POOLS[name]
+                self.stdout.write(f"# {name}: rate limit {pool.get('rate_limit') or 'none'}")
+                self.stdout.write(f"{POOL_ENV}={name} {shlex.join(argv)}")
+            return
+
+        processes = {
+            name: subprocess.Popen(argv, env={**os.environ, POOL_ENV: name}) for name, argv in commands.items()
+        }
+        self.stdout.write(f"Started pools: {', '.join(f'{n} (pid {p.pid})' for n, p in processes.items())}")
+
+        def stop(signum, frame):
+            for process in processes.values():
+                if process.poll() is None:
+                    process.send_signal(signum)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for name, process in processes.items():
+            code = process.wait()
+            self.stdout.write(f"Pool {name} exited with {code}")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from financeapp import chat_cache
+
+
+class Command(BaseCommand):
+    help = "Show chat response cache hits, misses, bypasses and hit rate across local workers"
+
+    def handle(self, *args, **options):
+        stats = chat_cache.stats()
+        self.stdout.write(f"hits      {stats['hit']}")
+        self.stdout.write(f"misses    {stats['miss']}")
+        self.stdout.write(f"bypassed  {stats['bypass']} (personal prompts)")
+        self.stdout.write(f"hit rate  {stats['hit_rate']:.1%}")
@@ -0,0 +1,137 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """Minimal Ollama ``/api/chat``: one JSON reply, or NDJSON chunks when streaming"""
+
+    protocol_version = "HTTP/1.1"
+    options = {}
+
+    def log_message(self, format, *args):
+        if self.options.get("verbose"):
+            super().log_message(format, *args)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/api/chat":
+            self.send_error(404)
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.send_error(400)
+            return
+
+        messages = body.get("messages") or [{}]
+        prompt = messages[-1].get("content", "")
+        tokens = self.reply_tokens(prompt)
+        model = body.get("model", "fake")
+
+        time.sleep(self.options["first_token_delay"])
+        if body.get("stream", True):
+            self.stream(model, tokens)
+        else:
+            time.sleep(self.options["token_delay"] * len(tokens))
+            self.send_json(
+                {"model": model, "message": {"role": "assistant", "content": "".join(tokens)}, "done": True}
+            )
+
+    def reply_tokens(self, prompt):
+        words = (f"You said: {prompt}. " * self.options["tokens"]).split()[: self.options["tokens"]]
+        return [word + " " for word in words]
+
+    def send_json(self, data):
+        payload = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def stream(self, model, tokens):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i, token in enumerate(tokens):
+                if i == self.options.get("malformed_after"):
+                    line = b'{"model": "' + model.encode() + b'", "message": {"content": \n'
+                    self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                self.write_chunk({"model": model, "message": {"role": "assistant", "content": token}, "done": False})
+                time.sleep(self.options["token_delay"])
+            self.write_chunk({"model": model, "message": {"role": "assistant", "content": ""}, "done": True})
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The proxy closed the stream (client disconnected)
+            if self.options.get("verbose"):
+                self.log_message("stream closed by client after partial reply")
+
+    def write_chunk(self, data):
+        line = json.dumps(data).encode() + b"\n"
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    @property
+    def chat_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/chat"
+
+
+def build_fake_llm(
+    host="127.0.0.1", port=0, tokens=40, token_delay=0.05, first_token_delay=0.3, malformed_after=None, verbose=False
+):
+    """A ``FakeLLMServer``; port 0 picks a free one"""
+    options = {
+        "tokens": tokens,
+        "token_delay": token_delay,
+        "first_token_delay": first_token_delay,
+        "malformed_after": malformed_after,
+        "verbose": verbose,
+    }
+    handler = type("Handler", (FakeLLMHandler,), {"options": options})
+    return FakeLLMServer((host, port), handler)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a stand-in for the local LLM (Ollama /api/chat) that replies with "
+        "canned tokens at a configurable pace, for exercising the chat proxy"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=11434)
+        parser.add_argument("--tokens", type=int, default=40, help="Tokens per reply")
+        parser.add_argument("--token-delay", type=float, default=0.05, help="Seconds between tokens")
+        parser.add_argument("--first-token-delay", type=float, default=0.3, help="Seconds before the first token")
+        parser.add_argument(
+            "--malformed-after", type=int, help="Send a line that isn't JSON after this many streamed tokens"
+        )
+        parser.add_argument("--verbose", action="store_true", help="Log every request")
+
+    def handle(self, *args, **options):
+        server = build_fake_llm(
+            options["host"],
+            options["port"],
+            tokens=options["tokens"],
+            token_delay=options["token_delay"],
+            first_token_delay=options["first_token_delay"],
+            malformed_after=options["malformed_after"],
+            verbose=options["verbose"],
+        )
+        self.stdout.write(f"Fake LLM listening on {server.chat_url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
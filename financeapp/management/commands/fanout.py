@@ -0,0 +1,100 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from financeapp import jobs
+from financeapp.models import FanOutJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Launch and watch chunked per-user jobs (see financeapp.jobs). "
+        "Actions: start KIND, list, watch JOB, resume JOB, cancel JOB"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["start", "list", "watch", "resume", "cancel"])
+        parser.add_argument("target", nargs="?", help="Job kind for start, job id otherwise")
+        parser.add_argument("--chunk-size", type=int, help="Users per chunk (default FANOUT_CHUNK_SIZE)")
+        parser.add_argument("--param", action="append", default=[], help="Handler parameter as key=value")
+        parser.add_argument("--watch", action="store_true", help="Keep printing progress until the job finishes")
+        parser.add_argument(
+            "--inline", action="store_true", help="Run the chunks in this process instead of on Celery workers"
+        )
+        parser.add_argument("--interval", type=float, default=2.0, help="Seconds between progress lines")
+
+    def handle(self, *args, **options):
+        action = options["action"]
+        if action == "list":
+            return self.list_jobs()
+        if not options["target"]:
+            raise CommandError(f"{action} needs a {'job kind' if action == 'start' else 'job id'}")
+
+        if action == "start":
+            params = dict(item.split("=", 1) for item in options["param"])
+            try:
+                job = jobs.start(
+                    options["target"], options["chunk_size"], params, dispatch_chunks=not options["inline"]
+                )
+            except ValueError as e:
+                raise CommandError(e)
+            self.stdout.write(f"Started {job.kind} job #{job.pk}: {job.total_chunks} chunks of {job.chunk_size} users")
+        else:
+            job = self.get_job(options["target"])
+            if action == "cancel":
+                cancelled = jobs.cancel(job)
+                self.stdout.write(f"Job #{job.pk} {'cancelled' if cancelled else 'was not running'}")
+                return
+            if action == "resume":
+                count = jobs.resume(job, dispatch_chunks=not options["inline"])
+                self.stdout.write(f"Resumed job #{job.pk}: {count} chunks re-queued")
+
+        if options["inline"] and action in ("start", "resume"):
+            self.run_inline(job, options["interval"])
+        elif options["watch"] or action == "watch":
+            self.watch(job, options["interval"])
+
+    def get_job(self, job_id):
+        try:
+            return FanOutJob.objects.get(pk=job_id)
+        except (FanOutJob.DoesNotExist, ValueError):
+            raise CommandError(f"No job {job_id}")
+
+    def list_jobs(self):
+        for job in FanOutJob.objects.all()[:20]:
+            self.stdout.write(
+                f"#{job.pk} {job.kind} {job.status}: {job.done_chunks}/{job.total_chunks} chunks done, "
+                f"{job.failed_chunks} failed, {job.users_processed} users, started {job.created_at:%Y-%m-%d %H:%M}"
+            )
+
+    def progress_line(self, job):
+        info = jobs.progress(job)
+        chunks = info["chunks"]
+        return (
+            f"#{job.pk} {job.kind} {job.status}: {chunks['done']}/{job.total_chunks} done, "
+            f"{chunks['running']} running, {chunks['pending']} pending, {chunks['failed']} failed, "
+            f"{info['users_processed']} users ({info['users_per_second']:.1f}/s)"
+        )
+
+    def watch(self, job, interval):
+        while True:
+            self.stdout.write(self.progress_line(job))
+            if job.status != "running":
+                return
+            time.sleep(interval)
+
+    def run_inline(self, job, interval):
+        last_report = 0.0
+        for chunk_id in job.chunks.filter(status="pending").values_list("pk", flat=True):
+            while jobs.db_busy():
+                self.stdout.write(f"Database busy; waiting {settings.FANOUT_THROTTLE_DELAY}s")
+                time.sleep(settings.FANOUT_THROTTLE_DELAY)
+            try:
+                jobs.run_chunk(chunk_id)
+            except Exception as e:
+                self.stderr.write(f"Chunk {chunk_id} failed: {e}")
+            if time.monotonic() - last_report >= interval:
+                last_report = time.monotonic()
+                self.stdout.write(self.progress_line(job))
+        self.stdout.write(self.progress_line(job))
@@ -0,0 +1,94 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import connection, migrations, models
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+
+from financeapp import index_advisor
+from financeapp.models import Account, Transaction
+
+
+class Command(BaseCommand):
+    help = (
+        "EXPLAIN the app's hot Transaction query shapes, report full scans and "
+        "filesorts, and propose covering composite indexes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="User id to plug into the queries (default: busiest user)")
+        parser.add_argument("--show-plans", action="store_true", help="Print the raw plan for every query")
+        parser.add_argument(
+            "--write-migration",
+            action="store_true",
+            help="Generate a migration adding the proposed indexes",
+        )
+
+    def handle(self, *args, **options):
+        user_id = options["user"] or self.busiest_user()
+        account = Account.objects.filter(user_id=user_id).only("id").first()
+        account_id = account.id if account else 0
+
+        self.stdout.write(f"Backend: {connection.vendor}, sample user id: {user_id}\n")
+        findings, proposals = index_advisor.run(user_id, account_id)
+
+        for finding in findings:
+            shape = finding["shape"]
+            issues = sorted(finding["issues"])
+            style = self.style.WARNING if set(issues) & {"full_scan", "filesort"} else self.style.SUCCESS
+            self.stdout.write(style(f"{shape.name:<22} {', '.join(issues) or 'ok'}"))
+            self.stdout.write(f"{'':<23}{shape.source}")
+            if options["show_plans"]:
+                for line in str(finding["plan"]).splitlines():
+                    self.stdout.write(f"{'':<27}{line}")
+
+        if not proposals:
+            self.stdout.write(self.style.SUCCESS("\nEvery query shape is served by an existing index."))
+            return
+
+        self.stdout.write("\nProposed covering indexes:")
+        for fields, shapes in proposals.items():
+            self.stdout.write(
+                f"  models.Index(fields={list(fields)!r}, name={index_advisor.index_name(fields)!r})"
+                f"  # {', '.join(shapes)}"
+            )
+
+        if options["write_migration"]:
+            path = self.write_migration(proposals)
+            self.stdout.write(self.style.SUCCESS(f"\nMigration written to {path}"))
+            self.stdout.write("Add the same models.Index entries to Transaction.Meta.indexes.")
+
+    def busiest_user(self):
+        row = (
+            Transaction.objects.order_by()
+            .values("user_id")
+            .annotate(n=models.Count("id"))
+            .order_by("-n")
+            .first()
+        )
+        return row["user_id"] if row else 0
+
+    def write_migration(self, proposals):
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        leaf = loader.graph.leaf_nodes("financeapp")[0]
+        number = int(leaf[1].split("_")[0]) + 1
+
+        migration = type(
+            "Migration",
+            (migrations.Migration,),
+            {
+                "dependencies": [leaf],
+                "operations": [
+                    migrations.AddIndex(
+                        model_name="transaction",
+                        index=models.Index(fields=list(fields), name=index_advisor.index_name(fields)),
+                    )
+                    for fields in proposals
+                ],
+            },
+        )("%04d_transaction_covering_indexes" % number, "financeapp")
+
+        writer = MigrationWriter(migration)
+        with open(writer.path, "w", encoding="utf-8") as f:
+            f.write(writer.as_string())
+        return os.path.relpath(writer.path)
@@ -0,0 +1,193 @@
+import linecache
+import tracemalloc
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import RequestFactory
+from django.utils import timezone
+
+from financeapp import views
+from financeapp.models import Account, Transaction
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    """Raised to discard the generated data at the end of each run"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure peak memory of the CSV export and admin bulk actions against "
+        "generated data of increasing size, and fail on super-linear growth"
+    )
+
+    targets = {
+        "export_csv": "run_export_csv",
+        "recalculate_balances": "run_recalculate_balances",
+        "categorize_as_other": "run_categorize_as_other",
+        "export_selected_transactions": "run_export_selected",
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default=",".join(str(n) for n in settings.MEMPROFILE_SIZES),
+            help="Comma separated transaction counts, smallest first (baseline)",
+        )
+        parser.add_argument("--targets", default=",".join(self.targets), help="Comma separated targets")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=settings.MEMPROFILE_TOLERANCE,
+            help="Allowed factor over linear growth from the baseline size",
+        )
+        parser.add_argument("--top", type=int, default=5, help="Allocation sites to show per run")
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Run even when DEBUG is off (data is generated and rolled back in the live DB)",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options["force"]:
+            raise CommandError("Refusing to generate profiling data with DEBUG off; pass --force to override.")
+
+        sizes = sorted(int(n) for n in options["sizes"].split(","))
+        targets = [t.strip() for t in options["targets"].split(",") if t.strip()]
+        unknown = set(targets) - set(self.targets)
+        if unknown:
+            raise CommandError(f"Unknown targets: {', '.join(sorted(unknown))}")
+
+        self.factory = RequestFactory()
+        results = {target: [] for target in targets}
+
+        for size in sizes:
+            for target in targets:
+                peak, top_stats = self.profile(target, size, options["top"])
+                results[target].append((size, peak))
+                self.stdout.write(f"{target:<30} rows={size:<8} peak={peak / 1024:>10.1f} KiB")
+                for stat in top_stats:
+                    frame = stat.traceback[0]
+                    line = linecache.getline(frame.filename, frame.lineno).strip()
+                    self.stdout.write(
+                        f"{'':<32}{stat.size / 1024:>8.1f} KiB  {frame.filename}:{frame.lineno}  {line[:70]}"
+                    )
+
+        failures = self.check_growth(results, options["tolerance"])
+        if failures:
+            for failure in failures:
+                self.stderr.write(self.style.ERROR(failure))
+            failed = sorted({failure.split(":")[0] for failure in failures})
+            raise CommandError(f"Peak memory grows faster than linearly for: {', '.join(failed)}")
+        self.stdout.write(self.style.SUCCESS("Peak memory grows at most linearly for every target."))
+
+    # ----------------- Measurement -----------------
+    def profile(self, target, size, top):
+        """Generate ``size`` transactions, run the target under tracemalloc, roll back"""
+        runner = getattr(self, self.targets[target])
+        measured = {}
+        try:
+            with transaction.atomic():
+                user = self.generate(size)
+                tracemalloc.start()
+                tracemalloc.reset_peak()
+                try:
+                    runner(user)
+                    snapshot = tracemalloc.take_snapshot()
+                    _, measured["peak"] = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                measured["top"] = snapshot.filter_traces(
+                    [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen *>")]
+                ).statistics("lineno")[:top]
+                raise Rollback
+        except Rollback:
+            pass
+        return measured["peak"], measured["top"]
+
+    def generate(self, size):
+        stamp = timezone.now().strftime("%Y%m%d%H%M%S%f")
+        user = User.objects.create(username=f"memprofile-{stamp}")
+        account_count = max(1, size // 1000)
+        accounts = Account.objects.bulk_create(
+            Account(
+                user=user,
+                name=f"Profile {i}",
+                account_type="Bank",
+                account_number=f"MP{stamp[-12:]}{i:06d}",
+            )
+            for i in range(account_count)
+        )
+        today = timezone.now().date()
+        types = ("income", "expense", "expense", "transfer") if account_count > 1 else ("income", "expense")
+        batch = []
+        for i in range(size):
+            transaction_type = types[i % len(types)]
+            # Each account gets whole income/expense/transfer cycles
+            index = (i // len(types)) % account_count
+            batch.append(
+                Transaction(
+                    user=user,
+                    account=accounts[index],
+                    to_account=accounts[(index + 1) % account_count] if transaction_type == "transfer" else None,
+                    transaction_type=transaction_type,
+                    # Income dominates so recalculated balances stay positive
+                    amount=Decimal(5000) if transaction_type == "income" else Decimal(10 + i % 500),
+                    date=today - timedelta(days=i % 365),
+                    description=f"Generated transaction {i}",
+                    category="salary" if transaction_type == "income" else "food",
+                )
+            )
+            if len(batch) >= 2000:
+                Transaction.objects.bulk_create(batch)
+                batch = []
+        Transaction.objects.bulk_create(batch)
+        return user
+
+    def request(self, user, path="/"):
+        request = self.factory.get(path)
+        request.user = user
+        request._messages = CookieStorage(request)
+        return request
+
+    def run_export_csv(self, user):
+        response = views.export_transactions_csv(self.request(user, "/export-csv/"))
+        assert response.status_code == 200
+
+    def run_recalculate_balances(self, user):
+        model_admin = admin.site._registry[Account]
+        model_admin.recalculate_balances(self.request(user), Account.objects.filter(user=user))
+
+    def run_categorize_as_other(self, user):
+        model_admin = admin.site._registry[Transaction]
+        model_admin.categorize_as_other(self.request(user), Transaction.objects.filter(user=user))
+
+    def run_export_selected(self, user):
+        model_admin = admin.site._registry[Transaction]
+        model_admin.export_selected_transactions(self.request(user), Transaction.objects.filter(user=user))
+
+    # ----------------- Growth check -----------------
+    def check_growth(self, results, tolerance):
+        """
+        Extrapolate linearly from the smallest run (the baseline) and flag any
+        larger run whose peak exceeds that line by more than ``tolerance``.
+        """
+        failures = []
+        floor = settings.MEMPROFILE_MIN_BASELINE_BYTES
+        for target, runs in results.items():
+            base_size, base_peak = runs[0]
+            for size, peak in runs[1:]:
+                allowed = max(base_peak, floor) * (size / base_size) * tolerance
+                if peak > allowed:
+                    failures.append(
+                        f"{target}: {peak / 1024:.1f} KiB at {size} rows, "
+                        f"linear allowance {allowed / 1024:.1f} KiB from {base_size} rows"
+                    )
+        return failures
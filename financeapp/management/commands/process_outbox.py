@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from financeapp.mail import claim_batch, deliver
+from financeapp.models import OutboxMessage
+
+
+class Command(BaseCommand):
+    help = "Deliver all due outbox mail now, batch by batch, without a Celery worker"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Messages per SMTP connection (default OUTBOX_BATCH_SIZE)")
+        parser.add_argument(
+            "--retry-failed", action="store_true", help="Give messages that exhausted their attempts another round"
+        )
+
+    def handle(self, *args, **options):
+        if options["retry_failed"]:
+            revived = OutboxMessage.objects.filter(status="failed").update(status="pending", attempts=0)
+            self.stdout.write(f"Requeued {revived} failed messages")
+
+        totals = [0, 0, 0]
+        batches = 0
+        while True:
+            batch = claim_batch(options["batch_size"])
+            if not batch:
+                break
+            batches += 1
+            for i, count in enumerate(deliver(batch)):
+                totals[i] += count
+        sent, retrying, failed = totals
+        self.stdout.write(
+            self.style.SUCCESS(f"{sent} sent, {retrying} to retry, {failed} failed in {batches} batches")
+        )
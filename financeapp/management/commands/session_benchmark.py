@@ -0,0 +1,109 @@
+import random
+import time
+from importlib import import_module
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+ENGINES = {
+    "db": "django.contrib.sessions.backends.db",
+    "cached_db": "django.contrib.sessions.backends.cached_db",
+    "financeapp": "financeapp.sessions",
+}
+
+
+class StatementCounter:
+    """Execute wrapper counting all statements and the ones that write"""
+
+    def __init__(self):
+        self.queries = 0
+        self.writes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        if not sql.lstrip().upper().startswith("SELECT"):
+            self.writes += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a session workload (load on every request, occasional writes) "
+        "against the db, cached_db and financeapp session engines and compare "
+        "per-request latency, DB queries and capacity against a target rate"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--engines", default=",".join(ENGINES), help="Comma separated engines")
+        parser.add_argument("--sessions", type=int, default=200, help="Distinct active sessions")
+        parser.add_argument("--requests", type=int, default=5000, help="Requests replayed per engine")
+        parser.add_argument("--write-ratio", type=float, default=0.05, help="Requests that change the session")
+        parser.add_argument(
+            "--noop-write-ratio",
+            type=float,
+            default=0.3,
+            help="Requests that re-assign a key to its current value (marks the session modified)",
+        )
+        parser.add_argument("--rps", type=float, default=50.0, help="Target request rate per worker")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in options["engines"].split(",") if name.strip()]
+        unknown = set(names) - set(ENGINES)
+        if unknown:
+            raise CommandError(f"Unknown engines: {', '.join(sorted(unknown))}")
+
+        self.stdout.write(
+            f"{'engine':<12}{'p50 ms':>9}{'p99 ms':>9}{'queries/req':>13}{'writes':>8}{'capacity rps':>14}{'headroom':>10}"
+        )
+        for name in names:
+            store_class = import_module(ENGINES[name]).SessionStore
+            keys = self.seed_sessions(store_class, options["sessions"])
+            try:
+                result = self.replay(store_class, keys, options)
+            finally:
+                for key in keys:
+                    store_class(key).delete()
+
+            latencies = sorted(result["latencies"])
+            capacity = len(latencies) / sum(latencies)
+            self.stdout.write(
+                f"{name:<12}"
+                f"{latencies[len(latencies) // 2] * 1000:>9.3f}"
+                f"{latencies[int(len(latencies) * 0.99)] * 1000:>9.3f}"
+                f"{result['queries'] / len(latencies):>13.2f}"
+                f"{result['writes']:>8}"
+                f"{capacity:>14.0f}"
+                f"{capacity / options['rps']:>9.1f}x"
+            )
+
+    def seed_sessions(self, store_class, count):
+        keys = []
+        for i in range(count):
+            store = store_class()
+            store["_auth_user_id"] = str(i)
+            store["theme"] = "dark"
+            store.create()
+            keys.append(store.session_key)
+        return keys
+
+    def replay(self, store_class, keys, options):
+        """One iteration mimics SessionMiddleware: load, maybe modify, save if modified"""
+        rng = random.Random(options["seed"])
+        latencies = []
+        counter = StatementCounter()
+        with connection.execute_wrapper(counter):
+            for i in range(options["requests"]):
+                key = rng.choice(keys)
+                roll = rng.random()
+                started = time.perf_counter()
+                store = store_class(key)
+                store.get("_auth_user_id")
+                if roll < options["write_ratio"]:
+                    store["last_seen"] = i
+                elif roll < options["write_ratio"] + options["noop_write_ratio"]:
+                    store["theme"] = store.get("theme")
+                if store.modified:
+                    store.save()
+                latencies.append(time.perf_counter() - started)
+        return {"latencies": latencies, "queries": counter.queries, "writes": counter.writes}
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from financeapp import slow_queries
+
+
+class Command(BaseCommand):
+    help = "Summarize the slow-query log into a top-N by total time report"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=20, help="Number of fingerprints to report")
+
+    def handle(self, *args, **options):
+        path = slow_queries.write_report(top=options["top"])
+        for item in slow_queries.build_report(top=options["top"]):
+            self.stdout.write(
+                f"{item['total_ms']:>12.1f} ms  {item['count']:>6}x  "
+                f"max {item['max_ms']:.1f} ms  [{item['fingerprint']}] {item['sql'][:120]}"
+            )
+            self.stdout.write(f"{'':>14}{', '.join(item['locations'])}")
+        self.stdout.write(self.style.SUCCESS(f"Report written to {path}"))
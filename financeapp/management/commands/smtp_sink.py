@@ -0,0 +1,140 @@
+import os
+import random
+import socketserver
+import threading
+import time
+from email import message_from_bytes, policy
+
+from django.core.management.base import BaseCommand
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept mail from Django's SMTP backend and keep it"""
+
+    options = {}
+    state = {}
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        with self.state["lock"]:
+            self.state["connections"] += 1
+        self.reply("220 wealthywise-sink ESMTP")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.reply("250-wealthywise-sink")
+                self.reply("250 8BITMIME")
+            elif verb == "HELO":
+                self.reply("250 wealthywise-sink")
+            elif verb == "MAIL":
+                sender, recipients = command[10:].strip(), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command[8:].strip())
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = self.read_data()
+                time.sleep(self.options["delay"])
+                if random.random() < self.options["fail_rate"]:
+                    self.reply("451 Temporary failure, try again later")
+                else:
+                    self.store(sender, recipients, data)
+                    self.reply("250 OK: queued")
+                sender, recipients = None, []
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+    def read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line in (b".\r\n", b".\n"):
+                break
+            lines.append(line[1:] if line.startswith(b"..") else line)
+        return b"".join(lines)
+
+    def store(self, sender, recipients, data):
+        subject = message_from_bytes(data, policy=policy.default)["Subject"]
+        with self.state["lock"]:
+            self.state["messages"] += 1
+            number = self.state["messages"]
+            self.state["received"].append({"sender": sender, "recipients": recipients, "subject": subject})
+        if self.options["outdir"]:
+            path = os.path.join(self.options["outdir"], f"{int(time.time() * 1000)}-{number}.eml")
+            with open(path, "wb") as f:
+                f.write(data)
+        if self.options["verbosity"] >= 1 and self.state["write"]:
+            self.state["write"](
+                f"#{number} (connection {self.state['connections']}) {sender} -> {', '.join(recipients)}: {subject}"
+            )
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def build_sink(host="127.0.0.1", port=0, outdir=None, delay=0.0, fail_rate=0.0, verbosity=1, write=None):
+    """
+    An ``SMTPSink``; port 0 picks a free one. ``server.state`` counts
+    connections and keeps each accepted message's envelope and subject
+    under "received", and ``server.options`` can be changed while it runs.
+    """
+    options = {"outdir": outdir, "delay": delay, "fail_rate": fail_rate, "verbosity": verbosity}
+    state = {"connections": 0, "messages": 0, "received": [], "lock": threading.Lock(), "write": write}
+    handler = type("Handler", (SMTPSinkHandler,), {"options": options, "state": state})
+    server = SMTPSink((host, port), handler)
+    server.options, server.state = options, state
+    return server
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local SMTP server that accepts and records every message, for "
+        "exercising the mail outbox. Use with EMAIL_HOST=127.0.0.1 "
+        "EMAIL_PORT=<port> EMAIL_USE_TLS=false"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=1025)
+        parser.add_argument("--outdir", help="Write each message to this directory as an .eml file")
+        parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before accepting a message")
+        parser.add_argument(
+            "--fail-rate", type=float, default=0.0, help="Fraction of messages answered with a 451 temporary failure"
+        )
+
+    def handle(self, *args, **options):
+        if options["outdir"]:
+            os.makedirs(options["outdir"], exist_ok=True)
+        server = build_sink(
+            options["host"],
+            options["port"],
+            outdir=options["outdir"],
+            delay=options["delay"],
+            fail_rate=options["fail_rate"],
+            verbosity=options["verbosity"],
+            write=self.stdout.write,
+        )
+        state = server.state
+        self.stdout.write(f"SMTP sink listening on {options['host']}:{options['port']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"{state['messages']} messages over {state['connections']} connections")
@@ -0,0 +1,168 @@
+import itertools
+import json
+from collections import Counter
+import secrets
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.core.management.base import BaseCommand
+
+
+class StubOAuthHandler(BaseHTTPRequestHandler):
+    """Google's discovery, authorization, token, certs and userinfo endpoints, in miniature"""
+
+    protocol_version = "HTTP/1.1"
+    options = {}
+    state = {}
+
+    def log_message(self, format, *args):
+        if self.options.get("verbose"):
+            super().log_message(format, *args)
+
+    @property
+    def base_url(self):
+        return f"http://{self.headers.get('Host')}"
+
+    def should_fail(self):
+        every = self.options["fail_every"]
+        return every and next(self.state["counter"]) % every == every - 1
+
+    def do_GET(self):
+        time.sleep(self.options["latency"])
+        url = urlparse(self.path)
+        self.state["hits"][url.path] += 1
+        if url.path != "/o/oauth2/v2/auth" and self.should_fail():
+            self.send_json({"error": "backend_error"}, status=503)
+        elif url.path == "/.well-known/openid-configuration":
+            self.send_json(
+                {
+                    "issuer": self.base_url,
+                    "authorization_endpoint": f"{self.base_url}/o/oauth2/v2/auth",
+                    "token_endpoint": f"{self.base_url}/token",
+                    "userinfo_endpoint": f"{self.base_url}/v1/userinfo",
+                    "jwks_uri": f"{self.base_url}/oauth2/v3/certs",
+                },
+                max_age=3600,
+            )
+        elif url.path == "/oauth2/v3/certs":
+            self.send_json({"keys": [self.state["jwk"]]}, max_age=3600)
+        elif url.path == "/o/oauth2/v2/auth":
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            code = secrets.token_urlsafe(16)
+            self.state["codes"][code] = query.get("client_id", "")
+            params = {"code": code, **({"state": query["state"]} if "state" in query else {})}
+            self.send_response(302)
+            self.send_header("Location", f"{query.get('redirect_uri', '/')}?{urlencode(params)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif url.path == "/v1/userinfo":
+            if not self.headers.get("Authorization", "").startswith("Bearer "):
+                self.send_json({"error": "invalid_token"}, status=401)
+            else:
+                self.send_json(self.profile())
+        else:
+            self.send_json({"error": "not_found"}, status=404)
+
+    def do_POST(self):
+        time.sleep(self.options["latency"])
+        length = int(self.headers.get("Content-Length", 0))
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        self.state["hits"][urlparse(self.path).path] += 1
+        if urlparse(self.path).path != "/token":
+            self.send_json({"error": "not_found"}, status=404)
+            return
+        client_id = self.state["codes"].pop(form.get("code"), None)
+        if client_id is None or form.get("grant_type") != "authorization_code":
+            self.send_json({"error": "invalid_grant"}, status=400)
+            return
+        now = int(time.time())
+        claims = {
+            "iss": self.base_url,
+            "aud": form.get("client_id") or client_id,
+            "sub": "1000",
+            "iat": now,
+            "exp": now + 3600,
+            "email_verified": True,
+            **self.profile(),
+        }
+        id_token = jwt.encode(claims, self.state["private_key"], algorithm="RS256", headers={"kid": "stub"})
+        self.send_json(
+            {
+                "access_token": secrets.token_urlsafe(24),
+                "expires_in": 3599,
+                "token_type": "Bearer",
+                "scope": "openid email profile",
+                "id_token": id_token,
+            }
+        )
+
+    def profile(self):
+        return {"email": self.options["email"], "given_name": "Stub", "family_name": "User"}
+
+    def send_json(self, data, status=200, max_age=None):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if max_age:
+            self.send_header("Cache-Control", f"public, max-age={max_age}")
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StubOAuthServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    @property
+    def discovery_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/.well-known/openid-configuration"
+
+
+def build_server(host="127.0.0.1", port=0, email="stub.user@example.com", latency=0.0, fail_every=0, verbose=False):
+    """A ``StubOAuthServer`` with a fresh signing key; port 0 picks a free one. ``server.state["hits"]`` counts requests per path."""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": "stub", "use": "sig", "alg": "RS256"})
+    state = {"private_key": private_key, "jwk": jwk, "codes": {}, "counter": itertools.count(), "hits": Counter()}
+    options = {"email": email, "latency": latency, "fail_every": fail_every, "verbose": verbose}
+    handler = type("Handler", (StubOAuthHandler,), {"options": options, "state": state})
+    server = StubOAuthServer((host, port), handler)
+    server.state = state
+    return server
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in for Google's OAuth/OpenID endpoints. Point "
+        "GOOGLE_DISCOVERY_URL at http://HOST:PORT/.well-known/openid-configuration "
+        "to exercise the sign-in flow offline"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--email", default="stub.user@example.com", help="Email of the signed-in user")
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before each response")
+        parser.add_argument("--fail-every", type=int, default=0, help="Answer every Nth API GET with a 503")
+        parser.add_argument("--verbose", action="store_true", help="Log every request")
+
+    def handle(self, *args, **options):
+        server = build_server(
+            options["host"],
+            options["port"],
+            email=options["email"],
+            latency=options["latency"],
+            fail_every=options["fail_every"],
+            verbose=options["verbose"],
+        )
+        self.stdout.write(f"Stub OAuth listening on {server.discovery_url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,131 @@
+import random
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Sum
+
+from financeapp import ledger
+from financeapp.models import Account, Transaction
+
+SQLITE_BUSY_RETRIES = 100
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer a few accounts with concurrent transfers in both directions, then check "
+        "that no posting deadlocked or was lost: the total is conserved and every balance "
+        "matches its transactions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--transfers", type=int, default=200, help="Transfers per thread")
+        parser.add_argument("--accounts", type=int, default=2, help="Accounts to transfer between")
+        parser.add_argument("--initial", type=Decimal, default=Decimal("100000.00"), help="Opening income per account")
+        parser.add_argument(
+            "--legacy",
+            action="store_true",
+            help="Use unlocked read-modify-write saves instead of Transaction.save, to see what they lose",
+        )
+        parser.add_argument("--keep", action="store_true", help="Keep the stress user and its data afterwards")
+
+    def handle(self, *args, **options):
+        if options["accounts"] < 2:
+            raise CommandError("--accounts must be at least 2")
+        user, accounts = self.seed(options["accounts"], options["initial"])
+        expected_total = options["initial"] * len(accounts)
+        outcomes = Counter()
+        lock = threading.Lock()
+        post = self.post_legacy if options["legacy"] else self.post
+
+        def worker(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(options["transfers"]):
+                    source, destination = rng.sample(accounts, 2)
+                    amount = Decimal(rng.randint(1, 10000)) / 100
+                    for _ in range(SQLITE_BUSY_RETRIES):
+                        try:
+                            post(user, source, destination, amount)
+                            outcome = "posted"
+                        except ValidationError:
+                            outcome = "rejected"
+                        except DatabaseError as e:
+                            # SQLite refuses a second writer instead of queueing it; that isn't a deadlock
+                            if "database is locked" in str(e):
+                                with lock:
+                                    outcomes["retried (sqlite busy)"] += 1
+                                time.sleep(rng.uniform(0.001, 0.01))
+                                continue
+                            outcome = "deadlock" if "deadlock" in str(e).lower() else f"error: {e}"
+                        break
+                    else:
+                        outcome = "gave up (sqlite busy)"
+                    with lock:
+                        outcomes[outcome] += 1
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options["threads"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        total = Account.objects.filter(pk__in=[a.pk for a in accounts]).aggregate(total=Sum("balance"))["total"]
+        drifted = ledger.drift(Account.objects.filter(pk__in=[a.pk for a in accounts]))
+        for outcome, count in outcomes.most_common():
+            self.stdout.write(f"{count:>8}  {outcome}")
+        self.stdout.write(f"{outcomes['posted'] / elapsed:.1f} transfers/s over {elapsed:.1f}s")
+        self.stdout.write(f"Total balance {total} (expected {expected_total})")
+        for row in drifted:
+            self.stdout.write(f"Account {row['account_id']}: stored {row['stored']}, ledger {row['computed']}")
+
+        if not options["keep"]:
+            Transaction.objects.filter(user=user).delete()
+            user.delete()
+
+        if total != expected_total or drifted or outcomes["deadlock"]:
+            raise CommandError("Lost updates or deadlocks detected")
+        self.stdout.write(self.style.SUCCESS("No deadlocks, no lost updates"))
+
+    def seed(self, count, initial):
+        user = get_user_model().objects.create_user(f"transfer-stress-{int(time.time() * 1000)}")
+        accounts = []
+        for i in range(count):
+            account = Account.objects.create(
+                user=user, name=f"Stress {i}", account_type="Bank", account_number=f"{user.pk:010d}{i:04d}"
+            )
+            Transaction.objects.create(user=user, account=account, transaction_type="income", amount=initial)
+            accounts.append(account)
+        return user, accounts
+
+    def post(self, user, source, destination, amount):
+        Transaction.objects.create(
+            user=user, account_id=source.pk, to_account_id=destination.pk, transaction_type="transfer", amount=amount
+        )
+
+    def post_legacy(self, user, source, destination, amount):
+        # What Transaction.save used to do: full-row saves of balances read without a lock
+        with transaction.atomic():
+            source = Account.objects.get(pk=source.pk)
+            destination = Account.objects.get(pk=destination.pk)
+            Transaction.objects.bulk_create(
+                [
+                    Transaction(
+                        user=user, account=source, to_account=destination, transaction_type="transfer", amount=amount
+                    )
+                ]
+            )
+            source.balance -= amount
+            destination.balance += amount
+            destination.save()
+            source.save()
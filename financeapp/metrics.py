@@ -0,0 +1,416 @@
+# financeapp/metrics.py
+"""
+Process-local metrics registry with a Prometheus text exposition renderer.
+
+Every process (gunicorn worker, celery worker) keeps its own counters,
+gauges and histograms in memory and periodically flushes them to
+``<METRICS_DIR>/<pid>-<start time>.json``. The ``/metrics`` view merges
+every file in that directory, so a single scrape sees the whole process
+group without any external service.
+
+The start time in the name keeps a recycled pid from taking over an exited
+process's file. Once a process has exited, a scrape folds its counters and
+histograms into ``archive.json`` and deletes its file, so totals never go
+backwards and the directory doesn't grow with every restart.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# name -> (type, help)
+METRICS = {
+    "financeapp_http_requests_total": ("counter", "HTTP requests by view, method and status."),
+    "financeapp_http_request_duration_seconds": ("histogram", "HTTP request latency by view."),
+    "financeapp_db_queries_total": ("counter", "Database queries executed, by view."),
+    "financeapp_db_query_duration_seconds_total": ("counter", "Time spent in database queries, by view."),
+    "financeapp_cache_requests_total": ("counter", "Cache lookups by cache namespace, tier and result."),
+    "financeapp_celery_task_duration_seconds": ("histogram", "Celery task run time by task and state."),
+    "financeapp_celery_queue_depth": ("gauge", "Messages waiting in each Celery queue."),
+    "financeapp_celery_queue_wait_seconds": ("histogram", "Time Celery messages waited in their queue before starting."),
+    "financeapp_ledger_postings_total": ("counter", "Transactions posted to the ledger, by type."),
+    "financeapp_chat_proxy_duration_seconds": ("histogram", "Latency of the LLM chat proxy by outcome."),
+    "financeapp_chat_first_token_seconds": ("histogram", "Time to the first streamed chat token."),
+    "financeapp_chat_cache_requests_total": ("counter", "Chat response cache lookups (hit, miss, bypass)."),
+    "financeapp_llm_admissions_total": ("counter", "LLM admission decisions (admitted, queued, rejected, timeout)."),
+    "financeapp_llm_queue_wait_seconds": ("histogram", "Time queued chat requests waited for an LLM slot."),
+    "financeapp_llm_in_flight": ("gauge", "Chat generations currently holding an LLM slot (host-wide)."),
+    "financeapp_llm_queued": ("gauge", "Chat requests waiting for an LLM slot (host-wide)."),
+    "financeapp_llm_capacity": ("gauge", "Configured concurrent LLM generations."),
+    "financeapp_llm_utilization": ("gauge", "In-flight generations as a fraction of capacity."),
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _process_start(pid):
+    """Start time of ``pid`` in clock ticks since boot (Linux), None if unknown"""
+    try:
+        with open(f"/proc/{pid}/stat", encoding="ascii", errors="replace") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces; starttime is the 20th field after it
+    try:
+        return int(stat.rsplit(")", 1)[1].split()[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class MetricsRegistry:
+    """In-memory metric store for the current process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._start = _process_start(self._pid) or 0
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._last_flush = 0.0
+
+    def _check_fork(self):
+        # Forked children (celery prefork, gunicorn preload) must not
+        # re-report the parent's values under their own pid.
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._check_fork()
+            key = (name, _labels_key(labels))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._check_fork()
+            self._gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        with self._lock:
+            self._check_fork()
+            key = (name, _labels_key(labels))
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = {"buckets": list(buckets), "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+                self._histograms[key] = hist
+            for i, bound in enumerate(hist["buckets"]):
+                if value <= bound:
+                    hist["counts"][i] += 1
+                    break
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            self._check_fork()
+            return {
+                "pid": self._pid,
+                "start": self._start,
+                "counters": [[n, list(l), v] for (n, l), v in self._counters.items()],
+                "gauges": [[n, list(l), v] for (n, l), v in self._gauges.items()],
+                "histograms": [
+                    [n, list(l), h["buckets"], h["counts"], h["sum"], h["count"]]
+                    for (n, l), h in self._histograms.items()
+                ],
+            }
+
+    def flush_due(self):
+        """Whether a throttled ``flush`` would write now"""
+        return time.monotonic() - self._last_flush >= getattr(settings, "METRICS_FLUSH_INTERVAL", 2.0)
+
+    def flush(self, force=False):
+        """Write this process's metrics to the shared directory (throttled)"""
+        if not force and not self.flush_due():
+            return
+        self._last_flush = time.monotonic()
+
+        directory = settings.METRICS_DIR
+        try:
+            os.makedirs(directory, exist_ok=True)
+            data = self.snapshot()
+            _write_json(os.path.join(directory, f"{data['pid']}-{data['start']}.json"), data)
+        except OSError as e:
+            logger.warning(f"Could not flush metrics to {directory}: {e}")
+
+
+registry = MetricsRegistry()
+inc = registry.inc
+set_gauge = registry.set_gauge
+observe = registry.observe
+flush = registry.flush
+flush_due = registry.flush_due
+
+
+def record_cache_lookup(cache_name, hit, tier="app"):
+    inc("financeapp_cache_requests_total", cache=cache_name, tier=tier, result="hit" if hit else "miss")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _process_alive(data):
+    """Whether the process that wrote ``data`` is still running (not just its pid)"""
+    pid = data.get("pid", 0)
+    if not _pid_alive(pid):
+        return False
+    start = data.get("start")
+    return not start or _process_start(pid) in (start, None)
+
+
+ARCHIVE_NAME = "archive.json"
+# Folded file names are remembered this long, for scrapes that read them just before
+ARCHIVE_FOLDED_TTL = 3600
+
+
+def _read_process_files():
+    """{file name: snapshot} of every process file"""
+    directory = settings.METRICS_DIR
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return {}
+
+    snapshots = {}
+    for name in names:
+        if not name.endswith(".json") or name == ARCHIVE_NAME:
+            continue
+        data = _read_json(os.path.join(directory, name))
+        # None: file being replaced or truncated; it will be complete next scrape
+        if data is not None:
+            snapshots[name] = data
+    return snapshots
+
+
+def _merge(counters, histograms, data):
+    for name, labels, value in data.get("counters", []):
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, buckets, counts, total, count in data.get("histograms", []):
+        key = (name, tuple(map(tuple, labels)))
+        merged = histograms.get(key)
+        if merged is None or merged["buckets"] != buckets:
+            merged = histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        merged["counts"] = [a + b for a, b in zip(merged["counts"], counts)]
+        merged["sum"] += total
+        merged["count"] += count
+
+
+def _serialize(counters, histograms):
+    return {
+        "counters": [[n, list(l), v] for (n, l), v in counters.items()],
+        "histograms": [
+            [n, list(l), h["buckets"], h["counts"], h["sum"], h["count"]] for (n, l), h in histograms.items()
+        ],
+    }
+
+
+def archive_exited():
+    """
+    Fold the counters and histograms of exited processes into the archive
+    and delete their files. The archive is written before a file is deleted
+    and lists it as folded, so a concurrent ``collect`` counts each file
+    exactly once. Returns the number of files folded.
+    """
+    directory = settings.METRICS_DIR
+    try:
+        lock = os.open(os.path.join(directory, "archive.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    except FileNotFoundError:
+        return 0
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another scrape is folding right now
+            return 0
+        path = os.path.join(directory, ARCHIVE_NAME)
+        archive = _read_json(path) or {}
+        folded = archive.get("folded", {})
+        exited = {name: data for name, data in _read_process_files().items() if not _process_alive(data)}
+        now = time.time()
+        folded = {
+            name: at
+            for name, at in folded.items()
+            if name in exited or now - at < ARCHIVE_FOLDED_TTL
+        }
+        new = {name: data for name, data in exited.items() if name not in folded}
+        if new:
+            counters, histograms = {}, {}
+            _merge(counters, histograms, archive)
+            for name, data in new.items():
+                _merge(counters, histograms, data)
+                folded[name] = now
+            _write_json(path, {**_serialize(counters, histograms), "folded": folded})
+        for name in exited:
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+        return len(new)
+    except OSError as e:
+        logger.warning(f"Could not archive metrics in {directory}: {e}")
+        return 0
+    finally:
+        os.close(lock)
+
+
+def collect():
+    """
+    Merge every process file into one view. Counters and histograms are
+    summed across all processes plus the archive of exited ones, so totals
+    never go backwards; gauges are summed over live processes only.
+    """
+    archive_exited()
+    counters, gauges, histograms = {}, {}, {}
+    # Process files first: a file folded meanwhile is then listed in the archive
+    snapshots = _read_process_files()
+    archive = _read_json(os.path.join(settings.METRICS_DIR, ARCHIVE_NAME)) or {}
+    _merge(counters, histograms, archive)
+    folded = archive.get("folded", {})
+    for name, data in snapshots.items():
+        if name in folded:
+            continue
+        _merge(counters, histograms, data)
+        if _process_alive(data):
+            for metric, labels, value in data.get("gauges", []):
+                key = (metric, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+    return counters, gauges, histograms
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(extra_gauges=None):
+    """Render all merged metrics in the Prometheus text exposition format"""
+    registry.flush(force=True)
+    counters, gauges, histograms = collect()
+    for key, value in (extra_gauges or {}).items():
+        gauges[key] = value
+
+    by_name = {}
+    for store in (counters, gauges):
+        for (name, labels), value in store.items():
+            by_name.setdefault(name, []).append((labels, value))
+    for (name, labels), hist in histograms.items():
+        by_name.setdefault(name, []).append((labels, hist))
+
+    lines = []
+    for name in sorted(by_name):
+        metric_type, help_text = METRICS.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if metric_type != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(value["buckets"], value["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(float(value['sum']))}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def celery_queue_depths():
+    """
+    Ask the broker how many messages are waiting in each known queue.
+    Returns a gauge mapping suitable for ``render(extra_gauges=...)``.
+    """
+    depths = {}
+    try:
+        from finance.celery import app
+
+        queues = {app.conf.task_default_queue or "celery"}
+        queues.update(q.name for q in (app.conf.task_queues or []))
+        with app.connection_for_read() as conn:
+            conn.ensure_connection(max_retries=1)
+            channel = conn.default_channel
+            for queue in sorted(queues):
+                try:
+                    _, depth, _ = channel.queue_declare(queue=queue, passive=True)
+                except Exception:
+                    continue
+                depths[("financeapp_celery_queue_depth", (("queue", queue),))] = depth
+    except Exception as e:
+        logger.warning(f"Could not read Celery queue depth: {e}")
+    return depths
+
+
+# ----------------- Celery task timing -----------------
+_task_started = {}
+
+
+def _task_prerun(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is None:
+        return
+    observe(
+        "financeapp_celery_task_duration_seconds",
+        time.perf_counter() - started,
+        task=getattr(task, "name", "unknown"),
+        state=state or "UNKNOWN",
+    )
+    flush()
+
+
+def connect_celery_signals():
+    from celery.signals import task_prerun, task_postrun
+
+    task_prerun.connect(_task_prerun, weak=False)
+    task_postrun.connect(_task_postrun, weak=False)
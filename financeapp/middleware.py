@@ -0,0 +1,126 @@
+# financeapp/middleware.py
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics
+
+# The request being served, for code (e.g. DB wrappers) that has no access to it
+current_request = ContextVar("current_request", default=None)
+# The QueryCounters collecting for the request being served. A context
+# variable rather than a wrapper pushed on ``connection``: an async view runs
+# its queries through sync_to_async, on another thread's connection, but
+# with this context copied along.
+query_counters = ContextVar("query_counters", default=())
+
+
+class QueryCounter:
+    """``connection.execute_wrapper`` callable that counts and times queries"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+@contextmanager
+def counting_queries(counter):
+    """Feed every query run in this context (and its sync_to_async threads) to ``counter``"""
+    token = query_counters.set(query_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        query_counters.reset(token)
+
+
+def count_queries(execute, sql, params, many, context):
+    """``connection.execute_wrapper`` feeding the active ``counting_queries`` counters"""
+    counters = query_counters.get()
+    if not counters:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        for counter in counters:
+            counter.count += 1
+            counter.duration += elapsed
+
+
+def install_query_counter(sender=None, connection=None, **kwargs):
+    """``connection_created`` receiver adding ``count_queries`` once"""
+    if count_queries not in connection.execute_wrappers:
+        # At the front, like the slow-query logger, so wrappers pushed and
+        # popped around a block never pop this one
+        connection.execute_wrappers.insert(0, count_queries)
+
+
+def view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    return match.view_name or match._func_path
+
+
+class MetricsMiddleware:
+    """Record per-view latency and database usage for the /metrics endpoint"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = QueryCounter()
+        token = current_request.set(request)
+        start = time.perf_counter()
+        try:
+            with counting_queries(queries):
+                response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        self.record(request, response, time.perf_counter() - start, queries)
+        metrics.flush()
+        return response
+
+    async def __acall__(self, request):
+        queries = QueryCounter()
+        token = current_request.set(request)
+        start = time.perf_counter()
+        try:
+            with counting_queries(queries):
+                response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        self.record(request, response, time.perf_counter() - start, queries)
+        if metrics.flush_due():
+            await asyncio.to_thread(metrics.flush)
+        return response
+
+    def record(self, request, response, elapsed, queries):
+        view = view_name(request)
+        metrics.observe("financeapp_http_request_duration_seconds", elapsed, view=view)
+        metrics.inc(
+            "financeapp_http_requests_total",
+            view=view,
+            method=request.method,
+            status=response.status_code,
+        )
+        metrics.inc("financeapp_db_queries_total", queries.count, view=view)
+        metrics.inc("financeapp_db_query_duration_seconds_total", queries.duration, view=view)
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.23 on 2026-10-19 07:55
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0032_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BrokerMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queue', models.CharField(max_length=200)),
+                ('payload', models.TextField()),
+                ('delivery_tag', models.CharField(db_index=True, max_length=64)),
+                ('visible_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('deliveries', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['queue', 'id'], name='broker_queue_idx')],
+            },
+        ),
+    ]
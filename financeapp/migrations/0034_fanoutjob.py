@@ -0,0 +1,54 @@
+# Generated by Django 4.2.23 on 2026-10-19 07:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0033_brokermessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FanOutJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=100)),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='running', max_length=10)),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('total_chunks', models.PositiveIntegerField(default=0)),
+                ('done_chunks', models.PositiveIntegerField(default=0)),
+                ('failed_chunks', models.PositiveIntegerField(default=0)),
+                ('users_processed', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='FanOutChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('first_user_id', models.BigIntegerField()),
+                ('last_user_id', models.BigIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('users_processed', models.PositiveIntegerField(default=0)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='financeapp.fanoutjob')),
+            ],
+            options={
+                'ordering': ['job', 'index'],
+                'indexes': [models.Index(fields=['job', 'status'], name='fanout_chunk_status_idx')],
+                'unique_together': {('job', 'index')},
+            },
+        ),
+    ]
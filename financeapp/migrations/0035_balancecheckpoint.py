@@ -0,0 +1,39 @@
+# Generated by Django 4.2.23 on 2026-10-19 08:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0034_fanoutjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['account', '-date'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['to_account', 'date'], name='txn_to_account_date_idx'),
+        ),
+        migrations.AddField(
+            model_name='balancecheckpoint',
+            name='account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_checkpoints', to='financeapp.account'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='balancecheckpoint',
+            unique_together={('account', 'date')},
+        ),
+    ]
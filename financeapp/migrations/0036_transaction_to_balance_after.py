@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-19 08:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0035_balancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='to_balance_after',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=15, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.23 on 2026-10-19 08:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0036_transaction_to_balance_after'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='balance_shards',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='BalanceShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.PositiveSmallIntegerField()),
+                ('delta', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('postings', models.PositiveIntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='financeapp.account')),
+            ],
+            options={
+                'unique_together': {('account', 'slot')},
+            },
+        ),
+    ]
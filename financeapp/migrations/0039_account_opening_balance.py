@@ -0,0 +1,70 @@
+# Generated by Django 4.2.23 on 2026-10-19 08:20
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Case, DecimalField, F, Q, Sum, When
+
+
+def backfill_opening_balance(apps, schema_editor):
+    """
+    Existing accounts never recorded what they were opened with; take it to
+    be whatever their live balance holds beyond their transactions.
+    """
+    Account = apps.get_model('financeapp', 'Account')
+    Transaction = apps.get_model('financeapp', 'Transaction')
+    BalanceShard = apps.get_model('financeapp', 'BalanceShard')
+
+    ledger = defaultdict(lambda: 0)
+    own = (
+        Transaction.objects.exclude(account=None)
+        .order_by()
+        .values('account_id')
+        .annotate(
+            total=Sum(
+                Case(
+                    When(transaction_type='income', then=F('amount')),
+                    When(Q(transaction_type='expense') | Q(transaction_type='transfer'), then=-F('amount')),
+                    default=0,
+                    output_field=DecimalField(max_digits=15, decimal_places=2),
+                )
+            )
+        )
+    )
+    incoming = (
+        Transaction.objects.filter(transaction_type='transfer')
+        .exclude(to_account=None)
+        .order_by()
+        .values('to_account_id')
+        .annotate(total=Sum('amount'))
+    )
+    pending = BalanceShard.objects.order_by().values('account_id').annotate(total=Sum('delta'))
+    for row in own:
+        ledger[row['account_id']] += row['total'] or 0
+    for row in incoming:
+        ledger[row['to_account_id']] += row['total'] or 0
+    for row in pending:
+        ledger[row['account_id']] -= row['total'] or 0
+
+    accounts = []
+    for account in Account.objects.only('pk', 'balance').iterator():
+        account.opening_balance = account.balance - ledger[account.pk]
+        if account.opening_balance:
+            accounts.append(account)
+    Account.objects.bulk_update(accounts, ['opening_balance'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0038_idempotencyrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='opening_balance',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=15),
+        ),
+        migrations.RunPython(backfill_opening_balance, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,117 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:05
+
+import base64
+import pickle
+
+from django.db import migrations, models
+
+
+def unpickle_messages(apps, schema_editor):
+    """
+    Spread the pickled messages still in the outbox over the new fields. This
+    is the last time a stored pickle is loaded; the rows were written by this
+    project's own OutboxBackend.
+    """
+    OutboxMessage = apps.get_model('financeapp', 'OutboxMessage')
+    rows = []
+    for row in OutboxMessage.objects.exclude(status='sent').iterator():
+        try:
+            message = pickle.loads(row.message)
+        except Exception as e:
+            row.status = 'failed'
+            row.last_error = f"Could not convert the stored message: {type(e).__name__}: {e}"[:2000]
+            rows.append(row)
+            continue
+        row.subject = str(message.subject)
+        row.body = str(message.body)
+        row.content_subtype = message.content_subtype
+        row.from_email = str(message.from_email or '')
+        row.to = [str(address) for address in message.to]
+        row.cc = [str(address) for address in message.cc]
+        row.bcc = [str(address) for address in message.bcc]
+        row.reply_to = [str(address) for address in message.reply_to]
+        row.headers = {str(name): str(value) for name, value in message.extra_headers.items()}
+        row.alternatives = [[str(content), mimetype] for content, mimetype in getattr(message, 'alternatives', [])]
+        row.attachments = [
+            [filename, base64.b64encode(content.encode() if isinstance(content, str) else content).decode('ascii'), mimetype]
+            for filename, content, mimetype in (a for a in message.attachments if isinstance(a, tuple))
+        ]
+        rows.append(row)
+    OutboxMessage.objects.bulk_update(
+        rows,
+        [
+            'subject', 'body', 'content_subtype', 'from_email', 'to', 'cc', 'bcc', 'reply_to',
+            'headers', 'alternatives', 'attachments', 'status', 'last_error',
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0039_account_opening_balance'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboxmessage',
+            name='subject',
+            field=models.CharField(blank=True, max_length=998),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='body',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='content_subtype',
+            field=models.CharField(default='plain', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='from_email',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='to',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='cc',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='bcc',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='reply_to',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='headers',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='alternatives',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='attachments',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(unpickle_messages, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='outboxmessage',
+            name='message',
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0040_outbox_message_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.BigIntegerField()),
+                ('user_hash', models.CharField(max_length=16)),
+                ('view', models.CharField(max_length=255)),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('queries', models.PositiveBigIntegerField(default=0)),
+                ('db_seconds', models.FloatField(default=0)),
+                ('cpu_seconds', models.FloatField(default=0)),
+            ],
+            options={
+                'unique_together': {('bucket', 'user_hash', 'view')},
+            },
+        ),
+    ]
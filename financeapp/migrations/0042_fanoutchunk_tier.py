@@ -0,0 +1,23 @@
+# Generated by Django 4.2.23 on 2026-10-19 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0041_usagetotal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fanoutchunk',
+            name='tier',
+            field=models.CharField(default='standard', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='fanoutchunk',
+            name='user_ids',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-19 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financeapp', '0042_fanoutchunk_tier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencyrecord',
+            name='response_messages',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -8,18 +8,97 @@ from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from datetime import datetime, timedelta
 import logging
+import random
 from django.conf import settings
 from django.db.models import Sum, Count, Q
 from decimal import Decimal
+from . import metrics
 logger = logging.getLogger(__name__)
 from django.contrib.auth import get_user_model
 User = get_user_model()
 
 
-class UserProfile(models.Model):
+class DirtyFieldsMixin:
+    """
+    Remembers field values as loaded (or last saved) so that ``save()``
+    only writes the columns that changed, and skips the UPDATE entirely when
+    nothing did. ``auto_now`` fields are written along with any change.
+
+    ``validated_fields`` lists the fields checked by ``clean()``; models call
+    ``needs_clean()`` to skip validation when none of them changed.
+    """
+    validated_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._take_snapshot()
+        return instance
+
+    def _take_snapshot(self, fields=None):
+        deferred = self.get_deferred_fields()
+        snapshot = getattr(self, '_loaded_values', {}) if fields else {}
+        for field in self._meta.concrete_fields:
+            if field.attname in deferred or (fields and field.name not in fields and field.attname not in fields):
+                continue
+            snapshot[field.attname] = self._field_value(field)
+        self._loaded_values = snapshot
+
+    def _field_value(self, field):
+        value = field.value_from_object(self)
+        # FieldFile objects are mutated in place by FieldFile.save(); compare names
+        return value.name if isinstance(field, models.FileField) else value
+
+    def get_dirty_fields(self):
+        """Names of concrete fields whose value differs from the snapshot"""
+        if self._state.adding or not hasattr(self, '_loaded_values'):
+            return [field.name for field in self._meta.concrete_fields]
+        return [
+            field.name for field in self._meta.concrete_fields
+            if field.attname in self._loaded_values
+            and self._field_value(field) != self._loaded_values[field.attname]
+        ]
+
+    def needs_clean(self):
+        if self._state.adding or not hasattr(self, '_loaded_values'):
+            return True
+        dirty = set(self.get_dirty_fields())
+        return any(name in dirty for name in self.validated_fields)
+
+    def save(self, *args, **kwargs):
+        narrow = (
+            not args
+            and not self._state.adding
+            and hasattr(self, '_loaded_values')
+            and kwargs.get('update_fields') is None
+            and not kwargs.get('force_insert')
+        )
+        if narrow:
+            dirty = self.get_dirty_fields()
+            if not dirty:
+                return
+            if self._meta.pk.name in dirty:
+                # A changed primary key means a new row; let Django decide
+                dirty = None
+        if narrow and dirty:
+            auto_now = [
+                field.name for field in self._meta.concrete_fields
+                if getattr(field, 'auto_now', False) and field.name not in dirty
+            ]
+            kwargs['update_fields'] = dirty + auto_now
+        super().save(*args, **kwargs)
+        self._take_snapshot(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._take_snapshot(fields)
+
+
+class UserProfile(DirtyFieldsMixin, models.Model):
     """
     Extended user profile with additional information and preferences.
     """
+    validated_fields = ('date_of_birth',)
     ACCOUNT_TYPES = (
         ('standard', 'Standard'),
         ('premium', 'Premium'),
@@ -103,7 +182,8 @@ class UserProfile(models.Model):
             raise ValidationError({'date_of_birth': 'Date of birth cannot be in the future.'})
     
     def save(self, *args, **kwargs):
-        self.clean()
+        if self.needs_clean():
+            self.clean()
         super().save(*args, **kwargs)
 
 
@@ -121,9 +201,12 @@ def create_user_profile(sender, instance, created, **kwargs):
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
     """Signal to save the user profile when the user is saved"""
+    # Only a profile already loaded on this user instance can carry changes;
+    # anything else (e.g. the last_login update on every login) needs no write.
+    if not User.profile.is_cached(instance):
+        return
     try:
-        if hasattr(instance, 'profile'):
-            instance.profile.save()
+        instance.profile.save()
     except Exception as e:
         logger.error(f"Error saving user profile for {instance.username}: {str(e)}")
 
@@ -134,10 +217,11 @@ class SomeOtherModel(models.Model):
         on_delete=models.CASCADE
     )
 
-class Account(models.Model):
+class Account(DirtyFieldsMixin, models.Model):
     """
     Financial accounts for users (bank, cash, wallet, etc.)
     """
+    validated_fields = ('balance',)
     ACCOUNT_TYPES = (
         ("Bank", "Bank"),
         ("Cash", "Cash"),
@@ -174,7 +258,13 @@ class Account(models.Model):
         default=0
     )
 
+    # What the balance was before any transaction: the balance the account was
+    # opened with, moved by any later edit of ``balance`` made by hand
+    opening_balance = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+
     currency = models.CharField(max_length=3, default="NGN", choices=CURRENCY)
+    # Above 0, credits go to this many BalanceShard slots instead of locking this row
+    balance_shards = models.PositiveSmallIntegerField(default=0)
     last_transaction_date = models.DateTimeField(blank=True, null=True)
     last_updated = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
@@ -198,6 +288,16 @@ class Account(models.Model):
     def __str__(self):
         return f"{self.name} ({self.currency} {float(self.balance):.2f}) - {self.user.username}"
 
+    def current_balance(self):
+        """``balance`` plus credits still waiting in its shards"""
+        if not self.balance_shards:
+            return self.balance
+        return self.balance + BalanceShard.pending(self.pk)
+
+    def history(self):
+        """This account's transactions, including transfers into it"""
+        return Transaction.objects.filter(Q(account=self) | Q(to_account=self, transaction_type='transfer'))
+
     def clean(self):
         """Validate the model before saving"""
         super().clean()
@@ -207,14 +307,24 @@ class Account(models.Model):
             raise ValidationError({'balance': 'Account balance cannot be negative.'})
 
     def save(self, *args, **kwargs):
-        self.clean()
+        if self.needs_clean():
+            self.clean()
+        # Balances entered by hand, not posted by a transaction, belong to the opening balance
+        if self._state.adding:
+            self.opening_balance = self.balance
+        elif 'balance' in getattr(self, '_loaded_values', {}) and 'balance' in self.get_dirty_fields():
+            self._opening_shift = Decimal(self.balance) - self._loaded_values['balance']
+            self.opening_balance = self.opening_balance + self._opening_shift
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'opening_balance'}
         super().save(*args, **kwargs)
 
 
-class Transaction(models.Model):
+class Transaction(DirtyFieldsMixin, models.Model):
     """
     Financial transactions (income and expenses)
     """
+    validated_fields = ('amount', 'transaction_type', 'account', 'to_account')
     TRANSACTION_TYPES = (
         ("income", "Income"),
         ("expense", "Expense"),
@@ -267,6 +377,8 @@ class Transaction(models.Model):
         blank=True, 
         null=True
     )
+    # Destination account's running balance after a transfer
+    to_balance_after = models.DecimalField(max_digits=15, decimal_places=2, blank=True, null=True)
     date = models.DateField(default=timezone.now)
     created_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
     description = models.CharField(max_length=255, blank=True)
@@ -301,6 +413,10 @@ class Transaction(models.Model):
             models.Index(fields=['account', 'date']),
             models.Index(fields=['transaction_type', 'date']),
             models.Index(fields=['category', 'date']),
+            # Covers the hot "sum amount for user + type over a date range" shape
+            models.Index(fields=['user', 'transaction_type', 'date', 'amount'], name='txn_user_type_date_amt_idx'),
+            # Incoming transfers by date, for point-in-time balances
+            models.Index(fields=['to_account', 'date'], name='txn_to_account_date_idx'),
         ]
         ordering = ['-date', '-created_at']
         verbose_name = "Transaction"
@@ -329,45 +445,135 @@ class Transaction(models.Model):
         if not self.user_id and self.account:
             self.user = self.account.user
             
-        self.clean()
-        
-        # Calculate balance_after if not set
-        if not self.balance_after and self.account:
-            if self.transaction_type == "income":
-                self.balance_after = self.account.balance + self.amount
-            elif self.transaction_type == "expense":
-                self.balance_after = self.account.balance - self.amount
-            elif self.transaction_type == "transfer" and self.to_account:
-                # For transfers, we update both accounts
-                self.balance_after = self.account.balance - self.amount
+        if self.needs_clean():
+            self.clean()
         
         is_new = self._state.adding
         
         try:
             # Use the imported transaction module
             with transaction.atomic():
+                if self.account_id and is_new:
+                    self._post()
                 super().save(*args, **kwargs)
-                
-                # Update account balance
-                if self.account and is_new:
-                    if self.transaction_type == "income":
-                        self.account.balance += self.amount
-                    elif self.transaction_type == "expense":
-                        self.account.balance -= self.amount
-                    elif self.transaction_type == "transfer" and self.to_account:
-                        self.account.balance -= self.amount
-                        self.to_account.balance += self.amount
-                        self.to_account.save()
-                    
-                    self.account.last_transaction_date = timezone.now()
-                    self.account.save()
+
+            if is_new:
+                metrics.inc("financeapp_ledger_postings_total", transaction_type=self.transaction_type)
                     
         except Exception as e:
             logger.error(f"Error saving transaction: {str(e)}")
             raise
 
+    def deltas(self):
+        """{account_id: signed amount} this transaction moves when posted"""
+        if self.transaction_type == "income":
+            return {self.account_id: self.amount}
+        if self.transaction_type == "expense":
+            return {self.account_id: -self.amount}
+        if self.transaction_type == "transfer" and self.to_account_id:
+            return {self.account_id: -self.amount, self.to_account_id: self.amount}
+        return {}
+
+    def _post(self):
+        """
+        Apply this new transaction to its account balances. Must run inside
+        the atomic block that inserts it.
+
+        Both accounts of a transfer are locked in primary key order, so two
+        transfers in opposite directions queue up instead of deadlocking,
+        and the balances are changed with ``F()`` updates so nothing written
+        in between is lost. ``balance_after`` and ``to_balance_after`` come
+        from the locked rows.
+
+        Credits to an account with ``balance_shards`` set don't lock it at
+        all: they are added to one of its ``BalanceShard`` slots, which the
+        compactor later folds into ``balance`` (see financeapp.ledger).
+        """
+        deltas = self.deltas()
+        if not deltas:
+            return
+        shard_counts = self._shard_counts(deltas)
+        sharded = {account_id for account_id, delta in deltas.items() if delta > 0 and shard_counts.get(account_id)}
+        # ORDER BY pk makes the row locks be taken in pk order
+        locked = {
+            account.pk: account
+            for account in Account.objects.select_for_update()
+            .filter(pk__in=[account_id for account_id in deltas if account_id not in sharded])
+            .order_by('pk')
+        }
+        now = timezone.now()
+        for account_id, delta in sorted(deltas.items()):
+            if account_id in sharded:
+                new_balance = BalanceShard.add(account_id, shard_counts[account_id], delta)
+            else:
+                base = locked[account_id].balance
+                pending = BalanceShard.pending(account_id) if shard_counts.get(account_id) else 0
+                new_balance = base + pending + delta
+                if new_balance < 0:
+                    raise ValidationError({'balance': 'Account balance cannot be negative.'})
+                Account.objects.filter(pk=account_id).update(
+                    balance=models.F('balance') + delta, last_transaction_date=now, last_updated=now
+                )
+            if account_id == self.account_id and not self.balance_after:
+                self.balance_after = new_balance
+            if account_id == self.to_account_id and not self.to_balance_after:
+                self.to_balance_after = new_balance
+            # Keep the caller's instances current without making their balance look edited
+            if account_id in sharded:
+                continue
+            for name in ('account', 'to_account'):
+                account = getattr(self, name) if self._meta.get_field(name).is_cached(self) else None
+                if account is not None and account.pk == account_id:
+                    account.balance, account.last_transaction_date = base + delta, now
+                    account._take_snapshot(['balance', 'last_transaction_date'])
+
+    def _shard_counts(self, deltas):
+        """{account_id: balance_shards}, from the cached accounts when there are any"""
+        counts = {}
+        for name in ('account', 'to_account'):
+            if self._meta.get_field(name).is_cached(self) and getattr(self, name) is not None:
+                account = getattr(self, name)
+                counts[account.pk] = account.balance_shards
+        missing = [account_id for account_id in deltas if account_id not in counts]
+        if missing:
+            counts.update(Account.objects.filter(pk__in=missing).values_list('pk', 'balance_shards'))
+        return counts
+
+
+class BalanceShard(models.Model):
+    """
+    One slot of a hot account's pending balance. Credits to an account with
+    ``balance_shards`` set land on a random slot instead of its row, and
+    ``financeapp.ledger.compact_balance_shards`` folds them into ``balance``.
+    """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="shards")
+    slot = models.PositiveSmallIntegerField()
+    delta = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    postings = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ["account", "slot"]
+
+    def __str__(self):
+        return f"{self.account_id}[{self.slot}]: {self.delta}"
+
+    @classmethod
+    def add(cls, account_id, shards, amount):
+        """Add ``amount`` to a random slot of the account; returns its live balance"""
+        slot = random.randrange(shards)
+        changes = {'delta': models.F('delta') + amount, 'postings': models.F('postings') + 1}
+        if not cls.objects.filter(account_id=account_id, slot=slot).update(**changes):
+            cls.objects.get_or_create(account_id=account_id, slot=slot)
+            cls.objects.filter(account_id=account_id, slot=slot).update(**changes)
+        return Account.objects.filter(pk=account_id).values_list('balance', flat=True).get() + cls.pending(account_id)
+
+    @classmethod
+    def pending(cls, account_id):
+        """Sum of the account's slots not yet folded into ``balance``"""
+        return cls.objects.filter(account_id=account_id).aggregate(total=Sum('delta'))['total'] or Decimal('0.00')
 
-class UserSetting(models.Model):
+
+class UserSetting(DirtyFieldsMixin, models.Model):
     """Individual user settings"""
     user = models.OneToOneField(
         User, 
@@ -531,6 +737,175 @@ def transaction_summary(user, start_date=None, end_date=None):
         }
 
 
+class OutboxMessage(models.Model):
+    """An outgoing email, queued by ``financeapp.mail.OutboxBackend`` for the mail worker"""
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("sent", "Sent"),
+        ("failed", "Failed"),
+    )
+
+    subject = models.CharField(max_length=998, blank=True)
+    body = models.TextField(blank=True)
+    content_subtype = models.CharField(max_length=20, default="plain")
+    from_email = models.CharField(max_length=255, blank=True)
+    to = models.JSONField(default=list, blank=True)
+    cc = models.JSONField(default=list, blank=True)
+    bcc = models.JSONField(default=list, blank=True)
+    reply_to = models.JSONField(default=list, blank=True)
+    headers = models.JSONField(default=dict, blank=True)
+    alternatives = models.JSONField(default=list, blank=True)  # [content, mimetype] pairs
+    attachments = models.JSONField(default=list, blank=True)  # [filename, base64 content, mimetype]
+    recipients = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [models.Index(fields=["status", "next_attempt_at"], name="outbox_due_idx")]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.recipients} ({self.status})"
+
+
+class BrokerMessage(models.Model):
+    """A Celery message held by the database broker (see financeapp.broker)"""
+    queue = models.CharField(max_length=200)
+    payload = models.TextField()
+    delivery_tag = models.CharField(max_length=64, db_index=True)
+    visible_at = models.DateTimeField(default=timezone.now)
+    deliveries = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["queue", "id"], name="broker_queue_idx")]
+
+    def __str__(self):
+        return f"{self.queue} #{self.pk}"
+
+
+class FanOutJob(models.Model):
+    """A per-user job split into user-id chunks (see financeapp.jobs)"""
+    STATUS_CHOICES = (
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+        ("cancelled", "Cancelled"),
+    )
+
+    kind = models.CharField(max_length=100)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="running")
+    chunk_size = models.PositiveIntegerField()
+    total_chunks = models.PositiveIntegerField(default=0)
+    done_chunks = models.PositiveIntegerField(default=0)
+    failed_chunks = models.PositiveIntegerField(default=0)
+    users_processed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+
+class FanOutChunk(models.Model):
+    """One batch of a FanOutJob's users, all of one tier; its status is the job's checkpoint"""
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    )
+
+    job = models.ForeignKey(FanOutJob, on_delete=models.CASCADE, related_name="chunks")
+    index = models.PositiveIntegerField()
+    first_user_id = models.BigIntegerField()
+    last_user_id = models.BigIntegerField()
+    # Account type of the chunk's users, which picks its analytics queue
+    tier = models.CharField(max_length=20, default="standard")
+    # Chunks planned before tiers were recorded only have the id range
+    user_ids = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveIntegerField(default=0)
+    users_processed = models.PositiveIntegerField(default=0)
+    duration = models.FloatField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["job", "index"]
+        unique_together = ["job", "index"]
+        indexes = [models.Index(fields=["job", "status"], name="fanout_chunk_status_idx")]
+
+    def __str__(self):
+        return f"{self.job_id}:{self.index} {self.tier} [{self.first_user_id}-{self.last_user_id}] {self.status}"
+
+
+class BalanceCheckpoint(models.Model):
+    """An account's ledger balance at the end of ``date`` (see financeapp.ledger.balances_as_of)"""
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="balance_checkpoints")
+    date = models.DateField()
+    balance = models.DecimalField(max_digits=15, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["account", "-date"]
+        unique_together = ["account", "date"]
+
+    def __str__(self):
+        return f"{self.account_id} @ {self.date}: {self.balance}"
+
+
+class IdempotencyRecord(models.Model):
+    """The stored outcome of a write request sent with an Idempotency-Key (see financeapp.idempotency)"""
+    STATUS_CHOICES = (
+        ("running", "Running"),
+        ("done", "Done"),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="idempotency_records")
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)  # sha256 of method, path and body
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="running")
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_headers = models.JSONField(default=dict, blank=True)
+    response_body = models.BinaryField(blank=True, default=b"")
+    # Flash messages the request queued, as [level, message, extra_tags]
+    response_messages = models.JSONField(default=list, blank=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ["user", "key"]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.key} ({self.status})"
+
+
+class UsageTotal(models.Model):
+    """One user's request costs for one view in one time bucket (see financeapp.usage)"""
+    bucket = models.BigIntegerField()  # COST_BUCKET_SECONDS slots since the epoch
+    user_hash = models.CharField(max_length=16)
+    view = models.CharField(max_length=255)
+    requests = models.PositiveIntegerField(default=0)
+    queries = models.PositiveBigIntegerField(default=0)
+    db_seconds = models.FloatField(default=0)
+    cpu_seconds = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ["bucket", "user_hash", "view"]
+
+    def __str__(self):
+        return f"{self.user_hash} {self.view} @ {self.bucket}"
+
+
 class ContactMessage(models.Model):
     name = models.CharField(max_length=100)
     email = models.EmailField(validators=[EmailValidator()])
@@ -544,7 +919,7 @@ class ContactMessage(models.Model):
 
 
 # Add to your existing models
-class Budget(models.Model):
+class Budget(DirtyFieldsMixin, models.Model):
     BUDGET_CATEGORIES = (
         ('food', 'Food & Dining'),
         ('transport', 'Transportation'),
@@ -0,0 +1,167 @@
+# financeapp/oauth.py
+"""
+Client for Google's OAuth 2.0 / OpenID Connect endpoints.
+
+Every call goes through one ``requests.Session`` per process, so sign-ins
+reuse keep-alive connections to Google instead of a fresh TLS handshake
+each time. Each request is bounded by ``OAUTH_CONNECT_TIMEOUT`` and
+``OAUTH_READ_TIMEOUT``. Connection failures are retried with jittered
+exponential backoff, as are 429/5xx answers to GETs; the token exchange
+POST is not retried once sent, since an authorization code can only be
+redeemed once.
+
+The discovery document and Google's signing keys rarely change, so both are
+cached for the response's ``max-age`` (``OAUTH_CACHE_TIMEOUT`` if absent).
+With the keys at hand the ``id_token`` from the token exchange is verified
+locally, which saves the round trip to the userinfo endpoint.
+"""
+import logging
+import re
+from urllib.parse import urlencode
+
+import jwt
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class OAuthError(Exception):
+    """Google could not be reached or rejected the request"""
+
+
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        retry = Retry(
+            total=settings.OAUTH_RETRIES,
+            backoff_factor=settings.OAUTH_BACKOFF,
+            backoff_jitter=settings.OAUTH_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=settings.OAUTH_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
+
+
+def _request(method, url, **kwargs):
+    try:
+        response = get_session().request(
+            method, url, timeout=(settings.OAUTH_CONNECT_TIMEOUT, settings.OAUTH_READ_TIMEOUT), **kwargs
+        )
+    except requests.RequestException as e:
+        logger.warning("Google OAuth %s %s failed: %s", method, url, e)
+        raise OAuthError(f"{method} {url} failed: {e}") from e
+    if response.status_code >= 400:
+        logger.warning("Google OAuth %s %s returned %s", method, url, response.status_code)
+        raise OAuthError(f"{method} {url} returned {response.status_code}: {response.text[:200]}")
+    try:
+        return response, response.json()
+    except ValueError as e:
+        raise OAuthError(f"{method} {url} returned invalid JSON") from e
+
+
+def _max_age(response):
+    match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+    return int(match.group(1)) if match else settings.OAUTH_CACHE_TIMEOUT
+
+
+def _cached_json(key, url, refresh=False):
+    data = None if refresh else cache.get(key)
+    if data is None:
+        response, data = _request("GET", url)
+        cache.set(key, data, timeout=_max_age(response))
+    return data
+
+
+def discovery():
+    """Google's OpenID configuration (endpoints, issuer, jwks_uri)"""
+    return _cached_json(f"oauth:discovery:{settings.GOOGLE_DISCOVERY_URL}", settings.GOOGLE_DISCOVERY_URL)
+
+
+def certs(refresh=False):
+    """Google's current JSON Web Key Set"""
+    url = discovery()["jwks_uri"]
+    return _cached_json(f"oauth:certs:{url}", url, refresh=refresh)
+
+
+def authorization_url(state=None):
+    params = {
+        "response_type": "code",
+        "client_id": settings.GOOGLE_CLIENT_ID,
+        "redirect_uri": settings.GOOGLE_REDIRECT_URI,
+        "scope": settings.GOOGLE_OAUTH2_SCOPE or "openid email profile",
+    }
+    if state:
+        params["state"] = state
+    return f"{discovery()['authorization_endpoint']}?{urlencode(params)}"
+
+
+def exchange_code(code):
+    """Redeem an authorization code for the token response"""
+    _, tokens = _request(
+        "POST",
+        discovery()["token_endpoint"],
+        data={
+            "code": code,
+            "client_id": settings.GOOGLE_CLIENT_ID,
+            "client_secret": settings.GOOGLE_CLIENT_SECRET,
+            "redirect_uri": settings.GOOGLE_REDIRECT_URI,
+            "grant_type": "authorization_code",
+        },
+    )
+    if not tokens.get("access_token"):
+        raise OAuthError("Token response has no access_token")
+    return tokens
+
+
+def _signing_key(kid):
+    for refresh in (False, True):
+        # An unknown kid usually means Google rotated keys since we cached them
+        for key in jwt.PyJWKSet.from_dict(certs(refresh=refresh)).keys:
+            if key.key_id == kid:
+                return key
+    raise OAuthError(f"No Google signing key with kid {kid!r}")
+
+
+def verify_id_token(id_token):
+    """Claims of a Google-signed ID token issued to this client"""
+    try:
+        header = jwt.get_unverified_header(id_token)
+        key = _signing_key(header.get("kid"))
+        return jwt.decode(
+            id_token,
+            key.key,
+            algorithms=["RS256"],
+            audience=settings.GOOGLE_CLIENT_ID,
+            issuer=discovery()["issuer"],
+            leeway=60,
+        )
+    except jwt.PyJWTError as e:
+        raise OAuthError(f"Invalid ID token: {e}") from e
+
+
+def user_info(tokens):
+    """Profile claims (email, given_name, family_name) for a token response"""
+    if tokens.get("id_token"):
+        claims = verify_id_token(tokens["id_token"])
+        if claims.get("email"):
+            return claims
+    _, info = _request(
+        "GET",
+        discovery()["userinfo_endpoint"],
+        headers={"Authorization": f"Bearer {tokens['access_token']}"},
+    )
+    return info
@@ -0,0 +1,168 @@
+# financeapp/queues.py
+"""
+Celery queue topology, routing and per-pool limits.
+
+Tasks belong to a work class, and each class has its own queue(s) so that a
+big export can't hold up mail or a premium user's dashboard refresh:
+
+- ``mail``: outbox delivery
+- ``maintenance``: periodic housekeeping
+- ``analytics``: heavy per-user jobs (exports, rollups, fan-out chunks),
+  split by ``UserProfile.account_type`` into ``analytics.business``,
+  ``analytics.premium`` and ``analytics.standard``
+- ``celery``: everything else
+
+Workers run as named pools (``WORKER_POOLS``), each consuming a list of
+queues with its own concurrency and task rate limit; ``manage.py
+celery_workers`` prints or starts them. Tier weighting comes from overlap:
+business jobs are served by three analytics pools, premium by two and
+standard by one. That one pool takes from every tier queue in turn, which
+is the starvation guard: standard jobs always keep a share of it no matter
+how much higher-tier work is waiting.
+
+Every message is stamped with its publish time, so workers record how long
+it waited in its queue; the admin queue page shows depth and waits.
+"""
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+POOL_ENV = "FINANCEAPP_WORKER_POOL"
+TIERS = ("business", "premium", "standard")
+WAIT_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+# Task name -> work class; anything not listed goes to the default queue
+TASK_CLASSES = {
+    "financeapp.task.deliver_outbox": "mail",
+    "financeapp.task.send_welcome_email": "mail",
+    "financeapp.task.slow_query_report": "maintenance",
+    "financeapp.task.clear_expired_sessions": "maintenance",
+    "financeapp.task.write_balance_checkpoints": "maintenance",
+    "financeapp.task.compact_balance_shards": "maintenance",
+    "financeapp.task.clear_expired_idempotency_records": "maintenance",
+    "financeapp.task.run_fanout_chunk": "analytics",
+}
+
+
+def queue_names():
+    return [queue.name for queue in settings.CELERY_TASK_QUEUES]
+
+
+def user_tier(user_id):
+    """``UserProfile.account_type`` for ``user_id`` (cached), ``standard`` if unknown"""
+    if user_id is None:
+        return "standard"
+    key = f"queues:tier:{user_id}"
+    tier = cache.get(key)
+    if tier is None:
+        from .models import UserProfile
+
+        tier = UserProfile.objects.filter(user_id=user_id).values_list("account_type", flat=True).first()
+        tier = tier if tier in TIERS else "standard"
+        cache.set(key, tier, timeout=settings.TASK_TIER_CACHE_TIMEOUT)
+    return tier
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """
+    ``CELERY_TASK_ROUTES`` router: work class, then tier for analytics. The
+    tier is the ``tier`` kwarg when the sender knows it (fan-out chunks), else
+    looked up from the ``user_id`` kwarg.
+    """
+    if options.get("queue"):
+        return None
+    work_class = getattr(task, "work_class", None) or TASK_CLASSES.get(name)
+    if work_class is None:
+        return None
+    if work_class == "analytics":
+        kwargs = kwargs or {}
+        tier = kwargs.get("tier")
+        if tier not in TIERS:
+            tier = user_tier(kwargs.get("user_id"))
+        return {"queue": f"analytics.{tier}"}
+    return {"queue": work_class}
+
+
+class PoolRateLimits:
+    """``CELERY_TASK_ANNOTATIONS`` entry applying the current pool's rate limit to its tasks"""
+
+    def annotate(self, task):
+        pool = settings.WORKER_POOLS.get(os.environ.get(POOL_ENV, ""), {})
+        if pool.get("rate_limit") and task.name.startswith("financeapp."):
+            return {"rate_limit": pool["rate_limit"]}
+        return None
+
+
+def worker_argv(name):
+    """``celery worker`` arguments for the named pool"""
+    pool = settings.WORKER_POOLS[name]
+    return [
+        "celery", "-A", "finance", "worker",
+        "-n", f"{name}@%h",
+        "-Q", ",".join(pool["queues"]),
+        "-c", str(pool["concurrency"]),
+        # Long analytics jobs: don't let one process hoard waiting messages
+        "--prefetch-multiplier", "1",
+        "-O", "fair",
+    ]
+
+
+# ----------------- Wait times -----------------
+def _stamp_enqueued_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault("enqueued_at", time.time())
+
+
+def _record_wait(task=None, **kwargs):
+    request = getattr(task, "request", None)
+    enqueued_at = getattr(request, "enqueued_at", None)
+    if not enqueued_at:
+        return
+    queue = (request.delivery_info or {}).get("routing_key") or "unknown"
+    metrics.observe(
+        "financeapp_celery_queue_wait_seconds", max(time.time() - enqueued_at, 0), buckets=WAIT_BUCKETS, queue=queue
+    )
+
+
+def connect_celery_signals():
+    from celery.signals import before_task_publish, task_prerun
+
+    before_task_publish.connect(_stamp_enqueued_at, weak=False)
+    task_prerun.connect(_record_wait, weak=False)
+
+
+def overview():
+    """Per-queue depth, tasks started and wait times, for the admin queue page"""
+    depths = {dict(labels)["queue"]: value for (_, labels), value in metrics.celery_queue_depths().items()}
+    metrics.flush(force=True)
+    _, _, histograms = metrics.collect()
+    rows = []
+    for queue in queue_names():
+        hist = histograms.get(("financeapp_celery_queue_wait_seconds", (("queue", queue),)))
+        count = hist["count"] if hist else 0
+        rows.append(
+            {
+                "queue": queue,
+                "depth": depths.get(queue),
+                "started": count,
+                "mean_wait": hist["sum"] / count if count else None,
+                "p95_wait": _quantile(hist, 0.95) if count else None,
+                "pools": [name for name, pool in settings.WORKER_POOLS.items() if queue in pool["queues"]],
+            }
+        )
+    return rows
+
+
+def _quantile(hist, q):
+    """Upper bucket bound containing quantile ``q`` (``None`` past the last bucket)"""
+    target = q * hist["count"]
+    seen = 0
+    for bound, count in zip(hist["buckets"], hist["counts"]):
+        seen += count
+        if seen >= target:
+            return bound
+    return None
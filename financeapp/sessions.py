@@ -0,0 +1,118 @@
+# financeapp/sessions.py
+"""
+Database-backed session engine with an in-process read cache.
+
+Sessions live in the ``django_session`` table, so they survive restarts and
+are shared by every worker without Redis. Reads are served from the
+``SESSION_CACHE_ALIAS`` cache (a ``TwoTierCache``: in-process L1, Redis L2
+when configured), writes are skipped when the session data hasn't changed
+and the stored expiry is still fresh, and ``clear_expired`` deletes in
+batches so ``clearsessions`` never holds a long lock on the table.
+"""
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.core.cache import caches
+from django.utils import timezone
+
+KEY_PREFIX = "financeapp.sessions."
+
+
+class SessionStore(DBStore):
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        self._cache = caches[settings.SESSION_CACHE_ALIAS]
+        self._loaded_digest = None
+        self._loaded_expiry = None
+        self._written = None
+        super().__init__(session_key)
+
+    @property
+    def cache_key(self):
+        return self.cache_key_prefix + self._get_or_create_session_key()
+
+    def _digest(self, data):
+        return hashlib.sha256(self.serializer().dumps(data)).hexdigest()
+
+    def _cache_entry(self, session_data, expire_date):
+        timeout = max(0, int((expire_date - timezone.now()).total_seconds()))
+        if timeout:
+            self._cache.set(self.cache_key, (session_data, expire_date), timeout)
+
+    def load(self):
+        entry = self._cache.get(self.cache_key) if self.session_key else None
+        if entry is not None and entry[1] > timezone.now():
+            session_data, expire_date = entry
+        else:
+            s = self._get_session_from_db()
+            if s is None:
+                self._loaded_digest = self._loaded_expiry = None
+                return {}
+            session_data, expire_date = s.session_data, s.expire_date
+            self._cache_entry(session_data, expire_date)
+
+        data = self.decode(session_data)
+        self._loaded_digest = self._digest(data)
+        self._loaded_expiry = expire_date
+        return data
+
+    def exists(self, session_key):
+        return bool(session_key and self._cache.has_key(self.cache_key_prefix + session_key)) or super().exists(
+            session_key
+        )
+
+    def _is_unchanged(self, data):
+        """Same data as loaded, and the stored expiry doesn't need pushing out yet"""
+        if self._loaded_digest is None or self._loaded_digest != self._digest(data):
+            return False
+        refresh = timedelta(seconds=settings.SESSION_EXPIRY_REFRESH_SECONDS)
+        return self.get_expiry_date() - self._loaded_expiry < refresh
+
+    def create_model_instance(self, data):
+        self._written = super().create_model_instance(data)
+        return self._written
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        if not must_create and self._is_unchanged(data):
+            return
+        super().save(must_create=must_create)
+        self._cache_entry(self._written.session_data, self._written.expire_date)
+        self._loaded_digest = self._digest(data)
+        self._loaded_expiry = self._written.expire_date
+
+    def delete(self, session_key=None):
+        super().delete(session_key)
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        self._cache.delete(self.cache_key_prefix + session_key)
+
+    def flush(self):
+        """Remove the current session data from the database and regenerate the key"""
+        self.clear()
+        self.delete(self.session_key)
+        self._session_key = None
+
+    @classmethod
+    def clear_expired(cls, batch_size=None):
+        """Delete expired sessions in primary-key batches; returns the number removed"""
+        batch_size = batch_size or settings.SESSION_CLEAR_BATCH_SIZE
+        model = cls.get_model_class()
+        removed = 0
+        while True:
+            keys = list(
+                model.objects.filter(expire_date__lt=timezone.now()).values_list("session_key", flat=True)[
+                    :batch_size
+                ]
+            )
+            if not keys:
+                return removed
+            model.objects.filter(session_key__in=keys).delete()
+            removed += len(keys)
@@ -0,0 +1,216 @@
+# financeapp/slow_queries.py
+"""
+Structured slow-query log.
+
+``SlowQueryLogger`` is installed on every database connection through the
+``connection_created`` signal. Queries slower than ``SLOW_QUERY_THRESHOLD_MS``
+are logged as JSON to ``LOG_DIR/slow_queries.log`` with a normalized SQL
+fingerprint, the calling view/task and code location, the row count and
+(once per fingerprint and process) the query plan.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+from .middleware import current_request, view_name
+
+logger = logging.getLogger("financeapp.slow_queries")
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_RE = re.compile(r"%s|\?")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def fingerprint(sql):
+    """Normalize SQL so queries differing only in literals group together"""
+    normalized = _STRING_RE.sub("?", sql)
+    normalized = _NUMBER_RE.sub("?", normalized)
+    normalized = _PLACEHOLDER_RE.sub("?", normalized)
+    normalized = _IN_LIST_RE.sub("(...)", normalized)
+    return _SPACE_RE.sub(" ", normalized).strip()
+
+
+def fingerprint_id(normalized):
+    return hashlib.md5(normalized.encode("utf-8")).hexdigest()[:12]
+
+
+def caller_label():
+    """Name of the view (or Celery task) on whose behalf the query runs"""
+    request = current_request.get()
+    if request is not None:
+        return view_name(request)
+    try:
+        from celery import current_task
+
+        if current_task and current_task.request.id:
+            return f"task:{current_task.name}"
+    except ImportError:
+        pass
+    return "-"
+
+
+_THIS_FILE = os.path.abspath(__file__)
+
+
+def code_location():
+    """First stack frame inside the project, outside Django and site-packages"""
+    base_dir = str(settings.BASE_DIR)
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if (
+            filename.startswith(base_dir)
+            and filename != _THIS_FILE
+            and "site-packages" not in filename
+        ):
+            relative = os.path.relpath(filename, base_dir)
+            return f"{relative}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "-"
+
+
+class SlowQueryLogger:
+    """``connection.execute_wrapper`` that logs queries over a threshold"""
+
+    def __init__(self):
+        self._explained = set()
+        self._local = threading.local()
+
+    def __call__(self, execute, sql, params, many, context):
+        if getattr(self._local, "explaining", False):
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        # Only queries that succeeded: after an error the transaction may be
+        # aborted, and an EXPLAIN there would fail over the original exception
+        result = execute(sql, params, many, context)
+        duration_ms = (time.perf_counter() - start) * 1000
+        if duration_ms >= settings.SLOW_QUERY_THRESHOLD_MS:
+            self.log(sql, params, many, context, duration_ms)
+        return result
+
+    def log(self, sql, params, many, context, duration_ms):
+        normalized = fingerprint(sql)
+        fp = fingerprint_id(normalized)
+        cursor = context.get("cursor")
+        rowcount = getattr(cursor, "rowcount", -1)
+
+        entry = {
+            "fingerprint": fp,
+            "sql": normalized,
+            "duration_ms": round(duration_ms, 3),
+            "rows": rowcount,
+            "view": caller_label(),
+            "location": code_location(),
+            "database": context["connection"].alias,
+        }
+        if settings.SLOW_QUERY_EXPLAIN and not many and fp not in self._explained:
+            self._explained.add(fp)
+            entry["plan"] = self.explain(context["connection"], sql, params)
+
+        logger.warning("slow query", extra=entry)
+
+    def explain(self, connection, sql, params):
+        if not sql.lstrip().upper().startswith("SELECT"):
+            return None
+        try:
+            prefix = connection.ops.explain_query_prefix()
+        except Exception:
+            return None
+
+        self._local.explaining = True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"{prefix} {sql}", params)
+                return [" ".join(str(col) for col in row) for row in cursor.fetchall()]
+        except Exception as e:
+            return [f"EXPLAIN failed: {e}"]
+        finally:
+            self._local.explaining = False
+
+
+slow_query_logger = SlowQueryLogger()
+
+
+def install(sender=None, connection=None, **kwargs):
+    """``connection_created`` receiver adding the slow-query wrapper once"""
+    if slow_query_logger not in connection.execute_wrappers:
+        # Insert at the front so wrappers pushed and popped around a block
+        # never pop this one by mistake.
+        connection.execute_wrappers.insert(0, slow_query_logger)
+
+
+# ----------------- Top-N report -----------------
+def log_path():
+    return os.path.join(settings.LOG_DIR, "slow_queries.log")
+
+
+def build_report(path=None, top=20):
+    """Aggregate the JSON slow-query log into a top-N by total time report"""
+    path = path or log_path()
+    stats = defaultdict(
+        lambda: {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0, "views": set(), "locations": set()}
+    )
+    details = {}
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                fp = entry.get("fingerprint")
+                if not fp:
+                    continue
+                item = stats[fp]
+                item["count"] += 1
+                item["total_ms"] += entry.get("duration_ms", 0)
+                item["max_ms"] = max(item["max_ms"], entry.get("duration_ms", 0))
+                item["rows"] += max(entry.get("rows", 0) or 0, 0)
+                item["views"].add(entry.get("view", "-"))
+                item["locations"].add(entry.get("location", "-"))
+                detail = details.setdefault(fp, {"sql": entry.get("sql"), "plan": None})
+                if entry.get("plan") and not detail["plan"]:
+                    detail["plan"] = entry["plan"]
+    except FileNotFoundError:
+        pass
+
+    ranked = sorted(stats.items(), key=lambda kv: kv[1]["total_ms"], reverse=True)[:top]
+    return [
+        {
+            "fingerprint": fp,
+            "sql": details[fp]["sql"],
+            "count": item["count"],
+            "total_ms": round(item["total_ms"], 3),
+            "mean_ms": round(item["total_ms"] / item["count"], 3),
+            "max_ms": round(item["max_ms"], 3),
+            "rows": item["rows"],
+            "views": sorted(item["views"]),
+            "locations": sorted(item["locations"]),
+            "plan": details[fp]["plan"],
+        }
+        for fp, item in ranked
+    ]
+
+
+def write_report(top=20):
+    """Write the report next to the log and return its path"""
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "top": build_report(top=top),
+    }
+    path = os.path.join(settings.LOG_DIR, "slow_query_report.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return path
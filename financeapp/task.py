@@ -11,4 +11,91 @@ def send_welcome_email(user_email, username):
         'noreply@wealthywise.com',
         [user_email],
         fail_silently=False,
-    )
\ No newline at end of file
+    )
+
+
+@shared_task
+def slow_query_report(top=20):
+    """Periodically rewrite the top-N slow query report in LOG_DIR"""
+    from .slow_queries import write_report
+
+    return write_report(top=top)
+
+
+@shared_task
+def clear_expired_sessions():
+    """Delete expired sessions in batches (see financeapp.sessions)"""
+    from importlib import import_module
+
+    from django.conf import settings
+
+    engine = import_module(settings.SESSION_ENGINE)
+    return engine.SessionStore.clear_expired()
+
+
+@shared_task
+def deliver_outbox():
+    """Send one batch of due outbox mail over a single connection (see financeapp.mail)"""
+    from django.conf import settings
+
+    from .mail import claim_batch, deliver, retry_delay
+
+    batch = claim_batch()
+    if not batch:
+        return {"sent": 0, "retrying": 0, "failed": 0}
+    sent, retrying, failed = deliver(batch)
+    if len(batch) == settings.OUTBOX_BATCH_SIZE:
+        # There may be more waiting
+        deliver_outbox.delay()
+    elif retrying:
+        deliver_outbox.apply_async(countdown=retry_delay(1))
+    return {"sent": sent, "retrying": retrying, "failed": failed}
+
+
+@shared_task(bind=True)
+def run_fanout_chunk(self, chunk_id, tier=None):
+    """
+    Process one chunk of a fan-out job, backing off a while when the database
+    is busy (see financeapp.jobs). ``tier`` only picks the queue.
+    """
+    from django.conf import settings
+
+    from .jobs import db_busy, run_chunk
+
+    limit = settings.FANOUT_MAX_THROTTLE_RETRIES
+    if self.request.retries < limit and db_busy():
+        raise self.retry(countdown=settings.FANOUT_THROTTLE_DELAY, max_retries=limit)
+    return run_chunk(chunk_id)
+
+
+@shared_task
+def write_balance_checkpoints():
+    """Record last month-end's balance for every account still missing it (see financeapp.ledger)"""
+    from django.conf import settings
+    from django.utils import timezone
+
+    from . import ledger
+    from .models import Account
+
+    on = ledger.month_end(timezone.now().date())
+    written = 0
+    for first, last in ledger.id_ranges(settings.BALANCE_CHECKPOINT_BATCH_SIZE):
+        missing = Account.objects.filter(pk__gte=first, pk__lte=last).exclude(balance_checkpoints__date=on)
+        written += ledger.write_checkpoints(on, missing)
+    return written
+
+
+@shared_task
+def compact_balance_shards():
+    """Fold credits waiting in hot accounts' balance shards into their balances (see financeapp.ledger)"""
+    from .ledger import compact_balance_shards
+
+    return compact_balance_shards()
+
+
+@shared_task
+def clear_expired_idempotency_records():
+    """Delete stored Idempotency-Key outcomes past their TTL (see financeapp.idempotency)"""
+    from .idempotency import clear_expired
+
+    return clear_expired()
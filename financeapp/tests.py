@@ -1,3 +1,1202 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import jwt
+import requests
+from cryptography.hazmat.primitives.asymmetric import rsa
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth import get_user_model
+from django.contrib.messages.storage import default_storage
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.handlers.asgi import ASGIHandler
+from django.db import DatabaseError, OperationalError, connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from finance.asgi import application
+
+from . import admission, auth_cache, broker, chat_context, jobs, ledger, metrics, oauth, slow_queries, usage, views
+from .auth_cache import CachedAuthenticationMiddleware
+from .idempotency import idempotent
+from .mail import build_message
+from .management.commands.fake_llm_server import build_fake_llm
+from .management.commands.smtp_sink import build_sink
+from .management.commands.stub_oauth_server import build_server
+from .middleware import MetricsMiddleware
+from .models import Account, ContactMessage, FanOutChunk, OutboxMessage, Transaction, UsageTotal, UserProfile
+from .sessions import SessionStore
+from .slow_queries import SlowQueryLogger
+from .task import deliver_outbox, run_fanout_chunk
+
+
+ACCOUNT_NUMBERS = itertools.count(1000000000)
+
+
+def make_account(user, name, balance="0.00"):
+    return Account.objects.create(
+        user=user,
+        name=name,
+        account_type="Bank",
+        account_number=str(next(ACCOUNT_NUMBERS)),
+        balance=Decimal(balance),
+    )
+
+
+class ReconciliationTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("ledger")
+        self.account = make_account(self.user, "Main", "1000.00")
+
+    def test_opening_balance_is_not_drift(self):
+        Transaction.objects.create(user=self.user, account=self.account, transaction_type="income", amount=100)
+        Transaction.objects.create(user=self.user, account=self.account, transaction_type="expense", amount=50)
+
+        self.assertEqual(ledger.drift(), [])
+        self.assertEqual(ledger.recalculate(), [])
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal("1050.00"))
+
+    def test_balance_edited_by_hand_moves_the_opening_balance(self):
+        Transaction.objects.create(user=self.user, account=self.account, transaction_type="income", amount=100)
+        self.account.balance = Decimal("700.00")
+        self.account.save()
+
+        self.assertEqual(self.account.opening_balance, Decimal("600.00"))
+        self.assertEqual(ledger.drift(), [])
+
+    def test_recalculate_restores_a_lost_update(self):
+        Transaction.objects.create(user=self.user, account=self.account, transaction_type="income", amount=100)
+        Account.objects.filter(pk=self.account.pk).update(balance=Decimal("1000.00"))
+
+        [row] = ledger.recalculate()
+        self.assertEqual(row["difference"], Decimal("-100.00"))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal("1100.00"))
+
+    def test_recalculate_keeps_a_posting_made_after_the_drift_check(self):
+        Account.objects.filter(pk=self.account.pk).update(balance=Decimal("900.00"))
+        check = ledger.drift
+
+        def drift_then_post(accounts=None):
+            drifted = check(accounts)
+            Transaction.objects.create(user=self.user, account=self.account, transaction_type="income", amount=25)
+            return drifted
+
+        with mock.patch.object(ledger, "drift", drift_then_post):
+            ledger.recalculate()
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal("1025.00"))
+        self.assertEqual(ledger.drift(), [])
+
+
+class DirtyFieldsTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("dirty")
+        self.account = Account.objects.get(pk=make_account(self.user, "Wallet", "10.00").pk)
+
+    def updated_columns(self, func):
+        """Columns SET by each UPDATE of the account table while ``func`` runs"""
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        return [
+            set(re.findall(r'"(\w+)" = ', query["sql"].split(" WHERE ")[0]))
+            for query in queries
+            if query["sql"].startswith('UPDATE "financeapp_account"')
+        ]
+
+    def test_save_writes_only_the_changed_fields(self):
+        self.account.name = "Travel wallet"
+        self.assertEqual(self.account.get_dirty_fields(), ["name"])
+        self.assertEqual(self.updated_columns(self.account.save), [{"name", "last_updated"}])
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.name, "Travel wallet")
+        self.assertEqual(self.account.balance, Decimal("10.00"))
+
+    def test_save_resets_the_dirty_state(self):
+        self.account.name = "Travel wallet"
+        self.account.save()
+        self.assertEqual(self.account.get_dirty_fields(), [])
+        # Nothing changed since, so nothing is written
+        self.assertEqual(self.updated_columns(self.account.save), [])
+
+    def test_refresh_from_db_resets_the_dirty_state(self):
+        self.account.name = "Travel wallet"
+        Account.objects.filter(pk=self.account.pk).update(currency="USD")
+        self.account.refresh_from_db(fields=["currency"])
+        # Only the refreshed field is clean again
+        self.assertEqual(self.account.get_dirty_fields(), ["name"])
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.get_dirty_fields(), [])
+        self.assertEqual((self.account.name, self.account.currency), ("Wallet", "USD"))
+        self.assertEqual(self.updated_columns(self.account.save), [])
+
+
+class PointInTimeBalanceTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("history")
+        self.account = make_account(self.user, "Main", "1000.00")
+        self.other = make_account(self.user, "Savings", "250.00")
+        start = date(2026, 1, 20)
+        for i, (kind, amount) in enumerate(
+            [("income", 300), ("expense", 120), ("transfer", 80), ("income", 45), ("expense", 500), ("transfer", 60)]
+        ):
+            source, destination = (self.other, self.account) if i == 5 else (self.account, self.other)
+            Transaction.objects.create(
+                user=self.user,
+                account=source,
+                to_account=destination if kind == "transfer" else None,
+                transaction_type=kind,
+                amount=amount,
+                date=start + timedelta(days=17 * i),
+            )
+        self.days = [date(2026, 1, 1), date(2026, 1, 31), date(2026, 2, 28), date(2026, 3, 15), date(2026, 4, 30), date(2026, 6, 1)]
+
+    def replay(self, account, on):
+        """The balance at the end of ``on``, from the opening balance and every transaction up to it"""
+        account.refresh_from_db()
+        balance = account.opening_balance
+        for txn in Transaction.objects.filter(date__lte=on):
+            balance += txn.deltas().get(account.pk, 0)
+        return balance
+
+    def assert_matches_replay(self):
+        for account in (self.account, self.other):
+            for on in self.days:
+                with self.subTest(account=account.name, on=on):
+                    self.assertEqual(ledger.balance_as_of(account, on), self.replay(account, on))
+
+    def test_without_checkpoints(self):
+        self.assert_matches_replay()
+        self.assertEqual(ledger.balance_as_of(self.account, date(2026, 6, 1)), self.account.balance)
+
+    def test_with_checkpoints(self):
+        for on in (date(2026, 1, 31), date(2026, 2, 28), date(2026, 3, 31)):
+            ledger.write_checkpoints(on)
+        self.assert_matches_replay()
+
+    def test_checkpoints_follow_backdated_and_hand_edited_changes(self):
+        for on in (date(2026, 1, 31), date(2026, 2, 28), date(2026, 3, 31)):
+            ledger.write_checkpoints(on)
+        Transaction.objects.create(
+            user=self.user, account=self.account, transaction_type="expense", amount=70, date=date(2026, 2, 10)
+        )
+        self.account.refresh_from_db()
+        self.account.balance += 25
+        self.account.save()
+        self.assert_matches_replay()
+
+
+class RunningBalanceTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("running")
+        self.account = make_account(self.user, "Main", "1000.00")
+        self.other = make_account(self.user, "Savings", "200.00")
+        self.today = date.today()
+        self.post("income", 100, self.today)
+
+    def post(self, kind, amount, on, account=None, to_account=None):
+        return Transaction.objects.create(
+            user=self.user,
+            account=account or self.account,
+            to_account=to_account,
+            transaction_type=kind,
+            amount=amount,
+            date=on,
+        )
+
+    def assert_running_balances(self):
+        """Every stored running balance matches a replay in ledger order, ending at the ledger balance"""
+        computed = dict(ledger.with_computed_balance().values_list("pk", "computed_balance"))
+        for account in (self.account, self.other):
+            account.refresh_from_db()
+            running = account.opening_balance
+            for txn in account.history().order_by(*ledger.ORDERING):
+                running += txn.deltas()[account.pk]
+                stored = txn.balance_after if txn.account_id == account.pk else txn.to_balance_after
+                self.assertEqual(stored, running, f"{account.name}: {txn}")
+            self.assertEqual(running, computed[account.pk])
+
+    def test_posted_in_order(self):
+        self.assertEqual(Transaction.objects.get().balance_after, Decimal("1100.00"))
+        self.assert_running_balances()
+
+    def test_backdated_insert(self):
+        self.post("transfer", 30, self.today - timedelta(days=1), to_account=self.other)
+        self.post("expense", 50, self.today - timedelta(days=3))
+        self.assert_running_balances()
+        self.assertEqual(ledger.drift(), [])
+        self.assertEqual(Transaction.objects.get(transaction_type="income").balance_after, Decimal("1020.00"))
+
+    def test_edit(self):
+        expense = self.post("expense", 50, self.today - timedelta(days=3))
+        transfer = self.post("transfer", 40, self.today - timedelta(days=2), account=self.other, to_account=self.account)
+        expense.date = self.today - timedelta(days=1)
+        expense.save()
+        transfer.date = self.today - timedelta(days=5)
+        transfer.save()
+        self.assert_running_balances()
+
+    def test_delete(self):
+        expense = self.post("expense", 50, self.today - timedelta(days=3))
+        self.post("transfer", 40, self.today - timedelta(days=2), account=self.other, to_account=self.account)
+        expense.delete()
+        self.assert_running_balances()
+
+    def test_balance_edited_by_hand(self):
+        self.post("expense", 50, self.today - timedelta(days=3))
+        self.account.refresh_from_db()
+        self.account.balance -= 150
+        self.account.save()
+        self.assert_running_balances()
+        self.assertEqual(ledger.drift(), [])
+
+
+class ChunkedRunningBalanceTests(RunningBalanceTests):
+    """The same, on databases without a windowed UPDATE"""
+
+    def setUp(self):
+        patcher = mock.patch.object(ledger, "_windowed_update_sql", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+
+class TwoTierCacheTests(TestCase):
+    def setUp(self):
+        self.cache = caches["sessions"]
+        self.cache.clear()
+
+    def forget_l1(self):
+        """What another worker process sees: nothing in L1"""
+        with self.cache._lock:
+            self.cache.l1.clear()
+
+    def test_metric_labels_stay_bounded(self):
+        self.assertEqual(self.cache._namespace("auth:user:1:abc"), "auth")
+        self.assertEqual(self.cache._namespace("financeapp.sessions.k2j3h4g5"), "sessions")
+        self.assertEqual(self.cache._namespace("financeapp.sessions.k2j3h4g5:fill-lock"), "sessions")
+
+    def test_values_outlive_l1(self):
+        self.cache.set("ledger:version:1", "v1", timeout=None)
+        self.forget_l1()
+        self.assertEqual(self.cache.get("ledger:version:1"), "v1")
+
+    def test_add_and_incr_hold_across_processes(self):
+        self.assertTrue(self.cache.add("lock:job", 1))
+        self.forget_l1()
+        self.assertFalse(self.cache.add("lock:job", 2))
+        self.cache.set("counter:hits", 1)
+        self.forget_l1()
+        self.assertEqual(self.cache.incr("counter:hits"), 2)
+        self.forget_l1()
+        self.assertEqual(self.cache.get("counter:hits"), 2)
+
+
+@override_settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_EXPLAIN=True)
+class SlowQueryLoggerTests(TestCase):
+    def setUp(self):
+        self.logger = SlowQueryLogger()
+        patcher = mock.patch.object(slow_queries.logger, "warning")
+        self.warning = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def logged(self, table):
+        return [call.kwargs["extra"] for call in self.warning.call_args_list if table in call.kwargs["extra"]["sql"]]
+
+    def test_logs_a_slow_query_with_its_plan(self):
+        with connection.execute_wrapper(self.logger):
+            list(Account.objects.filter(name="Savings"))
+        entries = self.logged("financeapp_account")
+        self.assertTrue(entries)
+        self.assertTrue(any(entry["plan"] for entry in entries))
+
+    def test_failed_query_is_neither_logged_nor_explained(self):
+        with connection.execute_wrapper(self.logger):
+            with self.assertRaisesMessage(DatabaseError, "no_such_table"), transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT * FROM no_such_table")
+        self.assertEqual(self.logged("no_such_table"), [])
+
+
+class FanOutThrottleTests(TestCase):
+    def test_probe_does_not_time_connecting(self):
+        connected = []
+
+        def cold_connection():
+            # Only the first call has to open the connection
+            if not connected:
+                time.sleep(0.2)
+                connected.append(True)
+
+        with mock.patch.object(connection, "ensure_connection", cold_connection), override_settings(
+            FANOUT_MAX_PROBE_MS=100
+        ):
+            self.assertFalse(jobs.db_busy())
+
+    @override_settings(FANOUT_MAX_THROTTLE_RETRIES=3, FANOUT_THROTTLE_DELAY=0)
+    def test_busy_database_postpones_a_chunk_only_so_often(self):
+        with mock.patch.object(jobs, "db_busy", return_value=True) as busy, mock.patch.object(
+            jobs, "run_chunk", return_value=7
+        ) as run:
+            result = run_fanout_chunk.apply(args=(42,))
+        self.assertEqual(result.get(), 7)
+        self.assertEqual(busy.call_count, 3)
+        run.assert_called_once_with(42)
+
+    def test_chunks_are_routed_by_their_users_tier(self):
+        premium = get_user_model().objects.create_user("premium")
+        UserProfile.objects.filter(user=premium).update(account_type="premium")
+        standard = get_user_model().objects.create_user("standard")
+        job = jobs.start("warm_chat_context", chunk_size=10, dispatch_chunks=False)
+        with mock.patch.object(jobs, "group") as group:
+            jobs.dispatch(job)
+        router = run_fanout_chunk.app.amqp.router
+        queues = {}
+        for signature in group.call_args.args[0]:
+            chunk = FanOutChunk.objects.get(pk=signature.args[0])
+            route = router.route(dict(signature.options), signature.task, signature.args, signature.kwargs)
+            queues[tuple(chunk.user_ids)] = route["queue"].name
+        self.assertEqual(queues, {(premium.pk,): "analytics.premium", (standard.pk,): "analytics.standard"})
+
+
+class BrokerReconnectTests(SimpleTestCase):
+    def call(self, in_atomic_block):
+        attempts = []
+
+        @broker._reconnecting
+        def put():
+            attempts.append(True)
+            if len(attempts) == 1:
+                raise OperationalError("server has gone away")
+            return "sent"
+
+        with mock.patch.object(broker, "connection") as db:
+            db.in_atomic_block = in_atomic_block
+            try:
+                return put(), len(attempts), db.close.called
+            except OperationalError:
+                return None, len(attempts), db.close.called
+
+    def test_retries_on_a_fresh_connection(self):
+        self.assertEqual(self.call(in_atomic_block=False), ("sent", 2, True))
+
+    def test_reraises_inside_a_transaction(self):
+        self.assertEqual(self.call(in_atomic_block=True), (None, 1, False))
+
+
+class ChatSnapshotTests(TestCase):
+    def test_snapshot_moves_on_with_the_month(self):
+        cache.clear()
+        user = get_user_model().objects.create_user("snapshot")
+        account = make_account(user, "Everyday", "100.00")
+        Transaction.objects.create(
+            user=user, account=account, transaction_type="expense", category="food", amount=25
+        )
+        snapshot = chat_context.get_snapshot(user)
+        self.assertEqual([row["category"] for row in snapshot["top_categories"]], ["food"])
+
+        next_month = timezone.now() + timedelta(days=32)
+        with mock.patch.object(timezone, "now", return_value=next_month):
+            snapshot = chat_context.get_snapshot(user)
+        self.assertEqual(snapshot["as_of"], next_month.date().isoformat())
+        self.assertEqual(snapshot["top_categories"], [])
+
+
+class ShardedBalanceTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("collector")
+        self.account = make_account(self.user, "Collections", "500.00")
+        ledger.set_balance_shards([self.account], 4)
+        for amount in (10, 20, 30):
+            Transaction.objects.create(user=self.user, account=self.account, transaction_type="income", amount=amount)
+        self.client.force_login(self.user)
+
+    def test_credits_wait_in_shards(self):
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal("500.00"))
+        self.assertEqual(self.account.current_balance(), Decimal("560.00"))
+
+    def test_readers_see_the_live_balance(self):
+        response = self.client.get(reverse("account_dashboard"))
+        self.assertEqual(response.context["total_balance"], Decimal("560.00"))
+        self.assertContains(response, "560")
+        response = self.client.get(reverse("transaction"))
+        self.assertEqual(response.context["total_balance"], Decimal("560.00"))
+        snapshot = chat_context.build_snapshot(self.user)
+        self.assertEqual(Decimal(snapshot["accounts"][0]["balance"]), Decimal("560.00"))
+
+    def test_entered_balance_is_the_live_balance(self):
+        request = RequestFactory().post(
+            "/accounts/update/",
+            {
+                "account_id": self.account.pk,
+                "account_name": "Collections",
+                "account_type": "Bank",
+                "account_balance": "600.00",
+                "account_currency": "NGN",
+            },
+            content_type="application/json",
+        )
+        request.user = self.user
+        response = views.update_account_api(request)
+        self.assertEqual(json.loads(response.content)["account"]["balance"], 600.0)
+        ledger.compact_balance_shards()
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal("600.00"))
+        self.assertEqual(ledger.drift(), [])
+
+
+class ConcurrentTransferTests(TransactionTestCase):
+    THREADS = 6
+    TRANSFERS = 20
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("transfers")
+        self.first = make_account(self.user, "First", "1000.00")
+        self.second = make_account(self.user, "Second", "1000.00")
+        # Each SQLite lock conflict below is logged as a failed save before it is retried
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def transfer(self, source, destination, errors):
+        try:
+            for _ in range(self.TRANSFERS):
+                for _ in range(200):
+                    try:
+                        Transaction.objects.create(
+                            user=self.user,
+                            account_id=source.pk,
+                            to_account_id=destination.pk,
+                            transaction_type="transfer",
+                            amount=Decimal("1.00"),
+                        )
+                        break
+                    except DatabaseError as e:
+                        # SQLite turns a second writer away instead of queueing it
+                        if "locked" not in str(e):
+                            errors.append(e)
+                            break
+                        time.sleep(0.002)
+                else:
+                    errors.append("database stayed locked")
+        finally:
+            connection.close()
+
+    def test_opposite_transfers_neither_deadlock_nor_lose_updates(self):
+        errors = []
+        threads = [
+            threading.Thread(
+                target=self.transfer,
+                args=(self.first, self.second, errors) if i % 2 else (self.second, self.first, errors),
+            )
+            for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=60)
+        self.assertFalse(any(thread.is_alive() for thread in threads), "transfers deadlocked")
+        self.assertEqual(errors, [])
+
+        self.assertEqual(Transaction.objects.count(), self.THREADS * self.TRANSFERS)
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        # As many transfers went each way, all of the same amount
+        self.assertEqual(self.first.balance, Decimal("1000.00"))
+        self.assertEqual(self.second.balance, Decimal("1000.00"))
+        self.assertEqual(ledger.drift(), [])
+
+
+class ConcurrentIdempotencyTests(TransactionTestCase):
+    def test_concurrent_duplicates_run_once(self):
+        user = get_user_model().objects.create_user("contact")
+        form = {"name": "Ada", "email": "ada@example.com", "subject": "Hi", "description": "Hello"}
+        sent, responses, errors = [], [], []
+
+        def send_mail(*args, **kwargs):
+            sent.append(args)
+            # Long enough for every duplicate to arrive while this one runs
+            time.sleep(0.3)
+
+        def post():
+            try:
+                for _ in range(200):
+                    request = RequestFactory().post(
+                        "/contact/", form, HTTP_IDEMPOTENCY_KEY="contact-1", HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+                    )
+                    request.user = user
+                    try:
+                        responses.append(views.contact_view(request))
+                        break
+                    except DatabaseError as e:
+                        # SQLite turns a second writer away; the client retries with the same key
+                        if "locked" not in str(e):
+                            errors.append(e)
+                            break
+                        time.sleep(0.002)
+                else:
+                    errors.append("database stayed locked")
+            finally:
+                connection.close()
+
+        with mock.patch.object(views, "send_mail", side_effect=send_mail):
+            threads = [threading.Thread(target=post) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=30)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(ContactMessage.objects.count(), 1)
+        self.assertEqual(len(responses), 5)
+        [first] = [
+            response
+            for response in responses
+            if response.status_code == 200 and not response.has_header("Idempotent-Replayed")
+        ]
+        for response in responses:
+            if response is first:
+                continue
+            # Told to come back while the first runs, or given its response once it's done
+            if response.status_code == 409:
+                self.assertEqual(response["Retry-After"], str(settings.IDEMPOTENCY_RETRY_AFTER))
+            else:
+                self.assertEqual(response.content, first.content)
+
+
+class IdempotencyReplayTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user("retrier")
+        self.runs = 0
+
+    def post(self, view):
+        request = RequestFactory().post("/settings/", {"theme": "dark"}, HTTP_IDEMPOTENCY_KEY="theme-1")
+        request.user = self.user
+        request.session = SessionStore()
+        request._messages = default_storage(request)
+        return request, idempotent(view)(request)
+
+    def test_replay_brings_back_cookies_and_messages(self):
+        def view(request):
+            self.runs += 1
+            messages.success(request, "Theme saved")
+            response = HttpResponse("saved")
+            response.set_cookie("theme", "dark", max_age=3600, httponly=True, samesite="Lax")
+            return response
+
+        _, original = self.post(view)
+        request, replayed = self.post(view)
+        self.assertEqual(self.runs, 1)
+        self.assertEqual(replayed["Idempotent-Replayed"], "true")
+        self.assertEqual(replayed.content, b"saved")
+        self.assertEqual(replayed.cookies["theme"].OutputString(), original.cookies["theme"].OutputString())
+        self.assertEqual([str(message) for message in messages.get_messages(request)], ["Theme saved"])
+        # Once the cache has lost it, the stored row replays the same
+        cache.clear()
+        request, replayed = self.post(view)
+        self.assertEqual(self.runs, 1)
+        self.assertEqual(replayed.cookies["theme"].value, "dark")
+        self.assertEqual([str(message) for message in messages.get_messages(request)], ["Theme saved"])
+
+    def test_running_duplicate_is_told_to_retry_without_waiting(self):
+        def view(request):
+            self.runs += 1
+            started = time.monotonic()
+            _, duplicate = self.post(view)
+            self.assertLess(time.monotonic() - started, 0.5)
+            self.assertEqual(duplicate.status_code, 409)
+            self.assertEqual(duplicate["Retry-After"], str(settings.IDEMPOTENCY_RETRY_AFTER))
+            return HttpResponse("saved")
+
+        _, response = self.post(view)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.runs, 1)
+
+
+class AccountStatementTests(TestCase):
+    def test_statement_includes_incoming_transfers(self):
+        user = get_user_model().objects.create_user("statement")
+        source = make_account(user, "Source", "500.00")
+        destination = make_account(user, "Destination", "100.00")
+        Transaction.objects.create(user=user, account=source, to_account=destination, transaction_type="transfer", amount=40)
+        Transaction.objects.create(user=user, account=destination, transaction_type="expense", amount=15)
+        self.client.force_login(user)
+
+        response = self.client.get(reverse("export_csv"), {"account": destination.pk})
+        rows = list(csv.reader(io.StringIO(response.content.decode())))
+        self.assertEqual(rows[0][-1], "Balance")
+        self.assertEqual([(row[1], row[-1]) for row in rows[1:]], [("Expense", "125.00"), ("Transfer", "140.00")])
+
+
+class StubOAuthTestCase(TestCase):
+    """Runs the OAuth client against ``manage.py stub_oauth_server`` on a free local port"""
+
+    server_options = {}
+
+    def setUp(self):
+        self.server = build_server(**self.server_options)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        overrides = override_settings(
+            GOOGLE_DISCOVERY_URL=self.server.discovery_url,
+            GOOGLE_CLIENT_ID="stub-client",
+            GOOGLE_CLIENT_SECRET="stub-secret",
+            GOOGLE_REDIRECT_URI="http://testserver/google/callback/",
+            OAUTH_RETRIES=2,
+            OAUTH_BACKOFF=0.1,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        cache.clear()
+        # The session (and its retry policy) is built once per process from settings
+        oauth._session = None
+        self.addCleanup(setattr, oauth, "_session", None)
+
+    def sign_in(self):
+        """Follow the stub's authorization redirect and return the code it issued"""
+        response = requests.get(oauth.authorization_url(state="xyz"), allow_redirects=False)
+        query = parse_qs(urlparse(response.headers["Location"]).query)
+        self.assertEqual(query["state"], ["xyz"])
+        return query["code"][0]
+
+
+class OAuthClientTests(StubOAuthTestCase):
+    def test_sign_in_verifies_the_id_token_locally(self):
+        tokens = oauth.exchange_code(self.sign_in())
+        claims = oauth.user_info(tokens)
+        self.assertEqual(claims["email"], "stub.user@example.com")
+        self.assertEqual(claims["aud"], "stub-client")
+        self.assertEqual(self.server.state["hits"]["/v1/userinfo"], 0)
+
+    def test_google_callback_signs_the_user_in(self):
+        response = self.client.get(reverse("google_login"))
+        location = requests.get(response.url, allow_redirects=False).headers["Location"]
+        response = self.client.get(reverse("google_callback"), parse_qs(urlparse(location).query))
+        user = get_user_model().objects.get(email="stub.user@example.com")
+        self.assertEqual(int(self.client.session["_auth_user_id"]), user.pk)
+
+    def test_discovery_and_keys_are_cached(self):
+        oauth.certs()
+        oauth.certs()
+        self.assertEqual(self.server.state["hits"]["/.well-known/openid-configuration"], 1)
+        self.assertEqual(self.server.state["hits"]["/oauth2/v3/certs"], 1)
+
+    def test_token_exchange_is_not_retried(self):
+        code = self.sign_in()
+        oauth.exchange_code(code)
+        with self.assertRaises(oauth.OAuthError):
+            oauth.exchange_code(code)
+        self.assertEqual(self.server.state["hits"]["/token"], 2)
+
+    def test_tampered_id_token_is_rejected(self):
+        tokens = oauth.exchange_code(self.sign_in())
+        header, payload, signature = tokens["id_token"].split(".")
+        forged = jwt.encode({"email": "attacker@example.com"}, "secret", algorithm="HS256").split(".")[1]
+        with self.assertRaises(oauth.OAuthError):
+            oauth.verify_id_token(f"{header}.{forged}.{signature}")
+
+    def test_id_token_for_another_client_is_rejected(self):
+        tokens = oauth.exchange_code(self.sign_in())
+        with override_settings(GOOGLE_CLIENT_ID="someone-else"), self.assertRaises(oauth.OAuthError):
+            oauth.verify_id_token(tokens["id_token"])
+
+    def test_rotated_keys_are_refetched(self):
+        retired = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(retired.public_key()))
+        jwk.update({"kid": "retired", "use": "sig", "alg": "RS256"})
+        jwks_uri = oauth.discovery()["jwks_uri"]
+        cache.set(f"oauth:certs:{jwks_uri}", {"keys": [jwk]})
+
+        claims = oauth.verify_id_token(oauth.exchange_code(self.sign_in())["id_token"])
+        self.assertEqual(claims["sub"], "1000")
+        self.assertEqual(self.server.state["hits"]["/oauth2/v3/certs"], 1)
+
+
+class OAuthRetryTests(StubOAuthTestCase):
+    server_options = {"fail_every": 2}
+
+    def test_failed_gets_are_retried(self):
+        # Every second GET is a 503; each one is retried
+        self.assertIn("jwks_uri", oauth.discovery())
+        self.assertIn("keys", oauth.certs())
+        self.assertEqual(sum(self.server.state["hits"].values()), 3)
+
+
+class OAuthBackoffTests(StubOAuthTestCase):
+    server_options = {"fail_every": 1}
+
+    def test_gives_up_after_backing_off(self):
+        started = time.monotonic()
+        with self.assertRaises(oauth.OAuthError):
+            oauth.discovery()
+        # One try and two retries, the second after 0.1 * 2 seconds of backoff (plus up to 0.1 of jitter)
+        self.assertEqual(self.server.state["hits"]["/.well-known/openid-configuration"], 3)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_unreachable_server_is_an_oauth_error(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(oauth.OAuthError):
+            oauth.discovery()
+
+
+class OutboxTests(TestCase):
+    """The outbox delivering to ``manage.py smtp_sink`` on a free local port"""
+
+    def setUp(self):
+        self.sink = build_sink(verbosity=0)
+        threading.Thread(target=self.sink.serve_forever, daemon=True).start()
+        self.addCleanup(self.sink.server_close)
+        self.addCleanup(self.sink.shutdown)
+        host, port = self.sink.server_address[:2]
+        # The test runner swaps EMAIL_BACKEND for locmem; put the outbox back in front of SMTP
+        overrides = override_settings(
+            EMAIL_BACKEND="financeapp.mail.OutboxBackend",
+            OUTBOX_DELIVERY_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+            EMAIL_HOST=host,
+            EMAIL_PORT=port,
+            EMAIL_USE_TLS=False,
+            EMAIL_HOST_USER=None,
+            EMAIL_HOST_PASSWORD=None,
+            OUTBOX_MAX_ATTEMPTS=3,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # A retry schedules a follow-up run; these tests run deliveries themselves
+        patcher = mock.patch.object(deliver_outbox, "apply_async")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, count=3):
+        with mock.patch.object(deliver_outbox, "delay") as delay:
+            with self.captureOnCommitCallbacks() as callbacks:
+                for i in range(count):
+                    mail.send_mail(f"Statement {i}", "Body", "noreply@example.com", [f"user{i}@example.com"])
+            # Delivery is only asked for once the rows are committed
+            delay.assert_not_called()
+            for callback in callbacks:
+                callback()
+        return delay
+
+    def make_due(self):
+        OutboxMessage.objects.filter(status="pending").update(next_attempt_at=timezone.now())
+
+    def test_sending_only_enqueues(self):
+        delay = self.send()
+        self.assertEqual(OutboxMessage.objects.filter(status="pending").count(), 3)
+        self.assertEqual(self.sink.state["connections"], 0)
+        self.assertTrue(delay.called)
+
+    def test_delivers_a_batch_over_one_connection(self):
+        self.send()
+        self.assertEqual(deliver_outbox(), {"sent": 3, "retrying": 0, "failed": 0})
+        self.assertEqual(self.sink.state["connections"], 1)
+        self.assertEqual(
+            sorted(message["subject"] for message in self.sink.state["received"]),
+            ["Statement 0", "Statement 1", "Statement 2"],
+        )
+        self.assertFalse(OutboxMessage.objects.exclude(status="sent").exists())
+
+    def test_failures_are_retried_with_backoff_then_given_up(self):
+        self.send(count=1)
+        self.sink.options["fail_rate"] = 1.0
+        self.assertEqual(deliver_outbox(), {"sent": 0, "retrying": 1, "failed": 0})
+        row = OutboxMessage.objects.get()
+        self.assertEqual((row.status, row.attempts), ("pending", 1))
+        self.assertGreater(row.next_attempt_at, timezone.now())
+        self.assertIn("451", row.last_error)
+        # Not due yet
+        self.assertEqual(deliver_outbox(), {"sent": 0, "retrying": 0, "failed": 0})
+
+        self.make_due()
+        deliver_outbox()
+        self.make_due()
+        self.assertEqual(deliver_outbox(), {"sent": 0, "retrying": 0, "failed": 1})
+        self.assertEqual(OutboxMessage.objects.get().status, "failed")
+
+    def test_retry_succeeds_once(self):
+        self.send(count=1)
+        self.sink.options["fail_rate"] = 1.0
+        deliver_outbox()
+        self.sink.options["fail_rate"] = 0.0
+        self.make_due()
+        self.assertEqual(deliver_outbox(), {"sent": 1, "retrying": 0, "failed": 0})
+        self.make_due()
+        deliver_outbox()
+        self.assertEqual(self.sink.state["messages"], 1)
+
+    def test_messages_are_stored_as_plain_fields(self):
+        message = mail.EmailMultiAlternatives(
+            "Reset your password",
+            "Follow the link",
+            "noreply@example.com",
+            ["user@example.com"],
+            cc=["audit@example.com"],
+            headers={"X-Campaign": "reset"},
+        )
+        message.attach_alternative("<p>Follow the link</p>", "text/html")
+        message.attach("terms.txt", "Terms", "text/plain")
+        with self.captureOnCommitCallbacks():
+            message.send()
+
+        row = OutboxMessage.objects.get()
+        self.assertEqual(row.to, ["user@example.com"])
+        self.assertEqual(row.headers, {"X-Campaign": "reset"})
+        self.assertEqual(row.alternatives, [["<p>Follow the link</p>", "text/html"]])
+        rebuilt = build_message(row).message()
+        self.assertEqual(rebuilt["Cc"], "audit@example.com")
+        self.assertEqual(rebuilt["X-Campaign"], "reset")
+        self.assertIn("<p>Follow the link</p>", rebuilt.as_string())
+        self.assertIn('filename="terms.txt"', rebuilt.as_string())
+
+        self.assertEqual(deliver_outbox(), {"sent": 1, "retrying": 0, "failed": 0})
+        [received] = self.sink.state["received"]
+        self.assertEqual(received["subject"], "Reset your password")
+        self.assertEqual(sorted(received["recipients"]), ["<audit@example.com>", "<user@example.com>"])
+
+    def test_claimed_messages_are_not_sent_twice(self):
+        self.send()
+        from .mail import claim_batch
+
+        first = claim_batch()
+        self.assertEqual(len(first), 3)
+        # A second worker finds nothing due while the first holds the lease
+        self.assertEqual(deliver_outbox(), {"sent": 0, "retrying": 0, "failed": 0})
+        self.assertEqual(self.sink.state["messages"], 0)
+
+
+async def post_asgi(path, payload, disconnect_after=None):
+    """
+    POST ``payload`` as JSON through the ASGI application; returns the status
+    and the body. With ``disconnect_after``, the client goes away once that
+    many body chunks have arrived.
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"testserver"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    inbox = asyncio.Queue()
+    inbox.put_nowait({"type": "http.request", "body": json.dumps(payload).encode(), "more_body": False})
+    status, chunks = None, []
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message.get("body"):
+            chunks.append(message["body"])
+            if len(chunks) == disconnect_after:
+                inbox.put_nowait({"type": "http.disconnect"})
+
+    await application(scope, inbox.get, send)
+    return status, b"".join(chunks).decode()
+
+
+def sse_events(body):
+    """(event, data) pairs from a Server-Sent Events body"""
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+@override_settings(CHAT_CACHE_ALIAS="default", LLM_MAX_CONCURRENCY=1, LLM_MAX_QUEUE=1, LLM_QUEUE_TIMEOUT=1)
+class ChatStreamTests(SimpleTestCase):
+    """Streams chat replies from ``manage.py fake_llm_server`` through the ASGI stack"""
+
+    def setUp(self):
+        cache.clear()
+        admission_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(admission_dir.cleanup)
+        overrides = override_settings(LLM_ADMISSION_DIR=admission_dir.name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # The limiter is built once per process from settings
+        patcher = mock.patch.object(admission, "_limiter", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def serve(self, **options):
+        server = build_fake_llm(**{"first_token_delay": 0, "token_delay": 0, **options})
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        overrides = override_settings(LLM_CHAT_URL=server.chat_url)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def assertSlotsFree(self):
+        limiter = admission.get_limiter()
+        self.assertEqual(limiter._held(limiter._slot_paths() + limiter._ticket_paths()), [])
+
+    async def test_streams_tokens_then_done(self):
+        self.serve(tokens=4)
+        status, body = await post_asgi("/api/chat/", {"text": "hello", "stream": True})
+        self.assertEqual(status, 200)
+        events = sse_events(body)
+        self.assertEqual([event for event, _ in events], ["token"] * 4 + ["done"])
+        self.assertEqual("".join(data["content"] for _, data in events[:-1]), "You said: hello. You ")
+        self.assertSlotsFree()
+
+    async def test_malformed_chunk_ends_the_stream_with_an_error_event(self):
+        self.serve(tokens=4, malformed_after=2)
+        status, body = await post_asgi("/api/chat/", {"text": "hello", "stream": True})
+        self.assertEqual(status, 200)
+        events = sse_events(body)
+        self.assertEqual([event for event, _ in events], ["token", "token", "error"])
+        self.assertEqual(events[-1][1], {"error": "The assistant sent a malformed reply"})
+        self.assertSlotsFree()
+
+    async def test_client_disconnect_stops_the_stream_and_frees_the_slot(self):
+        self.serve(tokens=200, token_delay=0.01)
+        status, body = await post_asgi("/api/chat/", {"text": "hello", "stream": True}, disconnect_after=3)
+        self.assertEqual(status, 200)
+        events = sse_events(body)
+        self.assertLess(len(events), 200)
+        self.assertNotIn("done", [event for event, _ in events])
+        self.assertSlotsFree()
+
+    async def test_unread_stream_holds_no_slot(self):
+        self.serve(tokens=4)
+        request = RequestFactory().post("/api/chat/", {"text": "hello", "stream": True}, content_type="application/json")
+        response = await views.external_chat_view(request)
+        self.assertTrue(response.streaming)
+        # The client went away before the body was sent
+        del response
+        self.assertSlotsFree()
+
+    async def test_full_queue_streams_an_error_event(self):
+        self.serve(tokens=4)
+        limiter = admission.get_limiter()
+        held = [await limiter.abegin(), await limiter.abegin()]
+        try:
+            status, body = await post_asgi("/api/chat/", {"text": "hello", "stream": True})
+        finally:
+            for hold in held:
+                await hold.arelease()
+        self.assertEqual(status, 200)
+        [(event, data)] = sse_events(body)
+        self.assertEqual(event, "error")
+        self.assertGreaterEqual(data["retry_after"], 1)
+        self.assertSlotsFree()
+
+    def test_counting_holders_takes_no_lock(self):
+        limiter = admission.get_limiter()
+        generating = limiter.begin()
+        waiting = limiter.begin()
+        self.addCleanup(waiting.release)
+        self.addCleanup(generating.release)
+        with mock.patch.object(admission, "_try_lock", side_effect=AssertionError("took a lock")):
+            gauges = limiter.gauges()
+            self.assertEqual(limiter.position(waiting), 1)
+        self.assertEqual(gauges[("financeapp_llm_in_flight", ())], 1)
+        self.assertEqual(gauges[("financeapp_llm_queued", ())], 1)
+        # The waiting ticket is left intact for its holder
+        [ticket] = limiter._held(limiter._ticket_paths())
+        self.assertEqual(float(ticket), waiting.enqueued_at)
+        generating.release()
+        waiting._try_admit()
+        self.assertTrue(waiting.admitted)
+
+
+class MetricsTests(TestCase):
+    REQUESTS = ("financeapp_http_requests_total", (("view", "home"),))
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        overrides = override_settings(METRICS_DIR=self.directory)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def write_process_file(self, pid, start, requests):
+        snapshot = {
+            "pid": pid,
+            "start": start,
+            "counters": [[self.REQUESTS[0], [list(pair) for pair in self.REQUESTS[1]], requests]],
+            "gauges": [["financeapp_llm_in_flight", [], 1]],
+            "histograms": [],
+        }
+        with open(os.path.join(self.directory, f"{pid}-{start}.json"), "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+
+    def test_exited_processes_are_archived_once(self):
+        exited = subprocess.Popen(["true"])
+        exited.wait()
+        self.write_process_file(exited.pid, 1, 5)
+        # This pid is alive, but as a later process than the one that wrote the file
+        self.write_process_file(os.getpid(), metrics.registry._start + 1, 3)
+        for _ in range(2):
+            counters, gauges, _ = metrics.collect()
+            self.assertEqual(counters[self.REQUESTS], 8)
+            self.assertEqual(gauges, {})
+        self.assertEqual(sorted(os.listdir(self.directory)), ["archive.json", "archive.lock"])
+
+    def test_live_process_counters_add_to_the_archive(self):
+        # Above the largest pid Linux allows, so never running
+        self.write_process_file(2 ** 22 + 1, 1, 5)
+        metrics.collect()
+        self.write_process_file(os.getpid(), metrics.registry._start, 2)
+        counters, gauges, _ = metrics.collect()
+        self.assertEqual(counters[self.REQUESTS], 7)
+        self.assertEqual(gauges, {("financeapp_llm_in_flight", ()): 1})
+
+    @override_settings(DEBUG=False, METRICS_TOKEN=None)
+    def test_endpoint_is_staff_only_without_a_token(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+        self.client.force_login(get_user_model().objects.create_user("ops", is_staff=True))
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+
+    @override_settings(DEBUG=False, METRICS_TOKEN="scrape-token")
+    def test_endpoint_accepts_the_scrape_token(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer scrape-token")
+        self.assertEqual(response.status_code, 200)
+
+
+class CachedAuthenticationTests(TestCase):
+    def setUp(self):
+        caches[settings.SESSION_CACHE_ALIAS].clear()
+        self.user = get_user_model().objects.create_user("cached", password="first-password")
+        self.client.force_login(self.user)
+        self.session_key = self.client.session.session_key
+        # Caches the user
+        self.assertEqual(self.resolve().pk, self.user.pk)
+
+    def resolve(self):
+        request = RequestFactory().get("/")
+        request.session = SessionStore(self.session_key)
+        CachedAuthenticationMiddleware(lambda request: HttpResponse()).process_request(request)
+        # Resolve the lazy user now
+        request.user.is_authenticated
+        return request.user
+
+    def user_queries(self, resolve):
+        with CaptureQueriesContext(connection) as queries:
+            user = resolve()
+        return user, [query["sql"] for query in queries if "auth_user" in query["sql"]]
+
+    def test_cached_user_is_served_without_loading_the_row(self):
+        user, queries = self.user_queries(self.resolve)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(queries, [])
+
+    def test_password_change_logs_the_session_out(self):
+        self.user.set_password("second-password")
+        self.user.save()
+        self.assertFalse(self.resolve().is_authenticated)
+
+    def test_deactivated_user_is_not_served(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.resolve().is_authenticated)
+
+    def test_staff_change_is_seen_on_the_next_request(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.assertTrue(self.resolve().is_staff)
+
+    def test_deleted_user_is_not_served(self):
+        self.user.delete()
+        self.assertFalse(self.resolve().is_authenticated)
+
+    def test_queryset_update_needs_an_explicit_invalidation(self):
+        get_user_model().objects.filter(pk=self.user.pk).update(is_staff=True)
+        # No signal: the cached user is still served
+        self.assertFalse(self.resolve().is_staff)
+        auth_cache.invalidate_user(self.user.pk)
+        self.assertTrue(self.resolve().is_staff)
+
+
+class UsageTests(TestCase):
+    def test_flushes_from_separate_processes_add_up(self):
+        workers = [usage.UsageBuffer(), usage.UsageBuffer()]
+        for i, worker in enumerate(workers):
+            worker.add("user-a", "landing", queries=3, db_seconds=0.5, cpu_seconds=0.25)
+            worker.add("user-b", "profile", queries=i, db_seconds=0.0, cpu_seconds=0.0)
+        # Interleaved: the second worker flushes between the first's two rounds
+        workers[0].flush(force=True)
+        workers[1].flush(force=True)
+        workers[0].add("user-a", "landing", queries=1, db_seconds=0.5, cpu_seconds=0.0)
+        workers[0].flush(force=True)
+
+        with mock.patch.object(usage, "buffer", usage.UsageBuffer()):
+            [first, second] = usage.top_consumers(order_by="requests")
+        self.assertEqual(first["user_hash"], "user-a")
+        self.assertEqual((first["requests"], first["queries"], first["db_seconds"]), (3, 7, 1.5))
+        self.assertEqual((second["user_hash"], second["requests"], second["queries"]), ("user-b", 2, 1))
+
+    def test_buckets_outside_the_window_are_dropped(self):
+        worker = usage.UsageBuffer()
+        old = usage.current_bucket() - settings.COST_WINDOW_BUCKETS
+        with mock.patch.object(usage, "current_bucket", return_value=old):
+            worker.add("user-a", "landing", queries=1, db_seconds=0.1, cpu_seconds=0.0)
+        worker.add("user-a", "landing", queries=1, db_seconds=0.1, cpu_seconds=0.0)
+        worker.flush(force=True)
+        self.assertEqual(list(UsageTotal.objects.values_list("bucket", flat=True)), [old + settings.COST_WINDOW_BUCKETS])
+
+
+class AsyncMiddlewareTests(TestCase):
+    @override_settings(DEBUG=True)
+    def test_project_middleware_is_not_adapted_under_asgi(self):
+        with mock.patch("django.core.handlers.base.logger") as logger:
+            ASGIHandler()
+        adapted = [call.args[1] for call in logger.debug.call_args_list if "adapted" in call.args[0]]
+        for path in settings.MIDDLEWARE:
+            if path.startswith("financeapp."):
+                self.assertNotIn(f"middleware {path}", adapted)
+
+    async def test_queries_are_counted_on_the_async_path(self):
+        user = await get_user_model().objects.acreate(username="async-costs")
+
+        async def view(request):
+            await sync_to_async(Account.objects.count)()
+            return HttpResponse()
+
+        middleware = MetricsMiddleware(usage.CostAccountingMiddleware(view))
+        self.assertTrue(iscoroutinefunction(middleware))
+        request = RequestFactory().get("/")
+        request.user = user
+        key = ("financeapp_db_queries_total", (("view", "unresolved"),))
+        before = metrics.registry._counters.get(key, 0)
+        with mock.patch.object(usage, "buffer", usage.UsageBuffer()) as buffer:
+            response = await middleware(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.registry._counters[key] - before, 1)
+        [users] = buffer._pending.values()
+        self.assertEqual(users[usage.user_hash(user.pk)]["unresolved"][usage.QUERIES], 1)
@@ -44,6 +44,8 @@ urlpatterns = [
     # Contact (TODO: ensure contact_view exists in views.py)
     path("contact/", views.contact_view, name="contact"),
     path("faq/", views.faq_view, name="faq"),
+    # Monitoring
+    path("metrics", views.metrics_view, name="metrics"),
     path(
         "privacy-policy/",
         views.privacy_view,
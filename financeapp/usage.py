@@ -0,0 +1,201 @@
+# financeapp/usage.py
+"""
+Per-user cost accounting.
+
+``CostAccountingMiddleware`` measures DB time, query count and CPU time for
+every authenticated request and attributes it to a keyed hash of the user
+id. Totals are buffered in-process and added to ``UsageTotal`` rows (one per
+time bucket, user and view) with ``F()`` increments, so any number of
+processes can flush at once without losing each other's counts, and the
+admin usage page can show rolling top consumers broken down by view. Requests served on the ASGI event loop (the async chat
+view) carry no CPU time, since the loop's thread is shared between requests.
+"""
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+
+from .middleware import QueryCounter, counting_queries, view_name
+from .models import UsageTotal
+
+logger = logging.getLogger(__name__)
+
+# Index of each value in the per-view counters list, and the matching UsageTotal fields
+REQUESTS, QUERIES, DB_SECONDS, CPU_SECONDS = range(4)
+FIELDS = ("requests", "queries", "db_seconds", "cpu_seconds")
+
+
+def user_hash(user_id):
+    """Stable pseudonymous id for a user (keyed, so it can't be brute forced offline)"""
+    digest = hmac.new(settings.SECRET_KEY.encode(), str(user_id).encode(), hashlib.sha256)
+    return digest.hexdigest()[:16]
+
+
+def current_bucket(now=None):
+    return int((now or time.time()) // settings.COST_BUCKET_SECONDS)
+
+
+def _add_to_total(bucket, user_key, view, values):
+    view = view[: UsageTotal._meta.get_field("view").max_length]
+    row = UsageTotal.objects.filter(bucket=bucket, user_hash=user_key, view=view)
+    increments = {field: F(field) + value for field, value in zip(FIELDS, values)}
+    if row.update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            UsageTotal.objects.create(bucket=bucket, user_hash=user_key, view=view, **dict(zip(FIELDS, values)))
+    except IntegrityError:
+        # Another process created it first
+        row.update(**increments)
+
+
+class UsageBuffer:
+    """Per-process accumulator flushed into the database at most every few seconds"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+
+    def add(self, user_key, view, queries, db_seconds, cpu_seconds):
+        bucket = current_bucket()
+        with self._lock:
+            views = self._pending.setdefault(bucket, {}).setdefault(user_key, {})
+            totals = views.setdefault(view, [0, 0, 0.0, 0.0])
+            totals[REQUESTS] += 1
+            totals[QUERIES] += queries
+            totals[DB_SECONDS] += db_seconds
+            totals[CPU_SECONDS] += cpu_seconds
+
+    def flush_due(self):
+        return time.monotonic() - self._last_flush >= settings.COST_FLUSH_INTERVAL
+
+    def flush(self, force=False):
+        if not force and not self.flush_due():
+            return
+        self._last_flush = time.monotonic()
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        for bucket, users in pending.items():
+            for user_key, views in users.items():
+                for view, values in views.items():
+                    try:
+                        _add_to_total(bucket, user_key, view, values)
+                    except Exception as e:
+                        logger.warning(f"Could not flush usage bucket {bucket}: {e}")
+                        # Kept for the next flush
+                        self._requeue(bucket, {user_key: {view: values}})
+        try:
+            # Buckets that have left the window
+            UsageTotal.objects.filter(bucket__lte=current_bucket() - settings.COST_WINDOW_BUCKETS).delete()
+        except Exception as e:
+            logger.warning(f"Could not prune usage buckets: {e}")
+
+    def _requeue(self, bucket, users):
+        with self._lock:
+            target = self._pending.setdefault(bucket, {})
+            for user_key, views in users.items():
+                target_views = target.setdefault(user_key, {})
+                for view, values in views.items():
+                    totals = target_views.setdefault(view, [0, 0, 0.0, 0.0])
+                    for i, value in enumerate(values):
+                        totals[i] += value
+
+
+buffer = UsageBuffer()
+
+
+class CostAccountingMiddleware:
+    """Attribute DB time, query count and CPU time to the requesting user"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = QueryCounter()
+        cpu_start = time.thread_time()
+        with counting_queries(queries):
+            response = self.get_response(request)
+        cpu_seconds = time.thread_time() - cpu_start
+
+        user_id = _user_id(request)
+        if user_id is not None:
+            buffer.add(user_hash(user_id), view_name(request), queries.count, queries.duration, cpu_seconds)
+            buffer.flush()
+        return response
+
+    async def __acall__(self, request):
+        queries = QueryCounter()
+        with counting_queries(queries):
+            response = await self.get_response(request)
+
+        # Resolving request.user may hit the session store and the database.
+        # CPU time isn't recorded: the event loop thread is shared with
+        # every other request in flight, so its clock says nothing about this one.
+        user_id = await sync_to_async(_user_id)(request)
+        if user_id is not None:
+            buffer.add(user_hash(user_id), view_name(request), queries.count, queries.duration, 0.0)
+            if buffer.flush_due():
+                await sync_to_async(buffer.flush)()
+        return response
+
+
+def _user_id(request):
+    user = getattr(request, "user", None)
+    return user.pk if user is not None and user.is_authenticated else None
+
+
+def top_consumers(limit=20, order_by="db_seconds"):
+    """
+    Rolling totals over the last ``COST_WINDOW_BUCKETS`` buckets, ordered by
+    ``order_by`` (requests, queries, db_seconds or cpu_seconds).
+    """
+    buffer.flush(force=True)
+    totals_by_view = (
+        UsageTotal.objects.filter(bucket__gt=current_bucket() - settings.COST_WINDOW_BUCKETS)
+        .values("user_hash", "view")
+        .annotate(**{field: Sum(field) for field in FIELDS})
+        .order_by()
+    )
+    merged = {}
+    for row in totals_by_view:
+        merged.setdefault(row["user_hash"], []).append({"view": row["view"], **{field: row[field] for field in FIELDS}})
+
+    rows = []
+    for user_key, breakdown in merged.items():
+        breakdown.sort(key=lambda item: item[order_by], reverse=True)
+        totals = {field: sum(item[field] for item in breakdown) for field in FIELDS}
+        rows.append({"user_hash": user_key, **totals, "views": breakdown})
+
+    rows.sort(key=lambda row: row[order_by], reverse=True)
+    return rows[:limit]
+
+
+def resolve_hashes(hashes):
+    """Map user hashes back to users (staff only; scans user ids)"""
+    from django.contrib.auth import get_user_model
+
+    wanted = set(hashes)
+    found = {}
+    for user in get_user_model().objects.only("id", "username").iterator(chunk_size=2000):
+        key = user_hash(user.pk)
+        if key in wanted:
+            found[key] = user
+            if len(found) == len(wanted):
+                break
+    return found
@@ -1,6 +1,9 @@
+import asyncio
 import json
 import csv
-import requests
+import time
+import httpx
+from asgiref.sync import sync_to_async
 from datetime import datetime, timedelta
 from collections import defaultdict
 from decimal import Decimal
@@ -20,7 +23,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.views.decorators.http import require_POST, require_GET
 from django.views.decorators.csrf import csrf_exempt, csrf_protect
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
 from django.db.models import Sum, Count, Q
 from django.conf import settings
@@ -29,8 +32,13 @@ from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.db.models.functions import ExtractWeek, ExtractMonth, ExtractYear
 from django.core.cache import cache
-from django_otp import user_has_device
+from django.core.exceptions import ValidationError
 
+from . import chat_cache, chat_context, ledger, llm, metrics, oauth
+from .admission import Overloaded, QueueTimeout, get_limiter
+from .asgi import client_disconnected
+from .auth_cache import user_has_device
+from .idempotency import idempotent
 from .models import (
     Account,
     Transaction,
@@ -64,6 +72,7 @@ class DecimalEncoder(json.JSONEncoder):
 @login_required
 def my_view(request):
     data = cache.get("my_cached_key")
+    metrics.record_cache_lookup("my_view", data is not None)
     if data is None:
         # Data not in cache, fetch from database or perform computation
         data = "Some data fetched from the database"
@@ -208,10 +217,10 @@ def landing(request):
     """Main dashboard view with comprehensive financial analysis"""
     user = request.user
     transactions = Transaction.objects.filter(user=user).order_by("-date")[:5]
-    accounts = Account.objects.filter(user=user)
+    accounts = ledger.with_live_balance(Account.objects.filter(user=user))
     budgets = Budget.objects.filter(user=user)
 
-    total_balance = sum(acc.balance for acc in accounts)
+    total_balance = sum(acc.live_balance for acc in accounts)
     total_budget = sum(b.amount for b in budgets)
     spent_budget = sum(
         t.amount for t in transactions if t.transaction_type == "expense"
@@ -338,8 +347,8 @@ def profile_view(request):
     except UserProfile.DoesNotExist:
         profile = UserProfile.objects.create(user=request.user)
 
-    accounts = Account.objects.filter(user=request.user, is_active=True)
-    total_balance = sum(account.balance for account in accounts)
+    accounts = ledger.with_live_balance(Account.objects.filter(user=request.user, is_active=True))
+    total_balance = sum(account.live_balance for account in accounts)
 
     recent_transactions = (
         Transaction.objects.filter(user=request.user)
@@ -359,6 +368,7 @@ def profile_view(request):
 
 
 @login_required
+@idempotent
 def edit_profile(request):
     user = request.user
 
@@ -446,9 +456,9 @@ def delete_user_account(request):
 # ----------------- Transaction Views -----------------
 @login_required
 def transaction(request):
-    accounts = Account.objects.filter(user=request.user)
+    accounts = ledger.with_live_balance(Account.objects.filter(user=request.user))
     total_balance = (
-        sum(account.balance for account in accounts) if accounts else Decimal("0.00")
+        sum(account.live_balance for account in accounts) if accounts else Decimal("0.00")
     )
 
     today = timezone.now()
@@ -498,7 +508,7 @@ def transaction(request):
 
     chart_data = {
         "labels": [account.name for account in accounts],
-        "data": [float(account.balance) for account in accounts],
+        "data": [float(account.live_balance) for account in accounts],
     }
 
     # ---- Budgets ----
@@ -539,6 +549,7 @@ def transaction(request):
 
 
 @login_required
+@idempotent
 def budget_manager(request):
     """Main budget management view"""
     today = timezone.now().date()
@@ -649,6 +660,7 @@ def budget_manager(request):
 
 @login_required
 @require_POST
+@idempotent
 def delete_budget(request, budget_id):
     """Delete a budget"""
     budget = get_object_or_404(Budget, id=budget_id, user=request.user)
@@ -740,6 +752,7 @@ def budget_insights_view(request):
 @login_required
 @require_POST
 @csrf_protect
+@idempotent
 def add_transaction(request):
     try:
         account_id = request.POST.get("account")
@@ -777,10 +790,14 @@ def add_transaction(request):
             )
 
         account = get_object_or_404(Account, id=account_id, user=request.user)
+        to_account = None
+        if transaction_type == "transfer":
+            to_account = get_object_or_404(Account, id=request.POST.get("to_account"), user=request.user)
 
-        # Create transaction
+        # Create transaction; saving it posts it to the account balances
         transaction = Transaction.objects.create(
             account=account,
+            to_account=to_account,
             user=request.user,
             transaction_type=transaction_type,
             amount=amount,
@@ -789,24 +806,16 @@ def add_transaction(request):
             date=transaction_date,
         )
 
-        # Update account balance
-        if transaction_type == "income":
-            account.balance += amount
-        else:
-            account.balance -= amount
-        account.save()
-
         # Calculate total balance
-        total_balance_result = Account.objects.filter(user=request.user).aggregate(
-            total_balance=Sum("balance")
+        total_balance = sum(
+            account.live_balance for account in ledger.with_live_balance(Account.objects.filter(user=request.user))
         )
-        total_balance = total_balance_result["total_balance"] or Decimal("0.00")
 
         return JsonResponse(
             {
                 "success": True,
                 "message": "Transaction added successfully",
-                "new_balance": float(account.balance),
+                "new_balance": float(account.current_balance()),
                 "total_balance": float(total_balance),
                 "transaction": {
                     "id": transaction.id,
@@ -822,6 +831,10 @@ def add_transaction(request):
             }
         )
 
+    except ValidationError as e:
+        return JsonResponse(
+            {"success": False, "message": " ".join(e.messages)}, status=400
+        )
     except Exception as e:
         return JsonResponse(
             {"success": False, "message": f"Server error: {str(e)}"}, status=500
@@ -831,19 +844,39 @@ def add_transaction(request):
 # ----------------- Export CSV -----------------
 @login_required
 def export_transactions_csv(request):
+    """
+    All of the user's transactions, or with ?account=<id> that account's
+    statement: its transactions and the transfers into it, each with the
+    account's running balance after it
+    """
+    account = None
+    if request.GET.get("account"):
+        account = get_object_or_404(Account, id=request.GET["account"], user=request.user)
+
     response = HttpResponse(content_type="text/csv")
     response["Content-Disposition"] = 'attachment; filename="financial_statement.csv"'
 
     writer = csv.writer(response)
-    writer.writerow(["Date", "Type", "Description", "Amount", "Category", "Account"])
-
-    transactions = (
-        Transaction.objects.filter(user=request.user)
-        .select_related("account")
-        .order_by("-date")
+    writer.writerow(
+        ["Date", "Type", "Description", "Amount", "Category", "Account"] + (["Balance"] if account else [])
     )
 
+    if account:
+        transactions = account.history().select_related("account").order_by("-date", "-created_at", "-id")
+    else:
+        transactions = (
+            Transaction.objects.filter(user=request.user)
+            .select_related("account")
+            .order_by("-date")
+        )
+
     for transaction in transactions:
+        if account:
+            balance = [
+                transaction.balance_after if transaction.account_id == account.pk else transaction.to_balance_after
+            ]
+        else:
+            balance = []
         writer.writerow(
             [
                 transaction.date.strftime("%Y-%m-%d") if transaction.date else "",
@@ -861,6 +894,7 @@ def export_transactions_csv(request):
                 ),
                 transaction.account.name if transaction.account else "",
             ]
+            + balance
         )
 
     return response
@@ -868,11 +902,10 @@ def export_transactions_csv(request):
 
 # ----------------- Account Management Views -----------------
 @login_required
+@idempotent
 def cards(request):
-    accounts = Account.objects.filter(user=request.user)
-    total_balance = accounts.aggregate(Sum("balance"))["balance__sum"] or Decimal(
-        "0.00"
-    )
+    accounts = ledger.with_live_balance(Account.objects.filter(user=request.user))
+    total_balance = sum((account.live_balance for account in accounts), Decimal("0.00"))
 
     if request.method == "POST":
         form = AccountForm(request.POST)
@@ -893,6 +926,7 @@ def cards(request):
 
 @csrf_exempt
 @require_POST
+@idempotent
 def update_account_api(request):
     """Update account via JSON API"""
     try:
@@ -912,7 +946,9 @@ def update_account_api(request):
 
         account.name = account_name
         account.account_type = account_type
-        account.balance = Decimal(account_balance)
+        # The balance shown, and entered, includes credits still in balance shards
+        pending = account.current_balance() - account.balance
+        account.balance = Decimal(account_balance) - pending
         account.currency = account_currency
         account.save()
 
@@ -924,7 +960,7 @@ def update_account_api(request):
                     "id": account.id,
                     "name": account.name,
                     "type": account.account_type,
-                    "balance": float(account.balance),
+                    "balance": float(account.balance + pending),
                     "currency": account.currency,
                 },
             }
@@ -937,6 +973,7 @@ def update_account_api(request):
 @login_required
 @require_POST
 @csrf_protect
+@idempotent
 def delete_account(request):
     try:
         data = json.loads(request.body)
@@ -974,6 +1011,7 @@ def load_settings(request):
 @login_required
 @csrf_exempt
 @require_POST
+@idempotent
 def save_setting(request):
     try:
         data = json.loads(request.body)
@@ -1012,36 +1050,197 @@ def home_redirect(request):
     return redirect("signup")
 
 
-@csrf_exempt
-def external_chat_view(request):
-    """Forward messages to a local LLM endpoint and return response"""
-    if request.method == "POST":
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _overloaded(error, status=429):
+    response = JsonResponse({"error": str(error), "retry_after": error.retry_after}, status=status)
+    response["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def _personal_context(request, prompt):
+    """The user's financial snapshot and matching transactions, for personal prompts"""
+    if not request.user.is_authenticated:
+        return None
+    return chat_context.context_for(request.user, prompt)
+
+
+async def _cached_chat_events(reply):
+    yield _sse("token", {"content": reply})
+    yield _sse("done", {"cached": True})
+
+
+async def _chat_events(user_message, stop, cacheable, context=None):
+    """
+    Server-Sent Events: "queued" (with position) while waiting for an LLM
+    slot, then the model's output as "token" events, then "done" or "error".
+    The slot is taken here rather than in the view, so a response that is
+    never iterated can't hold on to it.
+    """
+    try:
+        admission = await get_limiter().abegin()
+    except Overloaded as e:
+        yield _sse("error", {"error": str(e), "retry_after": e.retry_after})
+        return
+    try:
         try:
-            data = json.loads(request.body)
-            user_message = data.get("text", "")
-
-            response = requests.post(
-                "http://localhost:11434/api/chat",
-                json={
-                    "model": "llama3",
-                    "messages": [{"role": "user", "content": user_message}],
-                },
-                timeout=10,
+            async for position in admission.positions(stop):
+                yield _sse("queued", {"position": position})
+        except QueueTimeout as e:
+            yield _sse("error", {"error": str(e), "retry_after": e.retry_after})
+            return
+        if not admission.admitted:
+            return
+
+        started = time.perf_counter()
+        outcome = "ok"
+        pieces = []
+        try:
+            async for piece in llm.stream_chat(user_message, stop=stop, context=context):
+                if not pieces:
+                    metrics.observe("financeapp_chat_first_token_seconds", time.perf_counter() - started)
+                pieces.append(piece)
+                yield _sse("token", {"content": piece})
+            if stop is not None and stop.is_set():
+                outcome = "disconnected"
+            else:
+                if cacheable:
+                    await chat_cache.aset(user_message, "".join(pieces))
+                yield _sse("done", {})
+        except (TimeoutError, httpx.TimeoutException):
+            outcome = "timeout"
+            yield _sse("error", {"error": "The assistant took too long to respond"})
+        except httpx.HTTPStatusError as e:
+            outcome = "upstream_error"
+            yield _sse("error", {"error": f"Upstream returned {e.response.status_code}"})
+        except httpx.HTTPError as e:
+            outcome = "error"
+            yield _sse("error", {"error": str(e) or e.__class__.__name__})
+        except ValueError:
+            # A chunk that isn't JSON; the stream can't be trusted past it
+            outcome = "upstream_error"
+            yield _sse("error", {"error": "The assistant sent a malformed reply"})
+        except asyncio.CancelledError:
+            outcome = "disconnected"
+            raise
+        finally:
+            metrics.observe(
+                "financeapp_chat_proxy_duration_seconds", time.perf_counter() - started, outcome=outcome
             )
+    finally:
+        await admission.arelease()
+
+
+async def external_chat_view(request):
+    """
+    Forward messages to the LLM endpoint (async, pooled client). Returns
+    ``{"reply": ...}``, or streams Server-Sent Events (queued / token / done /
+    error) when the body has ``"stream": true`` or the client accepts
+    ``text/event-stream``. Requests beyond the LLM's capacity wait in a
+    bounded queue; when that is full they get 429 with Retry-After (or,
+    when streaming, an "error" event carrying ``retry_after``).
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request"}, status=400)
 
-            result = response.json()
-            bot_reply = (
-                result.get("message", {}).get("content")
-                if isinstance(result, dict)
-                else None
-            )
+    try:
+        data = json.loads(request.body)
+        user_message = data.get("text", "")
+    except (ValueError, AttributeError) as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    streaming = data.get("stream") or "text/event-stream" in request.headers.get("Accept", "")
+
+    # Repeated FAQ-style prompts are answered from the shared cache without
+    # touching the LLM; prompts about the user's own finances never are.
+    cacheable = chat_cache.cacheable(user_message)
+    if cacheable:
+        cached_reply = await chat_cache.aget(user_message)
+        if cached_reply is not None:
+            if streaming:
+                response = StreamingHttpResponse(_cached_chat_events(cached_reply), content_type="text/event-stream")
+                response["Cache-Control"] = "no-cache"
+                return response
+            return JsonResponse({"reply": cached_reply, "cached": True}, status=200)
+
+    context = None
+    if chat_cache.is_personal(user_message):
+        context = await sync_to_async(_personal_context)(request, user_message)
+
+    stop = client_disconnected(request)
+
+    if streaming:
+        response = StreamingHttpResponse(
+            _chat_events(user_message, stop, cacheable, context), content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        # Stop nginx-style proxies from buffering the stream
+        response["X-Accel-Buffering"] = "no"
+        return response
 
-            return JsonResponse({"reply": bot_reply}, status=200)
+    try:
+        admission = await get_limiter().abegin()
+    except Overloaded as e:
+        return _overloaded(e)
+    try:
+        try:
+            await admission.wait(stop)
+        except QueueTimeout as e:
+            return _overloaded(e, status=503)
+        if not admission.admitted:
+            return JsonResponse({"error": "Request cancelled"}, status=503)
 
-        except Exception as e:
-            return JsonResponse({"error": str(e)}, status=500)
+        started = time.perf_counter()
+        try:
+            response = await llm.chat(user_message, context=context)
+        except (TimeoutError, httpx.TimeoutException):
+            metrics.observe("financeapp_chat_proxy_duration_seconds", time.perf_counter() - started, outcome="timeout")
+            return JsonResponse({"error": "The assistant took too long to respond"}, status=504)
+        except httpx.HTTPError as e:
+            metrics.observe("financeapp_chat_proxy_duration_seconds", time.perf_counter() - started, outcome="error")
+            return JsonResponse({"error": str(e) or e.__class__.__name__}, status=502)
+    finally:
+        await admission.arelease()
+    metrics.observe(
+        "financeapp_chat_proxy_duration_seconds",
+        time.perf_counter() - started,
+        outcome="ok" if response.is_success else "upstream_error",
+    )
+
+    try:
+        result = response.json()
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=500)
+    bot_reply = result.get("message", {}).get("content") if isinstance(result, dict) else None
+    if cacheable and response.is_success and isinstance(bot_reply, str):
+        await chat_cache.aset(user_message, bot_reply)
+    return JsonResponse({"reply": bot_reply}, status=200)
+
+
+# Django 4.2's csrf_exempt wraps views in a sync function; mark the coroutine directly
+external_chat_view.csrf_exempt = True
+
+
+@require_GET
+def metrics_view(request):
+    """
+    Prometheus text exposition of metrics from every local worker process.
+    Scrapers send ``METRICS_TOKEN`` as a bearer token; staff can look in a
+    browser. Without a token it is only open in DEBUG.
+    """
+    token = getattr(settings, "METRICS_TOKEN", None)
+    authorized = (
+        (token and request.headers.get("Authorization") == f"Bearer {token}")
+        or request.user.is_staff
+        or (settings.DEBUG and not token)
+    )
+    if not authorized:
+        return HttpResponse("Unauthorized", status=401, content_type="text/plain")
 
-    return JsonResponse({"error": "Invalid request"}, status=400)
+    body = metrics.render(extra_gauges={**metrics.celery_queue_depths(), **get_limiter().gauges()})
+    return HttpResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 def faq_view(request):
@@ -1068,6 +1267,8 @@ def user_settings(request):
 
 
 # ----------------- Contact View -----------------
+# Records are per user, so only signed-in senders' retries are deduplicated
+@idempotent
 def contact_view(request):
     if request.method == "POST":
         form = ContactForm(request.POST)
@@ -1081,7 +1282,7 @@ def contact_view(request):
                 Name: {contact_message.name}
                 Email: {contact_message.email}
                 Subject: {contact_message.subject}
-                Message: {contact_message.message}
+                Message: {contact_message.description}
                 """
                 from_email = getattr(
                     settings, "DEFAULT_FROM_EMAIL", "noreply@wealthywise.com"
@@ -1115,17 +1316,11 @@ def contact_view(request):
 
 
 def google_login(request):
-    GOOGLE_CLIENT_ID = settings.GOOGLE_CLIENT_ID
-    GOOGLE_CLIENT_SECRET = settings.GOOGLE_CLIENT_SECRET
-    GOOGLE_REDIRECT_URI = settings.GOOGLE_REDIRECT_URI
-    auth_url = (
-        "https://accounts.google.com/o/oauth2/v2/auth"
-        "?response_type=code"
-        f"&client_id={GOOGLE_CLIENT_ID}"
-        f"&redirect_uri={GOOGLE_REDIRECT_URI}"
-        "&scope=email profile"
-    )
-    return redirect(auth_url)
+    try:
+        return redirect(oauth.authorization_url())
+    except oauth.OAuthError:
+        messages.error(request, "Google sign-in is unavailable right now. Please try again.")
+        return redirect("/login/")
 
 User = get_user_model()
 
@@ -1134,25 +1329,14 @@ def google_callback(request):
     if not code:
         return redirect("/login/")
 
-    # Exchange code for token
-    token_url = "https://oauth2.googleapis.com/token"
-    data = {
-        "code": code,
-        "client_id": settings.GOOGLE_CLIENT_ID,
-        "client_secret": settings.GOOGLE_CLIENT_SECRET,
-        "redirect_uri": settings.GOOGLE_REDIRECT_URI,
-        "grant_type": "authorization_code",
-    }
-    token_response = requests.post(token_url, data=data).json()
-    access_token = token_response.get("access_token")
-    if not access_token:
+    # Exchange code for token and resolve the profile
+    try:
+        tokens = oauth.exchange_code(code)
+        user_info = oauth.user_info(tokens)
+    except oauth.OAuthError:
+        messages.error(request, "Google sign-in failed. Please try again.")
         return redirect("/login/")
 
-    # Fetch user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v2/userinfo"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    user_info = requests.get(userinfo_url, headers=headers).json()
-
     email = user_info.get("email")
     first_name = user_info.get("given_name", "")
     last_name = user_info.get("family_name", "")
@@ -1180,6 +1364,7 @@ def google_callback(request):
 
 
 @login_required
+@idempotent
 def complete_profile(request):
     # Ask user to set a site password after Google login
     if request.method == "POST":